@@ -1,11 +1,24 @@
 #You will need to pip install flask and the sqlalchemy extension for flask.
+import logging
+
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+
+from database import AccountingSQLAlchemy
 
 # Initialize the application.
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+db = AccountingSQLAlchemy(app)
+
+# Messages of the accounting modules, they are only shown once an entry point calls configure_logging.
+logging.getLogger('accounting').setLevel(app.config['LOG_LEVEL'])
+logging.getLogger('accounting').addHandler(logging.NullHandler())
+
+
+def configure_logging():
+    """Send the messages to stderr unless logging was already configured, for the server and the commands."""
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
 
 # Import the views file for routing.
 import views
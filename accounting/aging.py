@@ -0,0 +1,167 @@
+#!/user/bin/env python2.7
+
+from itertools import groupby
+
+from sqlalchemy import func, select, union_all
+
+from accounting import db
+from models import ArchivedPayment, Invoice, Payment
+from utils import planned_installments, with_planned_rows
+
+"""
+#######################################################
+Accounts receivable aging report
+#######################################################
+
+The amount still due of every invoice is classified by the days passed since its due date. The payments of a
+policy settle its invoices in bill date order (FIFO), so what remains unpaid is always the most recent part
+of the billing. The invoices ordered by policy and the payments summed per policy are read with two queries
+and merged in a single pass, nothing is loaded per policy. The installments of the billing plans that the
+billing run didn't issue yet are aged like the invoices.
+"""
+
+# Name and last day past the due date of every bucket, the last one has no limit
+BUCKETS = (('current', 0), ('1-30', 30), ('31-60', 60), ('61+', None))
+
+
+def bucket_name(days_past_due):
+    for name, last_day in BUCKETS:
+        if last_day is None or days_past_due <= last_day:
+            return name
+
+
+def empty_buckets():
+    buckets = dict((name, 0) for name, last_day in BUCKETS)
+    buckets['past_cancel_date'] = 0
+    return buckets
+
+
+def aging_rows(date_cursor, chunk_size=10000):
+    """Yield the aging of every policy with invoices or payments until a date, ordered by policy.
+
+    :param date_cursor: Date of the report, only the invoices billed and payments received until it count.
+    :type  date_cursor: datetime.date
+    :param chunk_size: Rows fetched from the database at a time. (default = 10000)
+    :type  chunk_size: int
+    :returns: generator -- One dict per policy with its policy_id, balance, credit (the amount paid in
+                           advance), the amount due in each bucket and past_cancel_date, the part of it that
+                           passed the cancel date of its invoices.
+    """
+    invoices = Invoice.__table__.c
+    invoice_rows = db.fetch(select([invoices.policy_id, invoices.due_date, invoices.cancel_date,
+                                    invoices.amount_due])
+                            .where(invoices.deleted == False)
+                            .where(invoices.bill_date <= date_cursor)
+                            .order_by(invoices.policy_id, invoices.bill_date, invoices.id), chunk_size)
+    planned = dict((policy_id, [(policy_id, row['due_date'], row['cancel_date'], row['amount_due'])
+                                for row in rows])
+                   for policy_id, rows in planned_installments(date_cursor).items())
+    invoice_rows = with_planned_rows(invoice_rows, planned)
+
+    # The archived payments still settle the invoices of their policies
+    payments = union_all(*[select([table.c.policy_id, table.c.amount_paid])
+                           .where(table.c.transaction_date <= date_cursor)
+                           for table in (Payment.__table__, ArchivedPayment.__table__)]).alias('payments')
+    paid_rows = db.fetch(select([payments.c.policy_id, func.sum(payments.c.amount_paid)])
+                         .group_by(payments.c.policy_id)
+                         .order_by(payments.c.policy_id), chunk_size)
+
+    paid = next(paid_rows, None)
+    for policy_id, policy_invoices in groupby(invoice_rows, lambda row: row[0]):
+        # Policies that only have payments
+        while paid is not None and paid[0] < policy_id:
+            yield policy_aging(paid[0], [], paid[1], date_cursor)
+            paid = next(paid_rows, None)
+        amount_paid = 0
+        if paid is not None and paid[0] == policy_id:
+            amount_paid = paid[1]
+            paid = next(paid_rows, None)
+        yield policy_aging(policy_id, list(policy_invoices), amount_paid, date_cursor)
+    while paid is not None:
+        yield policy_aging(paid[0], [], paid[1], date_cursor)
+        paid = next(paid_rows, None)
+
+
+def policy_aging(policy_id, invoices, amount_paid, date_cursor):
+    """Classify the unpaid part of some invoices ordered by bill date, the payments settle the oldest first."""
+    aging = empty_buckets()
+    aging['policy_id'] = policy_id
+    aging['balance'] = sum(row[3] for row in invoices) - amount_paid
+    remaining = amount_paid
+    for row in invoices:
+        due_date, cancel_date, amount_due = row[1], row[2], row[3]
+        settled = min(remaining, amount_due)
+        remaining -= settled
+        unpaid = amount_due - settled
+        if not unpaid:
+            continue
+        aging[bucket_name(max((date_cursor - due_date).days, 0))] += unpaid
+        # The day of its cancel date an unpaid invoice already cancels the policy, see evaluate_cancel
+        if date_cursor >= cancel_date:
+            aging['past_cancel_date'] += unpaid
+    aging['credit'] = remaining
+    return aging
+
+
+def new_report(date_cursor):
+    totals = empty_buckets()
+    totals['balance'] = totals['credit'] = 0
+    return {'date': date_cursor.isoformat(), 'totals': totals, 'policies_due': 0}
+
+
+def add_to_report(report, aging):
+    """Add the aging of a policy to the totals of a report."""
+    for name in report['totals']:
+        report['totals'][name] += aging[name]
+    if aging['balance'] > 0:
+        report['policies_due'] += 1
+
+
+def aging_report(date_cursor, details=False, chunk_size=10000):
+    """Aging of the whole book until a date.
+
+    :param details: Include the aging of every policy with a balance. (default = False)
+    :type  details: bool
+    :returns: dict -- Date of the report, totals of the buckets, balance, credit and number of policies with
+                      something due, plus the policies when details are requested.
+    """
+    report = new_report(date_cursor)
+    if details:
+        report['policies'] = []
+    for aging in aging_rows(date_cursor, chunk_size):
+        add_to_report(report, aging)
+        if details and aging['balance']:
+            report['policies'].append(aging)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+    import csv
+    import sys
+    from datetime import datetime
+    from timeit import default_timer
+
+    parser = argparse.ArgumentParser(description="Accounts receivable aging of every policy.")
+    parser.add_argument('--date', help="Date of the report, %%Y-%%m-%%d, today if omitted")
+    parser.add_argument('--csv', action='store_true', help="Write the aging of every policy as CSV to stdout")
+    args = parser.parse_args()
+    configure_logging()
+
+    date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else datetime.now().date()
+    if args.csv:
+        fields = ['policy_id', 'balance', 'credit'] + [name for name, last_day in BUCKETS] + ['past_cancel_date']
+        writer = csv.DictWriter(sys.stdout, fields)
+        writer.writerow(dict(zip(fields, fields)))
+        for aging in aging_rows(date_cursor):
+            writer.writerow(aging)
+    else:
+        start = default_timer()
+        report = aging_report(date_cursor)
+        for name, last_day in BUCKETS:
+            print "%-16s %12d" % (name, report['totals'][name])
+        print "%-16s %12d" % ('past_cancel_date', report['totals']['past_cancel_date'])
+        print "%-16s %12d" % ('credit', report['totals']['credit'])
+        print "%d policies with an amount due, calculated in %.3f s" % (report['policies_due'],
+                                                                       default_timer() - start)
@@ -0,0 +1,198 @@
+#!/user/bin/env python2.7
+
+import logging
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import literal
+
+from accounting import app, db
+from models import ArchivedInvoice, ArchivedPayment, Invoice, Payment, Policy
+
+"""
+#######################################################
+Archive of deleted invoices and payments of closed policies
+#######################################################
+
+The invoices replaced by a new billing and the payments of the policies canceled or expired for longer than
+the retention window are moved to the invoices_archive and payments_archive tables in chunks, one transaction
+per chunk, so the live tables only keep the rows the hot queries need. The archived payments still count for
+the balance of their policies and the audit functions read both tables transparently.
+"""
+
+log = logging.getLogger('accounting.archive')
+
+
+def archive_deleted_invoices(chunk_size=500, archived_on=None):
+    """Move the invoices marked as deleted to the archive.
+
+    :param chunk_size: Number of invoices moved per transaction. (default = 500)
+    :type  chunk_size: int
+    :param archived_on: Date stored with the archived rows, today if omitted.
+    :type  archived_on: datetime.date
+    :returns: int -- Number of invoices archived.
+    """
+    archived_on = archived_on or datetime.now().date()
+    columns = [Invoice.id, Invoice.policy_id, Invoice.bill_date, Invoice.due_date, Invoice.cancel_date,
+               Invoice.amount_due, Invoice.deleted]
+    archived = 0
+    while True:
+        rows = db.session.query(*columns)\
+                         .filter(Invoice.deleted == True)\
+                         .order_by(Invoice.id)\
+                         .limit(chunk_size)\
+                         .all()
+        if not rows:
+            break
+        move_rows(rows, Invoice, ArchivedInvoice, archived_on)
+        archived += len(rows)
+        log.info("Archived %d deleted invoices", archived)
+    return archived
+
+
+def closed_policy_ids(date_cursor, retention_days):
+    """Return the identifiers of the policies canceled or expired before the retention window.
+
+    A policy expires one year after its effective date.
+    """
+    cutoff = date_cursor - timedelta(days=retention_days)
+    canceled = db.session.query(Policy.id)\
+                         .filter(Policy.status == "Canceled")\
+                         .filter(Policy.cancel_date < cutoff)
+    expired = db.session.query(Policy.id)\
+                        .filter(Policy.status == "Expired")\
+                        .filter(Policy.effective_date < cutoff - relativedelta(years=1))
+    return sorted(row.id for row in canceled.union(expired))
+
+
+def archive_closed_payments(date_cursor=None, retention_days=None, chunk_size=500):
+    """Move the payments of the policies canceled or expired before the retention window to the archive.
+
+    The policy balances ledger isn't modified, it keeps accounting for the archived payments.
+
+    :param date_cursor: Date the retention window is counted from, today if omitted.
+    :type  date_cursor: datetime.date
+    :param retention_days: Days a closed policy keeps its payments, ARCHIVE_RETENTION_DAYS if omitted.
+    :type  retention_days: int
+    :param chunk_size: Number of policies whose payments are moved per transaction. (default = 500)
+    :type  chunk_size: int
+    :returns: int -- Number of payments archived.
+    """
+    date_cursor = date_cursor or datetime.now().date()
+    if retention_days is None:
+        retention_days = app.config['ARCHIVE_RETENTION_DAYS']
+    columns = [Payment.id, Payment.policy_id, Payment.contact_id, Payment.amount_paid, Payment.transaction_date]
+
+    policy_ids = closed_policy_ids(date_cursor, retention_days)
+    archived = 0
+    for start in range(0, len(policy_ids), chunk_size):
+        rows = db.session.query(*columns)\
+                         .filter(Payment.policy_id.in_(policy_ids[start:start + chunk_size]))\
+                         .all()
+        if rows:
+            move_rows(rows, Payment, ArchivedPayment, date_cursor)
+            archived += len(rows)
+            log.info("Archived %d payments of closed policies", archived)
+    return archived
+
+
+def move_rows(rows, model, archive_model, archived_on):
+    """Copy some rows to their archive table and delete them from the live table, in one transaction."""
+    try:
+        db.session.execute(archive_model.__table__.insert(),
+                           [dict(zip(row.keys(), row), archived_on=archived_on) for row in rows])
+        # The rows are deleted in slices that stay below the limit of variables of a SQLite statement
+        ids = [row.id for row in rows]
+        for start in range(0, len(ids), 500):
+            model.query.filter(model.id.in_(ids[start:start + 500])).delete(synchronize_session=False)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+
+def compact_database(analyze=True):
+    """Give the space freed by the archive back to the file system and refresh the planner statistics.
+
+    Only SQLite is compacted, a database server reclaims the space of its tables by itself.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    db.session.remove()
+    db.engine.execute("VACUUM")
+    if analyze:
+        db.engine.execute("ANALYZE")
+
+
+def run_archive(date_cursor=None, retention_days=None, chunk_size=500, compact=True):
+    """Archive the deleted invoices and the payments of closed policies, then compact the database.
+
+    :returns: dict -- Number of invoices and payments archived.
+    """
+    stats = {'invoices': archive_deleted_invoices(chunk_size, date_cursor),
+             'payments': archive_closed_payments(date_cursor, retention_days, chunk_size)}
+    if compact:
+        compact_database()
+    return stats
+
+
+def audit_invoices(policy_id):
+    """Return every invoice of a policy, live, deleted or archived, ordered by bill date.
+
+    :returns: list -- One dict per invoice with its columns and whether it is archived.
+    """
+    invoices = []
+    for model in (Invoice, ArchivedInvoice):
+        for invoice in db.session.query(model.id, model.bill_date, model.due_date, model.cancel_date,
+                                        model.amount_due, model.deleted)\
+                                 .filter(model.policy_id == policy_id):
+            invoice = dict(zip(invoice.keys(), invoice))
+            invoice['archived'] = model is ArchivedInvoice
+            invoices.append(invoice)
+    return sorted(invoices, key=lambda invoice: (invoice['bill_date'], invoice['id']))
+
+
+def audit_payments(policy_id):
+    """Return every payment of a policy, live or archived, ordered by transaction date.
+
+    :returns: list -- One dict per payment with its columns and whether it is archived.
+    """
+    payments = []
+    for model in (Payment, ArchivedPayment):
+        for payment in db.session.query(model.id, model.contact_id, model.amount_paid, model.transaction_date)\
+                                 .filter(model.policy_id == policy_id):
+            payment = dict(zip(payment.keys(), payment))
+            payment['archived'] = model is ArchivedPayment
+            payments.append(payment)
+    return sorted(payments, key=lambda payment: (payment['transaction_date'], payment['id']))
+
+
+def payments_query(policy_id):
+    """Return a query of every payment of a policy, live or archived, for the payment listings.
+
+    The rows have the id, transaction_date, amount_paid and contact_id columns and whether they are archived.
+    The query is not ordered, filters and orders on the columns of Payment apply to both tables.
+    """
+    return db.session.query(Payment.id, Payment.transaction_date, Payment.amount_paid, Payment.contact_id,
+                            literal(False).label('archived'))\
+                     .filter(Payment.policy_id == policy_id)\
+                     .union_all(db.session.query(ArchivedPayment.id, ArchivedPayment.transaction_date,
+                                                 ArchivedPayment.amount_paid, ArchivedPayment.contact_id,
+                                                 literal(True).label('archived'))
+                                          .filter(ArchivedPayment.policy_id == policy_id))
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Archive deleted invoices and payments of closed policies.")
+    parser.add_argument('--retention-days', type=int, help="Days a closed policy keeps its payments")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Rows moved per transaction")
+    parser.add_argument('--no-compact', action='store_true', help="Skip VACUUM and ANALYZE")
+    args = parser.parse_args()
+    configure_logging()
+
+    stats = run_archive(retention_days=args.retention_days, chunk_size=args.chunk_size,
+                        compact=not args.no_compact)
+    print "Archived %(invoices)d invoices and %(payments)d payments" % stats
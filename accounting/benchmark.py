@@ -0,0 +1,354 @@
+#!/user/bin/env python2.7
+
+import json
+import random
+from StringIO import StringIO
+from datetime import date, timedelta
+from timeit import default_timer
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import func
+
+from accounting import app, db
+from cache import policy_cache
+from importer import PolicyImporter
+from models import AccountingEvent, ArchivedInvoice, ArchivedPayment, BillingPlan, Contact, Invoice, \
+    LedgerSnapshot, Payment, Policy, PolicyBalance
+from utils import BILLING_SCHEDULES, PolicyAccounting, account_balance, rebuild_policy_balances
+
+"""
+#######################################################
+Benchmarks for the accounting hot paths
+#######################################################
+"""
+
+def row_by_row_balance(policy_id, date_cursor):
+    """Reference implementation of the balance calculation that loads every row.
+
+    This is how PolicyAccounting.return_account_balance used to work, it is kept here only to be compared
+    against the current implementation.
+    """
+    invoices = Invoice.query.filter_by(policy_id=policy_id)\
+                            .filter(Invoice.bill_date <= date_cursor)\
+                            .filter(Invoice.deleted == False)\
+                            .order_by(Invoice.bill_date)\
+                            .all()
+    due_now = 0
+    for invoice in invoices:
+        due_now += invoice.amount_due
+
+    payments = Payment.query.filter_by(policy_id=policy_id)\
+                            .filter(Payment.transaction_date <= date_cursor)\
+                            .all()
+    for payment in payments:
+        due_now -= payment.amount_paid
+
+    return due_now
+
+
+def aggregate_balance(policy_id, date_cursor):
+    """Reference implementation of the balance calculation with SQL aggregates over the raw tables."""
+    billed = db.session.query(func.coalesce(func.sum(Invoice.amount_due), 0))\
+                       .filter(Invoice.policy_id == policy_id)\
+                       .filter(Invoice.bill_date <= date_cursor)\
+                       .filter(Invoice.deleted == False)\
+                       .as_scalar()
+    paid = db.session.query(func.coalesce(func.sum(Payment.amount_paid), 0))\
+                     .filter(Payment.policy_id == policy_id)\
+                     .filter(Payment.transaction_date <= date_cursor)\
+                     .as_scalar()
+    return int(db.session.query(billed - paid).scalar())
+
+
+def time_calls(function, args, repeat):
+    """Call a function several times and return the last result and the average time per call in ms."""
+    result = None
+    start = default_timer()
+    for _ in range(repeat):
+        result = function(*args)
+        # Drop the identity map so every call pays the full cost of loading its rows.
+        db.session.expire_all()
+    elapsed = default_timer() - start
+    return result, elapsed * 1000.0 / repeat
+
+
+def create_heavy_policy(years=5, payments_per_month=3):
+    """Create a monthly policy with several years of invoices and many partial payments.
+
+    :returns: tuple -- (Policy, Contact, Contact) created, so they can be removed afterwards.
+    """
+    agent = Contact('Benchmark Agent', 'Agent')
+    insured = Contact('Benchmark Insured', 'Named Insured')
+    db.session.add(agent)
+    db.session.add(insured)
+    db.session.commit()
+
+    policy = Policy('Benchmark Policy', date(2015, 1, 1), 1200)
+    policy.billing_schedule = 'Monthly'
+    policy.named_insured = insured.id
+    policy.agent = agent.id
+    db.session.add(policy)
+    db.session.commit()
+
+    for month in range(years * 12):
+        bill_date = policy.effective_date + relativedelta(months=month)
+        db.session.add(Invoice(policy.id,
+                               bill_date,
+                               bill_date + relativedelta(months=1),
+                               bill_date + relativedelta(months=1, days=14),
+                               100))
+        for payment in range(payments_per_month):
+            db.session.add(Payment(policy.id, insured.id, 100 / payments_per_month,
+                                   bill_date + relativedelta(days=payment)))
+    db.session.commit()
+    rebuild_policy_balances([policy.id])
+
+    return policy, agent, insured
+
+
+def remove_heavy_policy(policy, agent, insured):
+    Invoice.query.filter_by(policy_id=policy.id).delete()
+    Payment.query.filter_by(policy_id=policy.id).delete()
+    PolicyBalance.query.filter_by(policy_id=policy.id).delete()
+    db.session.delete(policy)
+    db.session.delete(agent)
+    db.session.delete(insured)
+    db.session.commit()
+
+
+def compare_balance_engines(years=5, payments_per_month=3, repeat=50):
+    """Compare the row by row and aggregate balance calculations against the ledger lookup.
+
+    :returns: dict -- Average milliseconds per call of each implementation and the balance obtained.
+    """
+    policy, agent, insured = create_heavy_policy(years, payments_per_month)
+    try:
+        date_cursor = policy.effective_date + relativedelta(years=years)
+        results = {}
+        for name, function in [('row_by_row', row_by_row_balance),
+                               ('aggregate', aggregate_balance),
+                               ('ledger', account_balance)]:
+            balance, results[name + '_ms'] = time_calls(function, (policy.id, date_cursor), repeat)
+            if results.setdefault('balance', balance) != balance:
+                raise AssertionError("Balance mismatch in %s: %d != %d" % (name, balance, results['balance']))
+    finally:
+        remove_heavy_policy(policy, agent, insured)
+
+    return results
+
+
+# Prefix of the policy numbers and contact names of the synthetic portfolio, used to remove it afterwards.
+SYNTHETIC_PREFIX = 'Synthetic'
+
+
+def synthetic_records(policies, payments, seed=0, start=date(2015, 1, 1)):
+    """Yield the (line_number, record) of a random portfolio in the format read by the importer.
+
+    The same seed always produces the same portfolio. Policies are spread across the billing schedules and
+    their effective dates along a year, agents are shared by around fifty policies and one in five insureds
+    holds more than one policy.
+
+    :param policies: Number of policies.
+    :type  policies: int
+    :param payments: Number of payments, each one for a random policy.
+    :type  payments: int
+    """
+    rng = random.Random(seed)
+    schedules = sorted(BILLING_SCHEDULES)
+    agents = max(1, policies / 50)
+    insureds = max(1, policies * 4 / 5)
+    effective_dates = []
+    for number in range(policies):
+        effective_date = start + timedelta(days=rng.randrange(365))
+        effective_dates.append(effective_date)
+        yield number + 1, {'record_type': 'policy',
+                           'policy_number': '%s Policy %d' % (SYNTHETIC_PREFIX, number),
+                           'effective_date': effective_date.isoformat(),
+                           'billing_schedule': rng.choice(schedules),
+                           'annual_premium': rng.randrange(12, 5000),
+                           'named_insured': '%s Insured %d' % (SYNTHETIC_PREFIX, rng.randrange(insureds)),
+                           'agent': '%s Agent %d' % (SYNTHETIC_PREFIX, rng.randrange(agents))}
+    for number in range(payments):
+        policy = rng.randrange(policies)
+        yield policies + number + 1, {'record_type': 'payment',
+                                      'policy_number': '%s Policy %d' % (SYNTHETIC_PREFIX, policy),
+                                      'transaction_date': (effective_dates[policy] +
+                                                           timedelta(days=rng.randrange(365))).isoformat(),
+                                      'amount': rng.randrange(10, 500)}
+
+
+def generate_portfolio(policies=1000, payments=3000, seed=0):
+    """Store a synthetic portfolio through the bulk importer.
+
+    :returns: dict -- Statistics of the import.
+    """
+    return PolicyImporter().import_records(synthetic_records(policies, payments, seed))
+
+
+def remove_portfolio():
+    """Remove every row of the synthetic portfolio."""
+    policy_ids = [row.id for row in db.session.query(Policy.id)
+                                              .filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %'))]
+    for start in range(0, len(policy_ids), 500):
+        chunk = policy_ids[start:start + 500]
+        for model in (Invoice, Payment, ArchivedInvoice, ArchivedPayment, PolicyBalance, AccountingEvent,
+                      LedgerSnapshot, BillingPlan):
+            model.query.filter(model.policy_id.in_(chunk)).delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(chunk)).delete(synchronize_session=False)
+    Contact.query.filter(Contact.name.like(SYNTHETIC_PREFIX + ' %')).delete(synchronize_session=False)
+    db.session.commit()
+    policy_cache.clear()
+
+
+def measure(calls):
+    """Run a list of callables and summarize how long each one took, in milliseconds."""
+    durations = []
+    for call in calls:
+        start = default_timer()
+        call()
+        durations.append((default_timer() - start) * 1000.0)
+        db.session.expire_all()
+    durations.sort()
+    return {'calls': len(durations),
+            'mean_ms': sum(durations) / len(durations),
+            'min_ms': durations[0],
+            'p95_ms': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            'max_ms': durations[-1]}
+
+
+def run_suite(policies=1000, payments=3000, samples=50, seed=0):
+    """Generate a synthetic portfolio, time the hot paths on it and remove it.
+
+    The accounting methods are timed on a random sample of the policies and the views through the Flask
+    test client, the write endpoints included. The policies they create are part of the synthetic portfolio.
+
+    :returns: dict -- The configuration of the run and the timings of every hot path, it can be dumped as
+                      JSON and compared with the results of another release with compare_results.
+    """
+    rng = random.Random(seed)
+    remove_portfolio()
+    import_stats = generate_portfolio(policies, payments, seed)
+    try:
+        policy_ids = [row.id for row in db.session.query(Policy.id)
+                                                  .filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %'))]
+        sample = rng.sample(policy_ids, min(samples, len(policy_ids)))
+        date_cursor = date(2015, 9, 1)
+        client = app.test_client()
+
+        def consult(policy_id):
+            policy_cache.clear()
+            client.post('/consult_policy', content_type='application/json',
+                        data=json.dumps({'date': date_cursor.isoformat(), 'policy_id': {'id': policy_id}}))
+
+        def timeline(policy_id):
+            client.post('/balance_timeline', content_type='application/json',
+                        data=json.dumps({'start': '2015-01-01', 'end': '2015-12-31', 'step_days': 7,
+                                         'policy_id': {'id': policy_id}}))
+
+        def make_payment(policy_id):
+            client.post('/make_payment', content_type='application/json',
+                        data=json.dumps({'date': date_cursor.isoformat(), 'payment_amount': 10,
+                                         'policy_id': {'id': policy_id}}))
+
+        def create_policy(number, insured_id, agent_id):
+            client.post('/create_policy', content_type='application/json',
+                        data=json.dumps({'date': date_cursor.isoformat(),
+                                         'policy_name': '%s Policy Created %d' % (SYNTHETIC_PREFIX, number),
+                                         'existingInsured': True, 'insured': {'id': insured_id},
+                                         'existingAgent': True, 'agent': {'id': agent_id},
+                                         'schedule': 'Monthly', 'premium': 1200}))
+
+        def import_policies(upload_seed):
+            # The records of another seed, their policy numbers repeat the portfolio's but the rows are new
+            upload = ''.join(json.dumps(record) + '\n'
+                             for line_number, record in synthetic_records(10, 30, upload_seed))
+            client.post('/import_policies', data={'file': (StringIO(upload), 'policies.jsonl')})
+
+        contacts = db.session.query(Policy.named_insured, Policy.agent).filter(Policy.id.in_(sample)).all()
+
+        results = {}
+        results['make_invoices'] = measure([PolicyAccounting(policy_id).make_invoices for policy_id in sample])
+        results['return_account_balance'] = measure(
+            [lambda policy_id=policy_id: PolicyAccounting(policy_id).return_account_balance(date_cursor)
+             for policy_id in sample])
+        results['evaluate_cancellation_pending_due_to_non_pay'] = measure(
+            [lambda policy_id=policy_id: PolicyAccounting(policy_id)
+                                         .evaluate_cancellation_pending_due_to_non_pay(date_cursor)
+             for policy_id in sample])
+        results['view_consult_policy'] = measure([lambda policy_id=policy_id: consult(policy_id)
+                                                  for policy_id in sample])
+        results['view_balance_timeline'] = measure([lambda policy_id=policy_id: timeline(policy_id)
+                                                    for policy_id in sample])
+        results['view_list_policies'] = measure([lambda: client.get('/list_policies')] * 5)
+        results['view_users'] = measure([lambda: client.get('/users')] * 5)
+        results['view_make_payment'] = measure([lambda policy_id=policy_id: make_payment(policy_id)
+                                                for policy_id in sample])
+        results['view_create_policy'] = measure(
+            [lambda number=number, contact=contact: create_policy(number, contact.named_insured, contact.agent)
+             for number, contact in enumerate(contacts)])
+        results['view_import_policies'] = measure([lambda upload=upload: import_policies(seed + upload + 1)
+                                                   for upload in range(5)])
+        # Last because it cancels policies
+        results['evaluate_cancel'] = measure(
+            [lambda policy_id=policy_id: PolicyAccounting(policy_id).evaluate_cancel(date_cursor)
+             for policy_id in sample])
+    finally:
+        remove_portfolio()
+
+    return {'config': {'policies': policies, 'payments': payments, 'samples': samples, 'seed': seed},
+            'import': {'records': import_stats['records'], 'rows_per_second': import_stats['rows_per_second']},
+            'results': results}
+
+
+def compare_results(baseline, current, tolerance=0.2):
+    """Compare the mean times of two runs of the suite.
+
+    :param tolerance: Fraction a mean can grow before it is reported as a regression. (default = 0.2)
+    :type  tolerance: float
+    :returns: list -- (name, baseline ms, current ms, ratio, regression) tuples sorted by name.
+    """
+    comparison = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before = baseline['results'][name]['mean_ms']
+        after = current['results'][name]['mean_ms']
+        ratio = after / before if before else 1.0
+        comparison.append((name, before, after, ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Time the accounting hot paths on a synthetic portfolio.")
+    parser.add_argument('--policies', type=int, default=1000)
+    parser.add_argument('--payments', type=int, default=3000)
+    parser.add_argument('--samples', type=int, default=50, help="Policies timed per hot path")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    parser.add_argument('--balance-engines', action='store_true',
+                        help="Only compare the balance implementations on a single heavy policy")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.balance_engines:
+        results = compare_balance_engines()
+        print "Balance: %d" % results['balance']
+        print "Row by row: %.3f ms per call" % results['row_by_row_ms']
+        print "Aggregate:  %.3f ms per call" % results['aggregate_ms']
+        print "Ledger:     %.3f ms per call" % results['ledger_ms']
+    else:
+        suite = run_suite(args.policies, args.payments, args.samples, args.seed)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(suite, output, indent=2, sort_keys=True)
+        print "Imported %(records)d records at %(rows_per_second).1f records per second" % suite['import']
+        for name in sorted(suite['results']):
+            print "%-45s %9.3f ms mean %9.3f ms p95" % (name, suite['results'][name]['mean_ms'],
+                                                        suite['results'][name]['p95_ms'])
+        if args.compare:
+            with open(args.compare) as baseline:
+                for name, before, after, ratio, regression in compare_results(json.load(baseline), suite):
+                    print "%-45s %9.3f -> %9.3f ms (%.2fx)%s" % (name, before, after, ratio,
+                                                                 ' REGRESSION' if regression else '')
@@ -0,0 +1,101 @@
+#!/user/bin/env python2.7
+
+import logging
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from accounting import db
+from cache import invalidate_policies
+from ledger import record_missing_events
+from models import BillingPlan, Invoice, Policy
+from utils import advance_plan, rebuild_policy_balances, store_plans
+
+"""
+#######################################################
+Daily billing run of the lazily billed policies
+#######################################################
+
+A policy billed lazily keeps the rest of its schedule as a single billing_plans row instead of a year of
+future invoices, so the balance queries don't scan invoices that aren't billed yet. The billing run finds the
+plans whose next bill date arrived with the index on that date and issues their invoices in chunks of
+policies, one insert, one plan rewrite and one policy balances rebuild per chunk. A run that was skipped is
+caught up by the next one.
+
+The installments get their invoices and their policy balances ledger rows once they are issued. Until then the
+balances, the cancellations and the aging add the installments of the plans billed until their date, so they
+don't depend on the billing run.
+"""
+
+log = logging.getLogger('accounting.billing')
+
+
+def due_policy_ids(date_cursor):
+    """Return the identifiers of the active policies with an installment billed until a date and not issued."""
+    return [row.policy_id for row in db.session.query(BillingPlan.policy_id)
+                                               .join(Policy, Policy.id == BillingPlan.policy_id)
+                                               .filter(Policy.status != "Canceled")
+                                               .filter(BillingPlan.next_bill_date <= date_cursor)
+                                               .order_by(BillingPlan.policy_id)]
+
+
+def run_billing(date_cursor=None, policy_ids=None, chunk_size=500):
+    """Issue every invoice of the billing plans billed until a date.
+
+    :param date_cursor: Date of the run, today if omitted.
+    :type  date_cursor: datetime.date
+    :param policy_ids: Identifiers of the policies to bill, every due policy if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies billed and committed together. (default = 500)
+    :type  chunk_size: int
+    :returns: dict -- Number of policies billed and invoices issued.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if policy_ids is None:
+        policy_ids = due_policy_ids(date_cursor)
+
+    stats = {'policies': 0, 'invoices': 0}
+    for start in range(0, len(policy_ids), chunk_size):
+        plans = []
+        for plan in db.session.query(*BillingPlan.__table__.columns)\
+                              .join(Policy, Policy.id == BillingPlan.policy_id)\
+                              .filter(BillingPlan.policy_id.in_(policy_ids[start:start + chunk_size]))\
+                              .filter(Policy.status != "Canceled")\
+                              .filter(BillingPlan.next_bill_date <= date_cursor):
+            plans.append(dict(zip(plan.keys(), plan)))
+        if not plans:
+            continue
+
+        rows = [row for plan in plans for row in advance_plan(plan, date_cursor)]
+        billed = [plan['policy_id'] for plan in plans]
+        try:
+            store_plans(billed, plans, chunk_size)
+            db.session.execute(Invoice.__table__.insert(), rows)
+            rebuild_policy_balances(billed, chunk_size, commit=False,
+                                    since=min(row['bill_date'] for row in rows) - relativedelta(days=1))
+            record_missing_events(billed, chunk_size)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        invalidate_policies(billed)
+        stats['policies'] += len(billed)
+        stats['invoices'] += len(rows)
+        log.info("Issued %d invoices of %d policies", stats['invoices'], stats['policies'])
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Issue the invoices of the billing plans billed until a date.")
+    parser.add_argument('--date', help="Date of the run, %%Y-%%m-%%d, today if omitted")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Policies billed per transaction")
+    args = parser.parse_args()
+    configure_logging()
+
+    run_date = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+    stats = run_billing(run_date, chunk_size=args.chunk_size)
+    print "Issued %(invoices)d invoices of %(policies)d policies" % stats
@@ -0,0 +1,160 @@
+#!/user/bin/env python2.7
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from timeit import default_timer
+
+from accounting import app
+
+"""
+#######################################################
+Cache of the data served for a policy
+#######################################################
+
+The caches live in the memory of every process. The writes of the process are invalidated once committed, but
+the writes of another process, e.g. a second server or the billing, archive, ledger and import commands, can't
+reach them, those are only seen once the entries expire after CACHE_TTL seconds.
+"""
+
+class LRUCache(object):
+    """
+     Bounded cache whose keys are (policy_id, as_of_date) tuples, the least recently used entry is evicted
+     when it is full. It is shared by the threads that serve the requests. An entry that depends on several
+     policies is stored with all of them and dropped when any of them is invalidated.
+
+     :param max_size: Maximum number of entries kept.
+     :type  max_size: int
+     :param ttl: Seconds an entry is served after it was stored, forever if None. (default = None)
+     :type  ttl: float
+     :ivar  hits:      Number of lookups that found their entry.
+     :vartype hits:    int
+     :ivar  misses:    Number of lookups that didn't find their entry.
+     :vartype misses:  int
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Keys stored for each policy so they can be invalidated without scanning the whole cache
+        self._policy_keys = {}
+        # Policies of every key, when they are not just the first element of the key
+        self._key_policies = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored for a key or None if it expired, the entry becomes the most recently used."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and default_timer() - entry[1] > self.ttl:
+                self._forget(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, policy_ids=None):
+        """Store a value, policy_ids are the policies it depends on, only key[0] if omitted."""
+        with self._lock:
+            if key in self._entries:
+                self._forget(key)
+            self._entries.pop(key, None)
+            self._entries[key] = (value, default_timer())
+            if policy_ids is not None:
+                self._key_policies[key] = policy_ids = tuple(policy_ids)
+            for policy_id in policy_ids if policy_ids is not None else (key[0],):
+                self._policy_keys.setdefault(policy_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def update(self, policy_id, function):
+        """Replace every entry of a policy by function(key, value), the entry is dropped if it returns None.
+
+        The entries keep their position and the time they were stored.
+        """
+        with self._lock:
+            for key in list(self._policy_keys.get(policy_id, ())):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                value = function(key, entry[0])
+                if value is None:
+                    del self._entries[key]
+                    self._forget(key)
+                else:
+                    self._entries[key] = (value, entry[1])
+
+    def invalidate(self, policy_ids):
+        """Drop every entry of the policies provided, whatever their date."""
+        with self._lock:
+            for policy_id in policy_ids:
+                for key in self._policy_keys.pop(policy_id, ()):
+                    if self._entries.pop(key, None) is not None:
+                        self._forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._policy_keys.clear()
+            self._key_policies.clear()
+
+    def _forget(self, key):
+        for policy_id in self._key_policies.pop(key, (key[0],)):
+            keys = self._policy_keys.get(policy_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._policy_keys[policy_id]
+
+
+# Responses of /consult_policy, they are invalidated every time the data of their policy changes.
+policy_cache = LRUCache(app.config['POLICY_CACHE_SIZE'], app.config['CACHE_TTL'])
+
+# Summaries of the policies of an agent or insured, keyed by (role, contact_id, as_of_date). Every value is the
+# summary and the identifiers of the policies it counts as pending cancellation.
+summary_cache = LRUCache(app.config['SUMMARY_CACHE_SIZE'], app.config['CACHE_TTL'])
+
+
+def invalidate_policies(policy_ids):
+    """Drop every cached entry that depends on the policies provided, once their changes are committed."""
+    policy_cache.invalidate(policy_ids)
+    summary_cache.invalidate(policy_ids)
+
+
+def apply_payments(payments):
+    """Bring the cached entries up to date with some payments once they are committed.
+
+    The consultations of their policies are dropped. A payment lowers the balance of the summaries dated since
+    its date and can only take its policy out of their pending cancellations, so the summaries that counted it
+    as pending are dropped and the rest are updated in place instead of being calculated again.
+
+    :param payments: (policy_id, transaction_date, amount_paid) tuples.
+    :type  payments: list
+    """
+    policy_cache.invalidate(set(policy_id for policy_id, transaction_date, amount in payments))
+    for policy_id, transaction_date, amount in payments:
+        if isinstance(transaction_date, datetime):
+            transaction_date = transaction_date.date()
+
+        def apply_payment(key, value, policy_id=policy_id, transaction_date=transaction_date, amount=amount):
+            summary, pending = value
+            if key[2] < transaction_date:
+                return value
+            if policy_id in pending:
+                return None
+            return dict(summary, balance=summary['balance'] - amount), pending
+        summary_cache.update(policy_id, apply_payment)
+
+
+def invalidate_contact(role, contact_id):
+    """Drop the summaries of a contact, e.g. when a policy is assigned to it."""
+    summary_cache.invalidate([(role, contact_id)])
@@ -0,0 +1,111 @@
+#!/user/bin/env python2.7
+
+import threading
+from weakref import WeakSet
+
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import NullPool, QueuePool
+
+"""
+#######################################################
+Engine and connection pool configuration
+#######################################################
+
+The database is any SQLAlchemy URL set in SQLALCHEMY_DATABASE_URI, so the application can be pointed to a
+database server where readers and writers don't block each other. SQLite is tuned on every new connection:
+write ahead log so readers aren't blocked by the writer, synchronous=NORMAL, memory mapped reads and a busy
+timeout so concurrent writers wait for the lock instead of failing.
+
+The session is scoped to the application context by Flask-SQLAlchemy and removed when the context is torn
+down, which returns its connection to the pool after every request. Background threads must remove the
+session themselves when they are done with it.
+"""
+
+class AccountingSQLAlchemy(SQLAlchemy):
+    """
+     Flask-SQLAlchemy with the pool and SQLite settings of the application config.
+    """
+    def __init__(self, *args, **kwargs):
+        self._configured_engines = WeakSet()
+        self._configure_lock = threading.Lock()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('SQLITE_JOURNAL_MODE', None)
+        app.config.setdefault('SQLITE_SYNCHRONOUS', None)
+        app.config.setdefault('SQLITE_MMAP_SIZE', None)
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT', None)
+        SQLAlchemy.init_app(self, app)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername.startswith('sqlite'):
+            connect_args = options.setdefault('connect_args', {})
+            if app.config['SQLITE_BUSY_TIMEOUT'] is not None:
+                connect_args['timeout'] = app.config['SQLITE_BUSY_TIMEOUT']
+            if options.get('pool_size') and info.database not in (None, '', ':memory:'):
+                # SQLite files use no pool by default, reusing connections saves opening the file and setting
+                # the pragmas again. The pool hands a connection to a single thread at a time.
+                options['poolclass'] = QueuePool
+                connect_args['check_same_thread'] = False
+        if options.get('poolclass') is not NullPool and app.config['SQLALCHEMY_MAX_OVERFLOW'] is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        with self._configure_lock:
+            if engine not in self._configured_engines:
+                configure_engine(engine, app.config)
+                self._configured_engines.add(engine)
+        return engine
+
+    def fetch(self, statement, chunk_size):
+        """Yield the rows of a Core select, fetching chunk_size rows at a time."""
+        result = self.session.execute(statement)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        result.close()
+
+
+def configure_engine(engine, config):
+    """Register the connection listeners of an engine before it opens its first connection.
+
+    :param engine: Engine to configure.
+    :type  engine: sqlalchemy.engine.Engine
+    :param config: Application config with the SQLITE_* and SQLALCHEMY_POOL_PRE_PING settings.
+    :type  config: dict
+    """
+    if engine.dialect.name == 'sqlite':
+        pragmas = [('journal_mode', config.get('SQLITE_JOURNAL_MODE')),
+                   ('synchronous', config.get('SQLITE_SYNCHRONOUS')),
+                   ('mmap_size', config.get('SQLITE_MMAP_SIZE'))]
+        pragmas = [(name, value) for name, value in pragmas if value is not None]
+        if pragmas:
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas:
+                    cursor.execute("PRAGMA %s = %s" % (name, value))
+                cursor.close()
+            event.listen(engine, 'connect', set_pragmas)
+
+    if config.get('SQLALCHEMY_POOL_PRE_PING'):
+        event.listen(engine, 'checkout', ping_connection)
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check that a connection is still alive before handing it out, the pool replaces it otherwise."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
@@ -0,0 +1,264 @@
+#!/user/bin/env python2.7
+
+import bz2
+import csv
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime
+
+from sqlalchemy import Boolean, literal, select, union_all
+
+from accounting import db
+from models import AccountingEvent, ArchivedInvoice, ArchivedPayment, Invoice, Payment, Policy
+
+"""
+#######################################################
+Streaming export of the tables for the data warehouse
+#######################################################
+
+The rows are read in chunks ordered by primary key, each chunk with a query that seeks past the last
+identifier of the previous one, so no cursor stays open between chunks and the memory used only depends on
+the chunk size, on SQLite as well as on a server. Every chunk is written as soon as it is read, as CSV, JSON
+lines or column chunks (one JSON line per chunk with the values of every column together, the layout of a
+Parquet row group), optionally compressed with gzip or bz2.
+
+The invoices and payments moved to the archive keep their identifiers, they are exported with the live ones
+in identifier order and an extra archived column.
+
+An incremental export only reads the rows after the identifier of the last row exported before, stored in a
+state file, and optionally the ones since a date. The rows updated in place since the previous export, e.g.
+the invoices marked as deleted or the status and cancel date of the policies, are not exported again, nor
+are the rows archived since. The accounting events are never updated, so they are always part of an
+incremental export and carry the invoices voided or issued by a new billing schedule and the policies
+canceled since the last one. Any other change of a policy, like its billing schedule or premium, is only seen
+by a full export.
+"""
+
+log = logging.getLogger('accounting.export')
+
+# Table, date column and archive table of every export, the date column is compared with the date watermark
+EXPORTS = {'policies': (Policy.__table__, 'effective_date', None),
+           'invoices': (Invoice.__table__, 'bill_date', ArchivedInvoice.__table__),
+           'payments': (Payment.__table__, 'transaction_date', ArchivedPayment.__table__),
+           'events': (AccountingEvent.__table__, 'effective_date', None)}
+DEFAULT_TABLES = ('policies', 'invoices', 'payments')
+
+# Function that opens a file for writing and extension of every compression
+COMPRESSIONS = {None: (open, ''),
+                'gzip': (gzip.open, '.gz'),
+                'bz2': (bz2.BZ2File, '.bz2')}
+
+
+def chunk_statement(table, columns, date_column, last_id, since_date, chunk_size):
+    """Return the statement of the next chunk of rows of a table after an identifier."""
+    statement = select(columns).order_by(table.c.id).limit(chunk_size)
+    if last_id is not None:
+        statement = statement.where(table.c.id > last_id)
+    if since_date is not None:
+        statement = statement.where(table.c[date_column] >= since_date)
+    return statement
+
+
+def export_chunks(table, date_column=None, since_id=None, since_date=None, chunk_size=1000, archive_table=None):
+    """Yield the rows of a table in chunks ordered by identifier, reading one chunk per query.
+
+    :param table: Table to read, its primary key must be an integer id column.
+    :type  table: sqlalchemy.Table
+    :param date_column: Name of the column compared with since_date. (default = None)
+    :type  date_column: str
+    :param since_id: Only the rows with a greater identifier are read. (default = None)
+    :type  since_id: int
+    :param since_date: Only the rows whose date column is this date or later are read. (default = None)
+    :type  since_date: datetime.date
+    :param chunk_size: Rows read per query. (default = 1000)
+    :type  chunk_size: int
+    :param archive_table: Archive of the table, its rows are merged with the live ones and every row gets an
+                          archived column last. (default = None)
+    :type  archive_table: sqlalchemy.Table
+    :returns: generator -- Lists of at most chunk_size rows.
+    """
+    last_id = since_id
+    while True:
+        if archive_table is None:
+            statement = chunk_statement(table, table.columns, date_column, last_id, since_date, chunk_size)
+        else:
+            # Both tables are read by primary key up to a chunk each, then merged
+            live = chunk_statement(table, list(table.columns) + [literal(False, Boolean).label('archived')],
+                                   date_column, last_id, since_date, chunk_size).alias()
+            archived = chunk_statement(archive_table,
+                                       [archive_table.c[column.name] for column in table.columns] +
+                                       [literal(True, Boolean).label('archived')],
+                                       date_column, last_id, since_date, chunk_size).alias()
+            merged = union_all(select([live]), select([archived])).alias()
+            statement = select([merged]).order_by(merged.c.id).limit(chunk_size)
+        rows = db.session.execute(statement).fetchall()
+        if not rows:
+            break
+        yield rows
+        if len(rows) < chunk_size:
+            break
+        last_id = rows[len(rows) - 1]['id']
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(stream, columns, chunks):
+    writer = csv.writer(stream)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([[csv_value(value) for value in row] for row in rows])
+
+
+def write_jsonl(stream, columns, chunks):
+    for rows in chunks:
+        stream.write(''.join(json.dumps(dict(zip(columns, [json_value(value) for value in row]))) + '\n'
+                             for row in rows))
+
+
+def write_columns(stream, columns, chunks):
+    for rows in chunks:
+        values = [[json_value(row[index]) for row in rows] for index in range(len(columns))]
+        stream.write(json.dumps({'rows': len(rows), 'columns': columns, 'values': values}) + '\n')
+
+
+# Writer and file extension of every format
+FORMATS = {'csv': (write_csv, 'csv'),
+           'jsonl': (write_jsonl, 'jsonl'),
+           'columns': (write_columns, 'columns.jsonl')}
+
+
+def export_table(name, stream, file_format='csv', since_id=None, since_date=None, chunk_size=1000):
+    """Write the rows of a table to a stream, one chunk at a time.
+
+    :param name: One of the keys of EXPORTS.
+    :type  name: str
+    :param stream: File like object the export is written to.
+    :param file_format: One of the keys of FORMATS. (default = 'csv')
+    :type  file_format: str
+    :returns: dict -- Number of rows written and identifier of the last one, the watermark of the next
+                      incremental export.
+    :raises: ValueError if the table or the format are unknown.
+    """
+    if name not in EXPORTS:
+        raise ValueError("Unknown table %s" % name)
+    if file_format not in FORMATS:
+        raise ValueError("Unknown file format %s" % file_format)
+    table, date_column, archive_table = EXPORTS[name]
+    columns = [column.name for column in table.columns]
+    if archive_table is not None:
+        columns.append('archived')
+
+    stats = {'rows': 0, 'last_id': since_id}
+
+    def chunks():
+        for rows in export_chunks(table, date_column, since_id, since_date, chunk_size, archive_table):
+            stats['rows'] += len(rows)
+            stats['last_id'] = rows[len(rows) - 1]['id']
+            yield rows
+
+    FORMATS[file_format][0](stream, columns, chunks())
+    return stats
+
+
+def load_state(path):
+    """Return the watermarks of the previous export stored in a state file, empty if it doesn't exist."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(path, state):
+    """Replace the state file at once, a failed export keeps the previous watermarks."""
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(path + '.tmp', path)
+
+
+def run_export(output_dir, file_format='csv', compression=None, tables=DEFAULT_TABLES, state_path=None,
+               since_date=None, chunk_size=1000):
+    """Export some tables to one file each, incrementally if a state file is given.
+
+    :param output_dir: Directory of the files, named after the tables, e.g. invoices.csv.gz.
+    :type  output_dir: str
+    :param compression: None, 'gzip' or 'bz2'. (default = None)
+    :type  compression: str
+    :param tables: Names of the tables. (default = DEFAULT_TABLES)
+    :type  tables: list
+    :param state_path: File with the identifier of the last row exported of every table, only the rows after
+                       it are exported and it is updated once every table was written, the events are always
+                       exported with it. (default = None)
+    :type  state_path: str
+    :param since_date: Only the rows whose date is this date or later are exported. (default = None)
+    :type  since_date: datetime.date
+    :returns: dict -- The statistics of export_table and the path of the file, indexed by table name.
+    :raises: ValueError if a table, the format or the compression are unknown.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression %s" % compression)
+    if file_format not in FORMATS:
+        raise ValueError("Unknown file format %s" % file_format)
+    opener, compression_extension = COMPRESSIONS[compression]
+    state = load_state(state_path)
+    if state_path and 'events' not in tables:
+        # The updates of the rows already exported only reach an incremental export through the events
+        tables = list(tables) + ['events']
+
+    results = {}
+    for name in tables:
+        path = os.path.join(output_dir, '%s.%s%s' % (name, FORMATS[file_format][1], compression_extension))
+        stream = opener(path, 'wb')
+        try:
+            results[name] = export_table(name, stream, file_format, state.get(name), since_date, chunk_size)
+        finally:
+            stream.close()
+        results[name]['path'] = path
+        log.info("Exported %d rows of %s", results[name]['rows'], name)
+
+    if state_path:
+        for name, stats in results.items():
+            if stats['last_id'] is not None:
+                state[name] = stats['last_id']
+        save_state(state_path, state)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Export the policies, invoices and payments.")
+    parser.add_argument('output_dir', help="Directory of the exported files")
+    parser.add_argument('--format', default='csv', choices=sorted(FORMATS), help="File format")
+    parser.add_argument('--compress', choices=['gzip', 'bz2'], help="Compress the files")
+    parser.add_argument('--tables', nargs='+', default=list(DEFAULT_TABLES), choices=sorted(EXPORTS),
+                        help="Tables to export")
+    parser.add_argument('--state', help="State file of the incremental exports")
+    parser.add_argument('--since', help="Only the rows since this date, %%Y-%%m-%%d")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="Rows read per query")
+    args = parser.parse_args()
+    configure_logging()
+
+    since = datetime.strptime(args.since, "%Y-%m-%d").date() if args.since else None
+    results = run_export(args.output_dir, args.format, args.compress, args.tables, args.state, since,
+                         args.chunk_size)
+    for name in sorted(results):
+        print "%-10s %10d rows  %s" % (name, results[name]['rows'], results[name]['path'])
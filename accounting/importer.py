@@ -0,0 +1,227 @@
+#!/user/bin/env python2.7
+
+import csv
+import json
+import logging
+from datetime import datetime
+from timeit import default_timer
+
+from accounting import db
+from cache import invalidate_contact, invalidate_policies
+from ledger import record_missing_events
+from models import Contact, Payment, Policy
+from utils import BILLING_SCHEDULES, make_invoices_for_policies, rebuild_policy_balances
+
+"""
+#######################################################
+Bulk import of policies, contacts and payments
+#######################################################
+
+Every record of the file is either a policy or a payment, identified by its record_type field:
+
+  - policy:  policy_number, effective_date, billing_schedule (Annual if omitted), annual_premium, named_insured,
+             agent
+  - payment: policy_number, transaction_date, amount, contact (optional) and contact_role (optional)
+
+Contacts are referenced by name and created the first time they are found. A payment without contact is
+registered to the named insured of the policy. The policy of a payment must appear earlier in the file or
+already exist in the database, if several policies share the number the latest one is used.
+
+Dates use the "%Y-%m-%d" format, the same one used by the views.
+"""
+
+log = logging.getLogger('accounting.importer')
+
+
+def read_csv(stream):
+    """Yield (line_number, record) for every row of a CSV file with a header row, empty fields are dropped."""
+    # The header is the first line of the file
+    for line_number, row in enumerate(csv.DictReader(stream), 2):
+        yield line_number, dict((key, value) for key, value in row.items() if value != '')
+
+
+def read_json_lines(stream):
+    """Yield (line_number, record) for every non empty line of a JSON-lines file."""
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                raise ValueError("Line %d is not valid JSON" % line_number)
+
+
+READERS = {'csv': read_csv, 'jsonl': read_json_lines}
+
+
+def format_from_filename(filename):
+    """Guess the format of a file from its extension, CSV is assumed if it can't be guessed."""
+    if filename and filename.lower().rsplit('.', 1)[-1] in ('jsonl', 'json', 'ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+class PolicyImporter(object):
+    """
+     Loads records into the database in chunks, each chunk is stored in a single transaction.
+
+     :param chunk_size: Number of records stored per transaction.
+     :type  chunk_size: int
+     :ivar  contacts:  Identifier of every known contact indexed by (name, role).
+     :vartype contacts: dict
+     :ivar  stats:     Number of rows created of each kind.
+     :vartype stats:   dict
+    """
+    def __init__(self, chunk_size=500):
+        self.chunk_size = chunk_size
+        self.contacts = dict(((contact.name, contact.role), contact.id)
+                             for contact in db.session.query(Contact.id, Contact.name, Contact.role))
+        self.stats = {'records': 0, 'policies': 0, 'payments': 0, 'contacts': 0}
+
+    def contact_id(self, name, role):
+        """Return the identifier of a contact, it is inserted if it doesn't exist yet."""
+        key = (name, role)
+        if key not in self.contacts:
+            result = db.session.execute(Contact.__table__.insert(), {'name': name, 'role': role})
+            self.contacts[key] = result.inserted_primary_key[0]
+            self.stats['contacts'] += 1
+        return self.contacts[key]
+
+    def import_records(self, records):
+        """Store an iterable of (line_number, record), only one chunk is kept in memory at a time.
+
+        :returns: dict -- Rows created of each kind, elapsed seconds and throughput in records per second.
+        """
+        start = default_timer()
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == self.chunk_size:
+                self.load_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.load_chunk(chunk)
+
+        elapsed = default_timer() - start
+        self.stats['seconds'] = elapsed
+        self.stats['rows_per_second'] = self.stats['records'] / elapsed if elapsed else 0.0
+        return self.stats
+
+    def load_chunk(self, chunk):
+        policies = []
+        payments = []
+        try:
+            for line_number, record in chunk:
+                record_type = record.get('record_type', 'policy')
+                if record_type == 'policy':
+                    policies.append(self.build_policy(line_number, record))
+                elif record_type == 'payment':
+                    payments.append((line_number, record))
+                else:
+                    raise ValueError("Line %d: unknown record type %s" % (line_number, record_type))
+
+            # The policies need their identifiers before the invoices and payments can reference them.
+            db.session.flush()
+            make_invoices_for_policies(policies, commit=False)
+            policy_ids = set(policy.id for policy in policies) | self.store_payments(payments, policies)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        invalidate_policies(policy_ids)
+        for policy in policies:
+            invalidate_contact('Agent', policy.agent)
+            invalidate_contact('Named Insured', policy.named_insured)
+        # Nothing of this chunk is needed anymore, don't let the session keep it.
+        db.session.expunge_all()
+
+        self.stats['records'] += len(chunk)
+        self.stats['policies'] += len(policies)
+        self.stats['payments'] += len(payments)
+        log.info("Imported %d records", self.stats['records'])
+
+    def build_policy(self, line_number, record):
+        try:
+            policy = Policy(record['policy_number'],
+                            datetime.strptime(record['effective_date'], "%Y-%m-%d").date(),
+                            int(record['annual_premium']))
+            policy.billing_schedule = record.get('billing_schedule', 'Annual')
+            policy.named_insured = self.contact_id(record['named_insured'], 'Named Insured')
+            policy.agent = self.contact_id(record['agent'], 'Agent')
+        except (KeyError, ValueError, TypeError):
+            raise ValueError("Line %d: invalid policy record" % line_number)
+        if policy.billing_schedule not in BILLING_SCHEDULES:
+            raise ValueError("Line %d: unknown billing schedule %s" % (line_number, policy.billing_schedule))
+        db.session.add(policy)
+        return policy
+
+    def store_payments(self, payments, policies):
+        """Insert the payments of a chunk and return the identifiers of their policies."""
+        if not payments:
+            return set()
+
+        # Policies of previous chunks are looked up with a single query, the latest one wins.
+        known = dict((policy.policy_number, (policy.id, policy.named_insured)) for policy in policies)
+        missing = set(record.get('policy_number') for line_number, record in payments) - set(known)
+        if missing:
+            for policy in db.session.query(Policy.id, Policy.policy_number, Policy.named_insured)\
+                                    .filter(Policy.policy_number.in_(missing))\
+                                    .order_by(Policy.id):
+                known[policy.policy_number] = (policy.id, policy.named_insured)
+
+        rows = []
+        for line_number, record in payments:
+            try:
+                policy_id, named_insured = known[record['policy_number']]
+                if record.get('contact'):
+                    contact_id = self.contact_id(record['contact'], record.get('contact_role', 'Named Insured'))
+                else:
+                    contact_id = named_insured
+                rows.append({'policy_id': policy_id,
+                             'contact_id': contact_id,
+                             'amount_paid': int(record['amount']),
+                             'transaction_date': datetime.strptime(record['transaction_date'],
+                                                                   "%Y-%m-%d").date()})
+            except (KeyError, ValueError, TypeError):
+                raise ValueError("Line %d: invalid payment record" % line_number)
+            if contact_id is None:
+                raise ValueError("Line %d: missing contact for this payment" % line_number)
+
+        db.session.execute(Payment.__table__.insert(), rows)
+        policy_ids = set(row['policy_id'] for row in rows)
+        rebuild_policy_balances(list(policy_ids), commit=False)
+        record_missing_events(list(policy_ids))
+        return policy_ids
+
+
+def import_policies_file(stream, file_format='csv', chunk_size=500):
+    """Import a CSV or JSON-lines stream of policies and payments.
+
+    The chunks already stored are kept if a later record is invalid.
+
+    :param stream: File like object with the records.
+    :param file_format: Either 'csv' or 'jsonl'. (default = 'csv')
+    :type  file_format: str
+    :param chunk_size: Number of records stored per transaction. (default = 500)
+    :type  chunk_size: int
+    :returns: dict -- Rows created of each kind, elapsed seconds and throughput in records per second.
+    """
+    if file_format not in READERS:
+        raise ValueError("Unknown file format %s" % file_format)
+    return PolicyImporter(chunk_size).import_records(READERS[file_format](stream))
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Bulk import policies, contacts and payments.")
+    parser.add_argument('path', help="CSV or JSON-lines file")
+    parser.add_argument('--format', choices=sorted(READERS), help="Guessed from the extension if omitted")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Records stored per transaction")
+    args = parser.parse_args()
+    configure_logging()
+
+    with open(args.path, 'rb') as stream:
+        stats = import_policies_file(stream, args.format or format_from_filename(args.path), args.chunk_size)
+    print "Imported %(policies)d policies, %(payments)d payments and %(contacts)d new contacts" % stats
+    print "%.1f records per second" % stats['rows_per_second']
@@ -0,0 +1,161 @@
+#!/user/bin/env python2.7
+
+import threading
+from functools import wraps
+from timeit import default_timer
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from accounting import app
+
+"""
+#######################################################
+Query count and latency instrumentation
+#######################################################
+
+Every SQL statement executed by any engine is counted and timed through the SQLAlchemy cursor events, the
+totals are attributed to the Flask request being served by the same thread. The PolicyAccounting methods
+decorated with timed are timed as well.
+
+The aggregated numbers are served by /metrics, besides that every finished request is passed to the sinks
+registered with add_sink, e.g. to send them to a monitoring system.
+"""
+
+class Metrics(object):
+    """
+     Aggregated counters of the requests, queries and timed methods of this process.
+
+     :ivar  sinks: Callables that receive a dict with the numbers of every finished request.
+     :vartype sinks: list
+    """
+    def __init__(self):
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._queries = {'count': 0, 'ms': 0.0}
+            self._requests = {}
+            self._methods = {}
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def query_started(self):
+        self._local.query_start = default_timer()
+
+    def query_finished(self):
+        start = getattr(self._local, 'query_start', None)
+        if start is None:
+            return
+        self._local.query_start = None
+        elapsed = (default_timer() - start) * 1000.0
+        with self._lock:
+            self._queries['count'] += 1
+            self._queries['ms'] += elapsed
+        current = getattr(self._local, 'request', None)
+        if current is not None:
+            current['queries'] += 1
+            current['db_ms'] += elapsed
+
+    def request_started(self):
+        self._local.request = {'queries': 0, 'db_ms': 0.0, 'start': default_timer()}
+
+    def request_finished(self, endpoint, status_code):
+        """Aggregate the numbers of the request served by this thread and pass them to the sinks.
+
+        :returns: dict -- Endpoint, status code, elapsed ms, number of queries and their ms, None if no request
+                          was started in this thread.
+        """
+        current = getattr(self._local, 'request', None)
+        if current is None:
+            return
+        self._local.request = None
+        record = {'endpoint': endpoint,
+                  'status_code': status_code,
+                  'ms': (default_timer() - current['start']) * 1000.0,
+                  'queries': current['queries'],
+                  'db_ms': current['db_ms']}
+        with self._lock:
+            totals = self._requests.setdefault(endpoint, {'count': 0, 'ms': 0.0, 'max_ms': 0.0,
+                                                          'queries': 0, 'db_ms': 0.0})
+            totals['count'] += 1
+            totals['ms'] += record['ms']
+            totals['max_ms'] = max(totals['max_ms'], record['ms'])
+            totals['queries'] += record['queries']
+            totals['db_ms'] += record['db_ms']
+        for sink in self.sinks:
+            sink(record)
+        return record
+
+    def method_finished(self, name, elapsed):
+        with self._lock:
+            totals = self._methods.setdefault(name, {'count': 0, 'ms': 0.0, 'max_ms': 0.0})
+            totals['count'] += 1
+            totals['ms'] += elapsed
+            totals['max_ms'] = max(totals['max_ms'], elapsed)
+
+    def snapshot(self):
+        """Return a copy of the counters with the mean time of every endpoint and method added."""
+        with self._lock:
+            queries = dict(self._queries)
+            requests = dict((name, dict(totals)) for name, totals in self._requests.items())
+            methods = dict((name, dict(totals)) for name, totals in self._methods.items())
+        for totals in requests.values() + methods.values():
+            totals['mean_ms'] = totals['ms'] / totals['count']
+        for totals in requests.values():
+            totals['queries_per_request'] = float(totals['queries']) / totals['count']
+        return {'queries': queries, 'requests': requests, 'methods': methods}
+
+
+metrics = Metrics()
+
+
+def timed(function):
+    """Record the time spent in every call of a method under the name Class.method, if METRICS_ENABLED."""
+    name = []
+
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if not app.config['METRICS_ENABLED']:
+            return function(self, *args, **kwargs)
+        if not name:
+            name.append('%s.%s' % (type(self).__name__, function.__name__))
+        start = default_timer()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            metrics.method_finished(name[0], (default_timer() - start) * 1000.0)
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.query_started()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.query_finished()
+
+
+def _before_request():
+    metrics.request_started()
+
+
+def _after_request(response):
+    # Streamed responses are measured until their headers are sent
+    metrics.request_finished(request.endpoint, response.status_code)
+    return response
+
+
+if app.config['METRICS_ENABLED']:
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
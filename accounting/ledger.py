@@ -0,0 +1,308 @@
+#!/user/bin/env python2.7
+
+import logging
+from datetime import date, datetime
+
+from sqlalchemy import and_, func, or_
+
+from accounting import db
+from models import (AccountingEvent, ArchivedInvoice, ArchivedPayment, Invoice, LedgerSnapshot, Payment, Policy,
+                    PolicyBalance)
+
+"""
+#######################################################
+Append only ledger of accounting events
+#######################################################
+
+Every invoice issued or voided, payment received and cancellation of a policy is appended to the
+accounting_events table, nothing there is ever updated or deleted. The effective date of an event is the date
+it counts for the balance: the bill date of an invoice, also when it is voided, and the transaction date of a
+payment, so replaying the events until a date gives the same balance as the policy balances ledger.
+
+The totals of every policy are stored periodically in ledger_snapshots, a balance is then the nearest snapshot
+until its date plus the few events after it. A snapshot remembers the last event that existed when it was
+taken, the events recorded later with an earlier effective date are replayed too.
+"""
+
+log = logging.getLogger('accounting.ledger')
+
+# How every type of event changes the (billed, paid) totals of its policy, per unit of its amount
+EVENT_EFFECTS = {'InvoiceIssued': (1, 0),
+                 'InvoiceVoided': (-1, 0),
+                 'PaymentReceived': (0, 1),
+                 'PolicyCanceled': (0, 0)}
+
+
+def event_row(policy_id, event_type, effective_date, amount=0, reference_id=None, details=None, recorded_at=None):
+    if isinstance(effective_date, datetime):
+        effective_date = effective_date.date()
+    return {'policy_id': policy_id,
+            'event_type': event_type,
+            'effective_date': effective_date,
+            'amount': amount,
+            'reference_id': reference_id,
+            'details': details,
+            'recorded_at': recorded_at or datetime.now()}
+
+
+def record_event(policy_id, event_type, effective_date, amount=0, reference_id=None, details=None):
+    """Append an event to the ledger without committing it.
+
+    :param policy_id: The identifier of the policy.
+    :type  policy_id: int
+    :param event_type: One of the keys of EVENT_EFFECTS.
+    :type  event_type: str
+    :param effective_date: Date in which the event counts for the balance of the policy.
+    :type  effective_date: datetime.date
+    :param amount: Amount invoiced, voided or paid, always positive. (default = 0)
+    :type  amount: int
+    :param reference_id: Identifier of the invoice or payment of the event. (default = None)
+    :type  reference_id: int
+    :param details: Free text, the reason of a cancellation for instance. (default = None)
+    :type  details: str
+    """
+    db.session.execute(AccountingEvent.__table__.insert(),
+                       event_row(policy_id, event_type, effective_date, amount, reference_id, details))
+
+
+def record_cancellations(policy_ids, date_cursor, reason):
+    """Append the PolicyCanceled events of several policies with a single insert, without committing them."""
+    if not policy_ids:
+        return
+    recorded_at = datetime.now()
+    rows = [event_row(policy_id, 'PolicyCanceled', date_cursor, details=reason, recorded_at=recorded_at)
+            for policy_id in policy_ids]
+    db.session.execute(AccountingEvent.__table__.insert(), rows)
+
+
+def record_missing_events(policy_ids=None, chunk_size=500):
+    """Append the events of the invoices, payments and cancellations of some policies that are not recorded.
+
+    The bulk writers store their rows with a single insert that doesn't return the identifiers, so their
+    events are recorded afterwards by comparing the rows of the policies with their events. The same is done
+    for every policy to fill the ledger of an existing database. Nothing is committed.
+
+    An event is matched by the identifier of its invoice or payment, live or archived, which is never reused
+    since the invoices and payments tables are created with AUTOINCREMENT (see upgrade_db).
+
+    :param policy_ids: Identifiers of the policies, every policy if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies compared per query. (default = 500)
+    :type  chunk_size: int
+    :returns: int -- Number of events appended.
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+
+    appended = 0
+    recorded_at = datetime.now()
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        recorded = set(db.session.query(AccountingEvent.policy_id, AccountingEvent.event_type,
+                                        AccountingEvent.reference_id)
+                                 .filter(AccountingEvent.policy_id.in_(chunk)))
+
+        rows = []
+        for model in (Invoice, ArchivedInvoice):
+            for invoice in db.session.query(model.id, model.policy_id, model.bill_date, model.amount_due,
+                                            model.deleted)\
+                                     .filter(model.policy_id.in_(chunk))\
+                                     .order_by(model.id):
+                for event_type, missing in (('InvoiceIssued', True), ('InvoiceVoided', invoice.deleted)):
+                    if missing and (invoice.policy_id, event_type, invoice.id) not in recorded:
+                        rows.append(event_row(invoice.policy_id, event_type, invoice.bill_date, invoice.amount_due,
+                                              invoice.id, recorded_at=recorded_at))
+        for model in (Payment, ArchivedPayment):
+            for payment in db.session.query(model.id, model.policy_id, model.transaction_date, model.amount_paid)\
+                                     .filter(model.policy_id.in_(chunk))\
+                                     .order_by(model.id):
+                if (payment.policy_id, 'PaymentReceived', payment.id) not in recorded:
+                    rows.append(event_row(payment.policy_id, 'PaymentReceived', payment.transaction_date,
+                                          payment.amount_paid, payment.id, recorded_at=recorded_at))
+        for policy in db.session.query(Policy.id, Policy.cancel_date, Policy.cancel_reason)\
+                                .filter(Policy.id.in_(chunk))\
+                                .filter(Policy.status == "Canceled"):
+            if (policy.id, 'PolicyCanceled', None) not in recorded:
+                rows.append(event_row(policy.id, 'PolicyCanceled', policy.cancel_date or recorded_at.date(),
+                                      details=policy.cancel_reason, recorded_at=recorded_at))
+
+        if rows:
+            db.session.execute(AccountingEvent.__table__.insert(), rows)
+            appended += len(rows)
+    if appended:
+        log.info("Recorded %d missing accounting events", appended)
+    return appended
+
+
+def replay(policy_ids, date_cursor, last_event_id=None):
+    """Calculate the totals of some policies until a date from their nearest snapshot and the events after it.
+
+    The identifiers of the policies are used twice in the statement of the events, so a list of 500 of them
+    is already close to the limit of variables of SQLite.
+
+    :param policy_ids: Identifiers of the policies.
+    :type  policy_ids: list
+    :param date_cursor: Date of the totals.
+    :type  date_cursor: datetime.date
+    :param last_event_id: Only the events up to this identifier are replayed, every one if omitted.
+    :type  last_event_id: int
+    :returns: dict -- Indexed by policy id, the billed and paid totals, the date of the snapshot they started
+                      from or None and the number of events replayed, the policies without snapshots nor events
+                      until the date are missing.
+    """
+    latest = db.session.query(LedgerSnapshot.policy_id.label('policy_id'),
+                              func.max(LedgerSnapshot.as_of_date).label('as_of_date'))\
+                       .filter(LedgerSnapshot.policy_id.in_(policy_ids))\
+                       .filter(LedgerSnapshot.as_of_date <= date_cursor)\
+                       .group_by(LedgerSnapshot.policy_id)\
+                       .subquery()
+    snapshots = db.session.query(LedgerSnapshot.policy_id, LedgerSnapshot.as_of_date, LedgerSnapshot.last_event_id,
+                                 LedgerSnapshot.billed, LedgerSnapshot.paid)\
+                          .join(latest, and_(latest.c.policy_id == LedgerSnapshot.policy_id,
+                                             latest.c.as_of_date == LedgerSnapshot.as_of_date))\
+                          .subquery()
+
+    totals = {}
+    for row in db.session.query(snapshots):
+        totals[row.policy_id] = {'billed': row.billed, 'paid': row.paid, 'snapshot_date': row.as_of_date,
+                                 'events': 0}
+
+    # The events after the snapshot date, or recorded after the snapshot with an earlier effective date
+    events = db.session.query(AccountingEvent.policy_id, AccountingEvent.event_type,
+                              func.sum(AccountingEvent.amount), func.count(AccountingEvent.id))\
+                       .outerjoin(snapshots, snapshots.c.policy_id == AccountingEvent.policy_id)\
+                       .filter(AccountingEvent.policy_id.in_(policy_ids))\
+                       .filter(AccountingEvent.effective_date <= date_cursor)\
+                       .filter(or_(snapshots.c.policy_id == None,
+                                   AccountingEvent.effective_date > snapshots.c.as_of_date,
+                                   AccountingEvent.id > snapshots.c.last_event_id))
+    if last_event_id is not None:
+        events = events.filter(AccountingEvent.id <= last_event_id)
+
+    for policy_id, event_type, amount, count in events.group_by(AccountingEvent.policy_id,
+                                                                AccountingEvent.event_type):
+        policy_totals = totals.setdefault(policy_id, {'billed': 0, 'paid': 0, 'snapshot_date': None, 'events': 0})
+        billed_effect, paid_effect = EVENT_EFFECTS[event_type]
+        policy_totals['billed'] += billed_effect * (amount or 0)
+        policy_totals['paid'] += paid_effect * (amount or 0)
+        policy_totals['events'] += count
+    return totals
+
+
+def event_balance(policy_id, date_cursor):
+    """Calculate the balance of a policy until a date by replaying its events from the nearest snapshot.
+
+    :returns: int -- Amount due until the date, the same that account_balance reads from the policy balances.
+    """
+    totals = replay([policy_id], date_cursor).get(policy_id)
+    if totals is None:
+        return 0
+    return totals['billed'] - totals['paid']
+
+
+def take_snapshots(date_cursor, policy_ids=None, chunk_size=250):
+    """Store the totals of the policies at a date so the later balances only replay the events after it.
+
+    It is meant to run periodically, at the end of every month for instance. The policies without events
+    since their previous snapshot are skipped and a snapshot taken again for the same date replaces it. Every
+    chunk is committed on its own.
+
+    :param date_cursor: Date of the snapshots.
+    :type  date_cursor: datetime.date
+    :param policy_ids: Identifiers of the policies, every policy if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies per statement. (default = 250)
+    :type  chunk_size: int
+    :returns: int -- Number of snapshots stored.
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+    last_event_id = db.session.query(func.max(AccountingEvent.id)).scalar()
+    if last_event_id is None:
+        return 0
+
+    stored = 0
+    for start in range(0, len(policy_ids), chunk_size):
+        rows = [{'policy_id': policy_id,
+                 'as_of_date': date_cursor,
+                 'last_event_id': last_event_id,
+                 'billed': totals['billed'],
+                 'paid': totals['paid']}
+                for policy_id, totals in replay(policy_ids[start:start + chunk_size], date_cursor,
+                                                last_event_id).items()
+                if totals['events']]
+        if not rows:
+            continue
+        try:
+            LedgerSnapshot.query.filter(LedgerSnapshot.policy_id.in_([row['policy_id'] for row in rows]))\
+                                .filter(LedgerSnapshot.as_of_date == date_cursor)\
+                                .delete(synchronize_session=False)
+            db.session.execute(LedgerSnapshot.__table__.insert(), rows)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        stored += len(rows)
+        log.info("Stored %d ledger snapshots", stored)
+    return stored
+
+
+def check_events(policy_ids=None, chunk_size=250):
+    """Verify that the events of the policies add up to the latest row of their policy balances ledger.
+
+    :returns: list -- Identifiers of the policies whose events don't match, see record_missing_events.
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+
+    mismatches = []
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        replayed = replay(chunk, date.max)
+        stored = {}
+        for row in db.session.query(PolicyBalance.policy_id, PolicyBalance.billed, PolicyBalance.paid)\
+                             .filter(PolicyBalance.policy_id.in_(chunk))\
+                             .order_by(PolicyBalance.policy_id, PolicyBalance.as_of_date):
+            stored[row.policy_id] = (row.billed, row.paid)
+        for policy_id in chunk:
+            totals = replayed.get(policy_id, {'billed': 0, 'paid': 0})
+            if (totals['billed'], totals['paid']) != stored.get(policy_id, (0, 0)):
+                mismatches.append(policy_id)
+    return mismatches
+
+
+def policy_events(policy_id):
+    """Return every event of a policy in the order it was recorded.
+
+    :returns: list -- One dict per event with its columns.
+    """
+    events = db.session.query(AccountingEvent.id, AccountingEvent.event_type, AccountingEvent.effective_date,
+                              AccountingEvent.amount, AccountingEvent.reference_id, AccountingEvent.details,
+                              AccountingEvent.recorded_at)\
+                       .filter(AccountingEvent.policy_id == policy_id)\
+                       .order_by(AccountingEvent.id)
+    return [dict(zip(event.keys(), event)) for event in events]
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Maintain the ledger of accounting events.")
+    parser.add_argument('--backfill', action='store_true', help="Record the events missing from the ledger")
+    parser.add_argument('--snapshot', action='store_true', help="Store the totals of every policy at the date")
+    parser.add_argument('--check', action='store_true', help="Compare the events with the policy balances")
+    parser.add_argument('--date', help="Date of the snapshots, %%Y-%%m-%%d, today if omitted")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.backfill:
+        appended = record_missing_events()
+        db.session.commit()
+        print "Recorded %d events" % appended
+    if args.snapshot:
+        snapshot_date = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else datetime.now().date()
+        print "Stored %d snapshots" % take_snapshots(snapshot_date)
+    if args.check:
+        mismatches = check_events()
+        print "%d policies don't match their events %s" % (len(mismatches), mismatches[:20] if mismatches else '')
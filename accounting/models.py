@@ -6,7 +6,10 @@ from accounting import db
 class Policy(db.Model):
     __tablename__ = 'policies'
 
-    __table_args__ = {}
+    # The summaries of an agent or insured read all their policies
+    __table_args__ = (db.Index('ix_policies_agent', 'agent'),
+                      db.Index('ix_policies_named_insured', 'named_insured'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -46,7 +49,13 @@ class Contact(db.Model):
 class Invoice(db.Model):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    # Every query on the invoices filters by policy and skips the deleted ones before comparing a date, the
+    # history including the deleted invoices is read in bill date order. The identifiers are never reused once
+    # the rows are moved to the archive, which keeps them
+    __table_args__ = (db.Index('ix_invoices_policy_deleted_bill_date', 'policy_id', 'deleted', 'bill_date'),
+                      db.Index('ix_invoices_policy_deleted_cancel_date', 'policy_id', 'deleted', 'cancel_date'),
+                      db.Index('ix_invoices_policy_bill_date', 'policy_id', 'bill_date'),
+                      {'sqlite_autoincrement': True})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -68,7 +77,9 @@ class Invoice(db.Model):
 class Payment(db.Model):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    # The identifiers are never reused once the rows are moved to the archive, which keeps them
+    __table_args__ = (db.Index('ix_payments_policy_transaction_date', 'policy_id', 'transaction_date'),
+                      {'sqlite_autoincrement': True})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -82,3 +93,103 @@ class Payment(db.Model):
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+
+class PolicyBalance(db.Model):
+    __tablename__ = 'policy_balances'
+
+    __table_args__ = {}
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, nullable=False)
+    as_of_date = db.Column(u'as_of_date', db.DATE(), primary_key=True, nullable=False)
+    billed = db.Column(u'billed', db.INTEGER(), nullable=False)
+    paid = db.Column(u'paid', db.INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, as_of_date, billed, paid):
+        self.policy_id = policy_id
+        self.as_of_date = as_of_date
+        self.billed = billed
+        self.paid = paid
+
+
+class ArchivedInvoice(db.Model):
+    __tablename__ = 'invoices_archive'
+
+    # Invoices moved out of the invoices table, they keep their original identifier
+    __table_args__ = (db.Index('ix_invoices_archive_policy_bill_date', 'policy_id', 'bill_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, autoincrement=False, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
+    due_date = db.Column(u'due_date', db.DATE(), nullable=False)
+    cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
+    deleted = db.Column(u'deleted', db.Boolean, nullable=False)
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=False)
+
+
+class ArchivedPayment(db.Model):
+    __tablename__ = 'payments_archive'
+
+    # Payments moved out of the payments table, they keep their original identifier
+    __table_args__ = (db.Index('ix_payments_archive_policy_transaction_date', 'policy_id', 'transaction_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, autoincrement=False, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
+    transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=False)
+
+
+class AccountingEvent(db.Model):
+    __tablename__ = 'accounting_events'
+
+    # Append only, the events of a policy are replayed in effective date order from its nearest snapshot
+    __table_args__ = (db.Index('ix_accounting_events_policy_effective_date', 'policy_id', 'effective_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    event_type = db.Column(u'event_type', db.Enum(u'InvoiceIssued', u'InvoiceVoided', u'PaymentReceived', u'PolicyCanceled'), nullable=False)
+    effective_date = db.Column(u'effective_date', db.DATE(), nullable=False)
+    amount = db.Column(u'amount', db.INTEGER(), default=0, nullable=False)
+    reference_id = db.Column(u'reference_id', db.INTEGER())
+    details = db.Column(u'details', db.VARCHAR(length=128))
+    recorded_at = db.Column(u'recorded_at', db.DATETIME(), nullable=False)
+
+
+class LedgerSnapshot(db.Model):
+    __tablename__ = 'ledger_snapshots'
+
+    __table_args__ = {}
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, nullable=False)
+    as_of_date = db.Column(u'as_of_date', db.DATE(), primary_key=True, nullable=False)
+    last_event_id = db.Column(u'last_event_id', db.INTEGER(), nullable=False)
+    billed = db.Column(u'billed', db.INTEGER(), nullable=False)
+    paid = db.Column(u'paid', db.INTEGER(), nullable=False)
+
+
+class BillingPlan(db.Model):
+    __tablename__ = 'billing_plans'
+
+    # The daily billing run looks for the plans whose next bill date arrived
+    __table_args__ = (db.Index('ix_billing_plans_next_bill_date', 'next_bill_date'),
+                      {})
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, autoincrement=False, nullable=False)
+    start_date = db.Column(u'start_date', db.DATE(), nullable=False)
+    interval_months = db.Column(u'interval_months', db.INTEGER(), nullable=False)
+    installments = db.Column(u'installments', db.INTEGER(), nullable=False)
+    next_installment = db.Column(u'next_installment', db.INTEGER(), nullable=False)
+    amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
+    next_bill_date = db.Column(u'next_bill_date', db.DATE())
@@ -0,0 +1,63 @@
+#!/user/bin/env python2.7
+
+import base64
+import json
+from datetime import date
+
+from sqlalchemy import and_, or_
+
+"""
+#######################################################
+Keyset pagination with opaque cursors
+#######################################################
+
+A page is read by seeking past the (date, id) of the last row of the previous page instead of skipping rows
+with an offset, so every page costs the same with an index on (..., date) and rows inserted meanwhile don't
+shift the pages. The cursor is that (date, id) pair encoded so the clients don't depend on its format.
+"""
+
+def encode_cursor(day, row_id):
+    """Return the cursor of the page that starts after the row with this date and identifier."""
+    return base64.urlsafe_b64encode(json.dumps([day.toordinal(), row_id]))
+
+
+def decode_cursor(cursor):
+    """Return the (date, id) encoded in a cursor.
+
+    :raises: ValueError if the cursor was not made by encode_cursor.
+    """
+    try:
+        ordinal, row_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        day, row_id = date.fromordinal(int(ordinal)), int(row_id)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid cursor")
+    # The identifiers are 64 bit integers in the database
+    if not -2 ** 63 <= row_id < 2 ** 63:
+        raise ValueError("Invalid cursor")
+    return day, row_id
+
+
+def keyset_page(query, date_column, id_column, cursor=None, limit=100):
+    """Read the page of a query that starts after a cursor, ordered by date and identifier.
+
+    :param query: Query with the filters of the rows to page through, it must not be ordered.
+    :param date_column: Column of the date the rows are ordered by.
+    :param id_column: Primary key column, it breaks the ties between rows of the same date.
+    :param cursor: Cursor returned with the previous page, the first page is returned if omitted.
+    :type  cursor: str
+    :param limit: Maximum number of rows of the page. (default = 100)
+    :type  limit: int
+    :returns: tuple -- (rows, cursor of the next page or None if this is the last one)
+    :raises: ValueError if the cursor is not valid.
+    """
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        query = query.filter(or_(date_column > last_date,
+                                 and_(date_column == last_date, id_column > last_id)))
+    # One more row than needed tells if there is a next page
+    rows = query.order_by(date_column, id_column).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[limit - 1]
+    return rows, encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
@@ -0,0 +1,213 @@
+#!/user/bin/env python2.7
+
+import atexit
+import itertools
+from collections import OrderedDict
+from Queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from timeit import default_timer
+
+from accounting import app, db
+from cache import apply_payments
+from ledger import record_missing_events
+from models import Payment
+from utils import rebuild_policy_balances
+
+"""
+#######################################################
+Queue of payments stored by background workers in batches
+#######################################################
+
+A payment is acknowledged in two steps: it is "queued" as soon as it is accepted, which is lost if the
+process dies before it is stored, and it becomes "committed" once the batch that includes it is committed
+to the database. A payment that can't be stored is marked as "failed".
+"""
+
+class PaymentTicket(object):
+    """
+     Tracks a queued payment until it is stored.
+
+     :ivar  id:     Identifier of the ticket, unique in this process.
+     :vartype id:   int
+     :ivar  status: One of "queued", "committed" or "failed".
+     :vartype status: str
+     :ivar  error:  Description of the problem when the payment failed.
+     :vartype error: str
+    """
+    def __init__(self, ticket_id, row):
+        self.id = ticket_id
+        self.row = row
+        self.status = 'queued'
+        self.error = None
+        self._done = Event()
+
+    def wait(self, timeout=None):
+        """Wait until the payment is committed or failed, returns the status at that moment."""
+        self._done.wait(timeout)
+        return self.status
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self._done.set()
+
+    def to_dict(self):
+        return {'ticket': self.id, 'status': self.status, 'error': self.error}
+
+
+class PaymentQueue(object):
+    """
+     Payments waiting to be stored and the workers that store them.
+
+     Each worker takes up to batch_size payments, waiting at most max_delay seconds for the batch to fill,
+     inserts them with a single statement, updates the policy balances ledger and commits once.
+
+     :param max_size: Maximum number of payments waiting, new ones are rejected when it is full.
+     :type  max_size: int
+     :param batch_size: Maximum number of payments per commit.
+     :type  batch_size: int
+     :param max_delay: Seconds a worker waits for a batch to fill before committing it.
+     :type  max_delay: float
+     :param workers: Number of worker threads, SQLite only allows one writer at a time.
+     :type  workers: int
+    """
+    def __init__(self, max_size, batch_size, max_delay, workers=1):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.workers = workers
+        self._queue = Queue(max_size)
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+        self._threads = []
+        # The latest tickets are kept so their status can be consulted
+        self._tickets = OrderedDict()
+        self._max_tickets = max_size
+        self._stats = {'enqueued': 0, 'committed': 0, 'failed': 0, 'rejected': 0, 'batches': 0,
+                       'last_batch_size': 0, 'last_batch_ms': 0.0}
+
+    def enqueue(self, policy_id, contact_id, amount, transaction_date):
+        """Queue a payment that was already validated.
+
+        :returns: PaymentTicket -- Ticket to follow the payment.
+        :raises: Queue.Full if there are already max_size payments waiting.
+        """
+        self.start()
+        ticket = PaymentTicket(next(self._ids), {'policy_id': policy_id,
+                                                 'contact_id': contact_id,
+                                                 'amount_paid': amount,
+                                                 'transaction_date': transaction_date})
+        try:
+            self._queue.put(ticket, block=False)
+        except Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise
+
+        with self._lock:
+            self._stats['enqueued'] += 1
+            self._tickets[ticket.id] = ticket
+            while len(self._tickets) > self._max_tickets:
+                self._tickets.popitem(last=False)
+        return ticket
+
+    def ticket(self, ticket_id):
+        with self._lock:
+            return self._tickets.get(ticket_id)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+        metrics['depth'] = self._queue.qsize()
+        metrics['workers'] = len(self._threads)
+        return metrics
+
+    def start(self):
+        """Start the workers, it is done automatically with the first payment."""
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = Thread(target=self._work, name='payment-worker-%d' % number)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        # Don't lose the payments already accepted when the process exits normally
+        atexit.register(self.stop)
+
+    def drain(self):
+        """Block until every payment queued so far is committed or failed."""
+        self._queue.join()
+
+    def stop(self):
+        """Store the payments still waiting and stop the workers."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        with app.app_context():
+            stopping = False
+            while not stopping:
+                ticket = self._queue.get()
+                if ticket is None:
+                    self._queue.task_done()
+                    break
+
+                batch = [ticket]
+                deadline = default_timer() + self.max_delay
+                while len(batch) < self.batch_size:
+                    try:
+                        ticket = self._queue.get(timeout=max(deadline - default_timer(), 0.001))
+                    except Empty:
+                        break
+                    if ticket is None:
+                        # Finish this batch before stopping
+                        self._queue.task_done()
+                        stopping = True
+                        break
+                    batch.append(ticket)
+
+                self._commit(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _commit(self, batch):
+        start = default_timer()
+        try:
+            db.session.execute(Payment.__table__.insert(), [ticket.row for ticket in batch])
+            policy_ids = list(set(ticket.row['policy_id'] for ticket in batch))
+            rebuild_policy_balances(policy_ids, commit=False)
+            record_missing_events(policy_ids)
+            db.session.commit()
+        except Exception, error:
+            db.session.rollback()
+            db.session.remove()
+            if len(batch) > 1:
+                # Store the payments one by one so a bad payment doesn't fail the whole batch
+                for ticket in batch:
+                    self._commit([ticket])
+                return
+            batch[0].finish('failed', str(error))
+            with self._lock:
+                self._stats['failed'] += 1
+            return
+        db.session.remove()
+        apply_payments([(ticket.row['policy_id'], ticket.row['transaction_date'], ticket.row['amount_paid'])
+                        for ticket in batch])
+
+        for ticket in batch:
+            ticket.finish('committed')
+        with self._lock:
+            self._stats['committed'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['last_batch_ms'] = (default_timer() - start) * 1000.0
+
+
+payment_queue = PaymentQueue(app.config['PAYMENT_QUEUE_SIZE'],
+                             app.config['PAYMENT_BATCH_SIZE'],
+                             app.config['PAYMENT_BATCH_DELAY'],
+                             app.config['PAYMENT_WORKERS'])
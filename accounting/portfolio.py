@@ -0,0 +1,137 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+from multiprocessing import Pool
+from timeit import default_timer
+
+from accounting import app, db
+from cache import invalidate_policies
+from ledger import record_cancellations
+from models import BillingPlan, Invoice, Policy
+from utils import PolicyAccounting
+
+"""
+#######################################################
+Evaluation of the whole portfolio across a process pool
+#######################################################
+
+The policies are split in shards that are evaluated by worker processes, each one with its own database
+connections. The workers only read, the cancellations they find are applied afterwards by the calling
+process with a single commit.
+"""
+
+def _init_worker():
+    # The connections inherited from the parent process can't be shared, every worker opens its own.
+    db.session.remove()
+    db.get_engine(app).dispose()
+
+
+def evaluate_shard(args):
+    """Evaluate the balance, the cancellation pending status and the need of cancellation of some policies.
+
+    :param args: (policy_ids, date_cursor) tuple, a single argument so it can be used with Pool.map.
+    :returns: list -- One dict per policy with its policy_id, balance, pending_cancellation and cancel.
+    """
+    policy_ids, date_cursor = args
+    # Only the policies already billed or with a billing plan are evaluated, read only so the workers never
+    # write.
+    with_invoices = set(row.policy_id for row in db.session.query(Invoice.policy_id)
+                                                           .filter(Invoice.policy_id.in_(policy_ids))
+                                                           .distinct())
+    with_invoices.update(row.policy_id for row in db.session.query(BillingPlan.policy_id)
+                                                            .filter(BillingPlan.policy_id.in_(policy_ids)))
+    results = []
+    for policy_id in policy_ids:
+        if policy_id not in with_invoices:
+            continue
+        pa = PolicyAccounting(policy_id, readonly=True)
+        active = pa.policy.status != "Canceled"
+        pending = active and pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor)
+        results.append({'policy_id': policy_id,
+                        'balance': pa.return_account_balance(date_cursor),
+                        'pending_cancellation': pending,
+                        'cancel': active and pa.cancellation_due_to_non_pay(date_cursor)})
+    db.session.remove()
+    return results
+
+
+def evaluate_portfolio(date_cursor, policy_ids=None, workers=4, shard_size=500, apply=True):
+    """Evaluate every policy in parallel and cancel the ones with unpaid invoices past their cancel date.
+
+    :param date_cursor: The date used to evaluate the policies.
+    :type  date_cursor: datetime.date
+    :param policy_ids: Identifiers of the policies to evaluate, every policy is evaluated if omitted.
+    :type  policy_ids: list
+    :param workers: Number of worker processes. (default = 4)
+    :type  workers: int
+    :param shard_size: Number of policies evaluated per task. (default = 500)
+    :type  shard_size: int
+    :param apply: If False the cancellations are only reported. (default = True)
+    :type  apply: bool
+    :returns: dict -- The results of every policy, the identifiers of the policies canceled and the seconds
+                      it took.
+    """
+    start = default_timer()
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+    # Nothing pending should be inherited by the workers.
+    db.session.commit()
+
+    shards = [(policy_ids[index:index + shard_size], date_cursor)
+              for index in range(0, len(policy_ids), shard_size)]
+    pool = Pool(workers, initializer=_init_worker)
+    try:
+        results = [result for shard in pool.map(evaluate_shard, shards) for result in shard]
+    finally:
+        pool.close()
+        pool.join()
+
+    to_cancel = [result['policy_id'] for result in results if result['cancel']]
+    if apply and to_cancel:
+        for index in range(0, len(to_cancel), shard_size):
+            Policy.query.filter(Policy.id.in_(to_cancel[index:index + shard_size]))\
+                        .update({Policy.status: "Canceled",
+                                 Policy.cancel_date: date_cursor,
+                                 Policy.cancel_reason: "Lack of payment"},
+                                synchronize_session='fetch')
+        record_cancellations(to_cancel, date_cursor, "Lack of payment")
+        db.session.commit()
+        invalidate_policies(to_cancel)
+
+    return {'results': results,
+            'canceled': to_cancel if apply else [],
+            'seconds': default_timer() - start}
+
+
+def scaling_report(date_cursor, worker_counts=(1, 2, 4, 8), policy_ids=None, shard_size=500):
+    """Time the evaluation of the portfolio with different numbers of workers, nothing is canceled.
+
+    :returns: list -- (workers, seconds, speedup against the first count) tuples.
+    """
+    report = []
+    for workers in worker_counts:
+        seconds = evaluate_portfolio(date_cursor, policy_ids, workers, shard_size, apply=False)['seconds']
+        report.append((workers, seconds, report[0][1] / seconds if report else 1.0))
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+
+    parser = argparse.ArgumentParser(description="Evaluate every policy of the portfolio in parallel.")
+    parser.add_argument('--date', help="Date of the evaluation, %%Y-%%m-%%d, today if omitted")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--shard-size', type=int, default=500)
+    parser.add_argument('--scaling', action='store_true', help="Only report the time with 1, 2, 4 and 8 workers")
+    args = parser.parse_args()
+    configure_logging()
+
+    date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else datetime.now().date()
+    if args.scaling:
+        for workers, seconds, speedup in scaling_report(date_cursor, shard_size=args.shard_size):
+            print "%d workers: %.3f s (%.2fx)" % (workers, seconds, speedup)
+    else:
+        evaluation = evaluate_portfolio(date_cursor, workers=args.workers, shard_size=args.shard_size)
+        print "Evaluated %d policies in %.3f s" % (len(evaluation['results']), evaluation['seconds'])
+        print "Canceled policies: %s" % evaluation['canceled']
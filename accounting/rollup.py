@@ -0,0 +1,135 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import and_, func
+
+from accounting import db
+from cache import summary_cache
+from models import BillingPlan, Contact, Invoice, Policy, PolicyBalance
+from utils import planned_billed, planned_installments
+
+"""
+#######################################################
+Summaries of the policies of an agent or a named insured
+#######################################################
+
+Each summary is calculated with a fixed number of grouped queries, whatever the number of policies of the
+contact. The summaries are cached, every entry depends on the policies it covers and on the contact. A payment
+updates the balance of the cached entries in place (see cache.apply_payments), a cancellation or a new billing
+of any of their policies drops them.
+"""
+
+ROLE_COLUMNS = {'Agent': Policy.agent, 'Named Insured': Policy.named_insured}
+
+
+def contact_summary(role, contact_id, date_cursor, use_cache=True):
+    """Summarize the policies of a contact at a date.
+
+    :param role: Either 'Agent' or 'Named Insured'.
+    :type  role: str
+    :param contact_id: Identifier of the contact.
+    :type  contact_id: int
+    :param date_cursor: Date of the balances and pending cancellations.
+    :type  date_cursor: datetime.date
+    :param use_cache: If False the summary is always calculated. (default = True)
+    :type  use_cache: bool
+    :returns: dict -- Number of policies, active policies, annual premium of the active ones, outstanding
+                      balance and policies pending cancellation, None if there is no such contact.
+    """
+    key = (role, contact_id, date_cursor)
+    if use_cache:
+        cached = summary_cache.get(key)
+        if cached is not None:
+            return cached[0]
+
+    contact = db.session.query(Contact.name).filter(Contact.id == contact_id).filter(Contact.role == role).first()
+    if contact is None:
+        return None
+
+    column = ROLE_COLUMNS[role]
+    policies = db.session.query(Policy.id, Policy.status, Policy.annual_premium)\
+                         .filter(column == contact_id)\
+                         .all()
+    active = [policy for policy in policies if policy.status == "Active"]
+    pending = pending_cancellations(column, contact_id, date_cursor)
+    summary = {'id': contact_id,
+               'name': contact.name,
+               'role': role,
+               'date': date_cursor.isoformat(),
+               'policies': len(policies),
+               'active_policies': len(active),
+               'annual_premium': sum(policy.annual_premium for policy in active),
+               'balance': outstanding_balance(column, contact_id, date_cursor),
+               'pending_cancellations': len(pending)}
+
+    summary_cache.set(key, (summary, frozenset(pending)),
+                      [policy.id for policy in policies] + [(role, contact_id)])
+    return summary
+
+
+def outstanding_balance(column, contact_id, date_cursor):
+    """Sum of the balances of the policies of a contact, read from the latest ledger row of each one.
+
+    The installments of the billing plans billed until the date that the billing run didn't issue yet are added.
+    """
+    latest = db.session.query(PolicyBalance.policy_id.label('policy_id'),
+                              func.max(PolicyBalance.as_of_date).label('as_of_date'))\
+                       .join(Policy, Policy.id == PolicyBalance.policy_id)\
+                       .filter(column == contact_id)\
+                       .filter(PolicyBalance.as_of_date <= date_cursor)\
+                       .group_by(PolicyBalance.policy_id)\
+                       .subquery()
+    balance = db.session.query(func.sum(PolicyBalance.billed - PolicyBalance.paid))\
+                        .join(latest, and_(latest.c.policy_id == PolicyBalance.policy_id,
+                                           latest.c.as_of_date == PolicyBalance.as_of_date))\
+                        .scalar()
+    planned_ids = [row.policy_id for row in db.session.query(BillingPlan.policy_id)
+                                                      .join(Policy, Policy.id == BillingPlan.policy_id)
+                                                      .filter(column == contact_id)
+                                                      .filter(BillingPlan.next_bill_date <= date_cursor)]
+    return (balance or 0) + sum(planned_billed(date_cursor, planned_ids).values())
+
+
+def pending_cancellations(column, contact_id, date_cursor):
+    """Identifiers of the active policies of a contact for which evaluate_cancellation_pending_due_to_non_pay is
+    True.
+
+    The first invoice of each policy between its due and cancel dates is found with a grouped query and the
+    ledger rows of those policies are read with another one. The installments of the billing plans that the
+    billing run didn't issue yet count as invoices.
+    """
+    candidates = dict(db.session.query(Invoice.policy_id, func.min(Invoice.bill_date))
+                                .join(Policy, Policy.id == Invoice.policy_id)
+                                .filter(column == contact_id)
+                                .filter(Policy.status != "Canceled")
+                                .filter(Invoice.due_date < date_cursor)
+                                .filter(Invoice.cancel_date > date_cursor)
+                                .filter(Invoice.deleted == False)
+                                .group_by(Invoice.policy_id))
+    planned_ids = [row.policy_id for row in db.session.query(BillingPlan.policy_id)
+                                                      .join(Policy, Policy.id == BillingPlan.policy_id)
+                                                      .filter(column == contact_id)
+                                                      .filter(Policy.status != "Canceled")
+                                                      .filter(BillingPlan.next_bill_date < date_cursor)]
+    for policy_id, rows in planned_installments(date_cursor, planned_ids).items():
+        for row in rows:
+            if row['due_date'] < date_cursor < row['cancel_date']:
+                candidates[policy_id] = min(candidates.get(policy_id, row['bill_date']), row['bill_date'])
+    if not candidates:
+        return []
+
+    # Amount billed until the bill date of that invoice and paid until the date, per policy
+    billed = dict((policy_id, 0) for policy_id in candidates)
+    paid = dict(billed)
+    policy_ids = list(candidates)
+    for start in range(0, len(policy_ids), 500):
+        for row in db.session.query(PolicyBalance.policy_id, PolicyBalance.as_of_date, PolicyBalance.billed,
+                                    PolicyBalance.paid)\
+                             .filter(PolicyBalance.policy_id.in_(policy_ids[start:start + 500]))\
+                             .filter(PolicyBalance.as_of_date <= date_cursor)\
+                             .order_by(PolicyBalance.policy_id, PolicyBalance.as_of_date):
+            if row.as_of_date <= candidates[row.policy_id]:
+                billed[row.policy_id] = row.billed
+            paid[row.policy_id] = row.paid
+    for policy_id, rows in planned_installments(date_cursor, policy_ids).items():
+        billed[policy_id] += sum(row['amount_due'] for row in rows if row['bill_date'] <= candidates[policy_id])
+    return [policy_id for policy_id in candidates if billed[policy_id] - paid[policy_id] > 0]
@@ -0,0 +1,245 @@
+#!/user/bin/env python2.7
+
+from array import array
+from bisect import bisect_right
+from datetime import date
+
+from sqlalchemy import select, union_all
+
+from accounting import db
+from models import ArchivedPayment, Invoice, Payment, Policy
+from utils import planned_installments, with_planned_rows
+
+"""
+#######################################################
+Columnar snapshot of the portfolio for what-if analysis
+#######################################################
+
+The policies, their non deleted invoices and their payments, archived or not, are read with Core selects
+into flat arrays, one per column: dates as ordinals, amounts as machine integers and the status and billing
+schedule as codes of the enums of the Policy model. The invoices and payments are sorted by policy and date,
+the ones of the policy in position i go from offsets[i] to offsets[i + 1], so each rule is a binary search
+or a short scan over a slice instead of a query per policy. The installments of the billing plans that the
+billing run didn't issue yet are loaded as invoices.
+
+A policy takes 38 bytes, an invoice 20 and a payment 12, about 420 MB for a million monthly policies with
+a dozen payments each. The standard array module is used, so the amounts are stored as C longs, 64 bits
+wide on the usual platforms.
+"""
+
+STATUSES = tuple(Policy.__table__.c.status.type.enums)
+BILLING_SCHEDULE_CODES = tuple(Policy.__table__.c.billing_schedule.type.enums)
+CANCELED = STATUSES.index('Canceled')
+
+
+class PortfolioSnapshot(object):
+    """
+     Arrays with the data that the balance and cancellation rules of PolicyAccounting need.
+
+     :ivar  policy_ids: Identifiers of the policies, sorted.
+     :vartype policy_ids: array.array
+     :ivar  status: Index of the status of every policy in STATUSES.
+     :vartype status: array.array
+     :ivar  billed:  Amount billed by every invoice and the ones billed before it in the same policy.
+     :vartype billed: array.array
+     :ivar  paid:    Same running total for the payments.
+     :vartype paid:  array.array
+    """
+    def __init__(self):
+        # Policies
+        self.policy_ids = array('l')
+        self.status = array('b')
+        self.billing_schedule = array('b')
+        self.effective_date = array('i')
+        self.annual_premium = array('l')
+        # Invoices, in the range invoice_offsets[i]:invoice_offsets[i + 1] for the policy i
+        self.invoice_offsets = array('l', [0])
+        self.bill_date = array('i')
+        self.due_date = array('i')
+        self.cancel_date = array('i')
+        self.billed = array('l')
+        # Payments, in the range payment_offsets[i]:payment_offsets[i + 1] for the policy i
+        self.payment_offsets = array('l', [0])
+        self.transaction_date = array('i')
+        self.paid = array('l')
+
+    @classmethod
+    def load(cls, chunk_size=10000):
+        """Read the whole portfolio from the database, nothing is loaded into the session.
+
+        :param chunk_size: Rows fetched from the database at a time. (default = 10000)
+        :type  chunk_size: int
+        :returns: PortfolioSnapshot
+        """
+        snapshot = cls()
+        policies = Policy.__table__.c
+        for row in db.fetch(select([policies.id, policies.status, policies.billing_schedule,
+                                    policies.effective_date, policies.annual_premium])
+                            .order_by(policies.id), chunk_size):
+            snapshot.policy_ids.append(row[0])
+            snapshot.status.append(STATUSES.index(row[1]))
+            snapshot.billing_schedule.append(BILLING_SCHEDULE_CODES.index(row[2]))
+            snapshot.effective_date.append(row[3].toordinal())
+            snapshot.annual_premium.append(row[4])
+
+        invoices = Invoice.__table__.c
+        invoice_rows = db.fetch(select([invoices.policy_id, invoices.bill_date, invoices.due_date,
+                                        invoices.cancel_date, invoices.amount_due])
+                                .where(invoices.deleted == False)
+                                .order_by(invoices.policy_id, invoices.bill_date, invoices.id),
+                                chunk_size)
+        planned = dict((policy_id, [(policy_id, row['bill_date'], row['due_date'], row['cancel_date'],
+                                     row['amount_due']) for row in rows])
+                       for policy_id, rows in planned_installments().items())
+        snapshot._load_children(with_planned_rows(invoice_rows, planned),
+                                snapshot.invoice_offsets,
+                                (snapshot.bill_date, snapshot.due_date, snapshot.cancel_date),
+                                snapshot.billed)
+
+        # The archived payments still count for the balance of their policies
+        payments = union_all(*[select([table.c.policy_id, table.c.transaction_date, table.c.amount_paid,
+                                       table.c.id])
+                               for table in (Payment.__table__, ArchivedPayment.__table__)])
+        snapshot._load_children(db.fetch(payments.order_by('policy_id', 'transaction_date', 'id'), chunk_size),
+                                snapshot.payment_offsets,
+                                (snapshot.transaction_date,),
+                                snapshot.paid)
+        return snapshot
+
+    def _load_children(self, rows, offsets, date_columns, totals):
+        # The rows come sorted by policy, the offsets of the policies without rows repeat the previous one
+        position = 0
+        total = 0
+        count = 0
+        for row in rows:
+            while position < len(self.policy_ids) and self.policy_ids[position] < row[0]:
+                offsets.append(count)
+                position += 1
+                total = 0
+            if position == len(self.policy_ids) or self.policy_ids[position] != row[0]:
+                # Rows of a policy that no longer exists
+                continue
+            for column, value in zip(date_columns, row[1:]):
+                column.append(value.toordinal())
+            total += row[len(date_columns) + 1]
+            totals.append(total)
+            count += 1
+        while len(offsets) <= len(self.policy_ids):
+            offsets.append(count)
+
+    def __len__(self):
+        return len(self.policy_ids)
+
+    def nbytes(self):
+        """Memory used by the arrays of the snapshot."""
+        return sum(column.itemsize * len(column) for column in self.__dict__.values()
+                   if isinstance(column, array))
+
+    def position(self, policy_id):
+        """Return the position of a policy in the arrays, None if it isn't in the snapshot."""
+        position = bisect_right(self.policy_ids, policy_id) - 1
+        if position >= 0 and self.policy_ids[position] == policy_id:
+            return position
+
+    def billed_until(self, position, day):
+        """Amount billed on the policy in a position until a date ordinal, like the policy balances ledger."""
+        start, end = self.invoice_offsets[position], self.invoice_offsets[position + 1]
+        last = bisect_right(self.bill_date, day, start, end) - 1
+        return self.billed[last] if last >= start else 0
+
+    def paid_until(self, position, day):
+        """Amount paid on the policy in a position until a date ordinal."""
+        start, end = self.payment_offsets[position], self.payment_offsets[position + 1]
+        last = bisect_right(self.transaction_date, day, start, end) - 1
+        return self.paid[last] if last >= start else 0
+
+    def balances(self, date_cursor):
+        """Balance of every policy at a date, the same return_account_balance calculates.
+
+        :param date_cursor: Date of the balances.
+        :type  date_cursor: datetime.date
+        :returns: array.array -- One balance per policy, in the order of policy_ids.
+        """
+        day = date_cursor.toordinal()
+        return array('l', (self.billed_until(position, day) - self.paid_until(position, day)
+                           for position in xrange(len(self.policy_ids))))
+
+    def pending_cancellations(self, date_cursor):
+        """Flag the policies with an invoice past its due date but not its cancel date and a pending balance.
+
+        It is the rule of evaluate_cancellation_pending_due_to_non_pay, canceled policies are never flagged.
+
+        :returns: array.array -- 1 for the flagged policies and 0 for the rest, in the order of policy_ids.
+        """
+        day = date_cursor.toordinal()
+        flags = array('b', [0]) * len(self.policy_ids)
+        for position in xrange(len(self.policy_ids)):
+            if self.status[position] == CANCELED:
+                continue
+            start = self.invoice_offsets[position]
+            # Only the invoices billed before the date can be past their due date
+            end = bisect_right(self.bill_date, day, start, self.invoice_offsets[position + 1])
+            for invoice in xrange(start, end):
+                if self.due_date[invoice] < day < self.cancel_date[invoice]:
+                    billed = self.billed_until(position, self.bill_date[invoice])
+                    flags[position] = billed - self.paid_until(position, day) > 0
+                    break
+        return flags
+
+    def cancellations(self, date_cursor):
+        """Flag the policies that have to be canceled due lack of payment, the rule of evaluate_cancel.
+
+        :returns: array.array -- 1 for the policies to cancel and 0 for the rest, in the order of policy_ids.
+        """
+        day = date_cursor.toordinal()
+        flags = array('b', [0]) * len(self.policy_ids)
+        for position in xrange(len(self.policy_ids)):
+            if self.status[position] == CANCELED:
+                continue
+            # The invoice billed last among the ones past their cancel date
+            last = None
+            for invoice in xrange(self.invoice_offsets[position], self.invoice_offsets[position + 1]):
+                if self.cancel_date[invoice] <= day:
+                    last = invoice
+            if last is None:
+                continue
+            billed = self.billed_until(position, self.bill_date[last])
+            flags[position] = billed - self.paid_until(position, self.cancel_date[last] - 1) > 0
+        return flags
+
+    def evaluate(self, date_cursor):
+        """Evaluate every policy at a date.
+
+        :returns: dict -- Identifiers of the policies with a balance, pending cancellation and to cancel.
+        """
+        balances = self.balances(date_cursor)
+        pending = self.pending_cancellations(date_cursor)
+        cancel = self.cancellations(date_cursor)
+        flagged = lambda flags: [self.policy_ids[position] for position, flag in enumerate(flags) if flag]
+        return {'balance': dict((self.policy_ids[position], balance) for position, balance in enumerate(balances)
+                                if balance),
+                'pending_cancellation': flagged(pending),
+                'cancel': flagged(cancel)}
+
+
+if __name__ == "__main__":
+    import argparse
+    from accounting import configure_logging
+    from datetime import datetime
+    from timeit import default_timer
+
+    parser = argparse.ArgumentParser(description="Evaluate the whole portfolio in memory.")
+    parser.add_argument('--date', help="Date of the evaluation, %%Y-%%m-%%d, today if omitted")
+    args = parser.parse_args()
+    configure_logging()
+
+    date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else date.today()
+    start = default_timer()
+    snapshot = PortfolioSnapshot.load()
+    loaded = default_timer()
+    evaluation = snapshot.evaluate(date_cursor)
+    print "Loaded %d policies (%.1f MB) in %.3f s" % (len(snapshot), snapshot.nbytes() / 1048576.0,
+                                                     loaded - start)
+    print "Evaluated in %.3f s" % (default_timer() - loaded)
+    print "%d policies pending cancellation, %d to cancel" % (len(evaluation['pending_cancellation']),
+                                                              len(evaluation['cancel']))
@@ -0,0 +1,57 @@
+#!/user/bin/env python2.7
+
+import json
+
+from flask import Response, request, stream_with_context
+
+from accounting import app
+
+"""
+#######################################################
+Helpers to write JSON responses incrementally
+#######################################################
+"""
+
+# Dates are repeated a lot in a response (every policy effective the same day, invoices billed the same day),
+# so each one is formatted only once. The memo is emptied once it holds FORMATTED_DATES_SIZE dates, so a server
+# answering for years of dates stays bounded.
+FORMATTED_DATES_SIZE = 4096
+_formatted_dates = {}
+
+
+def format_date(value):
+    """Return a date in the "%m/%d/%Y" format used by the views."""
+    formatted = _formatted_dates.get(value)
+    if formatted is None:
+        if len(_formatted_dates) >= FORMATTED_DATES_SIZE:
+            _formatted_dates.clear()
+        formatted = _formatted_dates[value] = "%02d/%02d/%04d" % (value.month, value.day, value.year)
+    return formatted
+
+
+def json_array(items):
+    """Yield the JSON encoding of an iterable of dicts in pieces of STREAM_CHUNK_SIZE items."""
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    pieces = ['[']
+    separator = ''
+    for item in items:
+        pieces.append(separator + json.dumps(item))
+        separator = ', '
+        if len(pieces) >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+    pieces.append(']')
+    yield ''.join(pieces)
+
+
+def json_stream(generator):
+    """Build a response that sends the pieces of JSON yielded by a generator as soon as they are ready.
+
+    The request context is kept while the generator runs, so it can keep reading from the database session.
+    """
+    return Response(stream_with_context(generator), mimetype='application/json')
+
+
+def stream_requested():
+    """The streaming mode is enabled with the stream argument of the query string, e.g. ?stream=1"""
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
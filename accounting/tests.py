@@ -1,12 +1,38 @@
 #!/user/bin/env python2.7
 
+import base64
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from accounting import app, db
+from models import AccountingEvent, ArchivedInvoice, ArchivedPayment, BillingPlan, Contact, Invoice, \
+    LedgerSnapshot, Payment, Policy, PolicyBalance
+from utils import PolicyAccounting, account_balance, evaluate_cancellations, make_invoices_for_policies, \
+    check_policy_balances, invoice_dates, rebuild_policy_balances, regenerate_invoices, upgrade_db
+import streaming
+import utils
+from importer import import_policies_file
+from cache import LRUCache, policy_cache, summary_cache
+from payment_queue import payment_queue
+from portfolio import evaluate_portfolio
+from instrumentation import metrics
+from snapshot import PortfolioSnapshot
+from aging import aging_report, aging_rows
+from rollup import contact_summary
+from archive import archive_closed_payments, archive_deleted_invoices, audit_invoices, audit_payments, \
+                    compact_database
+from ledger import check_events, event_balance, policy_events, record_missing_events, replay, take_snapshots
+from billing import due_policy_ids, run_billing
+from export import EXPORTS, export_chunks, export_table, run_export
+from benchmark import SYNTHETIC_PREFIX, compare_results, generate_portfolio, remove_portfolio, run_suite, \
+    synthetic_records
 
 """
 #######################################################
@@ -14,6 +40,11 @@ Test Suite for Accounting
 #######################################################
 """
 
+def setUpModule():
+    # The tests run against the bundled database, bring it up to date with the models first.
+    upgrade_db()
+
+
 class TestBillingSchedules(unittest.TestCase):
 
     @classmethod
@@ -34,6 +65,8 @@ class TestBillingSchedules(unittest.TestCase):
     def tearDownClass(cls):
         db.session.delete(cls.test_insured)
         db.session.delete(cls.test_agent)
+        PolicyBalance.query.filter_by(policy_id=cls.policy.id).delete()
+        AccountingEvent.query.filter_by(policy_id=cls.policy.id).delete()
         db.session.delete(cls.policy)
         db.session.commit()
 
@@ -70,6 +103,14 @@ class TestBillingSchedules(unittest.TestCase):
         self.assertEqual(self.policy.invoices[0].amount_due, 100)
         self.assertEquals(sum([invoice.amount_due for invoice in self.policy.invoices]), self.policy.annual_premium)
 
+    def test_invoice_dates_memo_is_bounded(self):
+        for days in range(utils.INVOICE_DATES_CACHE_SIZE + 10):
+            invoice_dates(date(2000, 1, 1) + relativedelta(days=days), 'Quarterly')
+        self.assertTrue(len(utils._invoice_dates_cache) <= utils.INVOICE_DATES_CACHE_SIZE)
+        self.assertEquals(invoice_dates(date(2015, 1, 1), 'Two-Pay'),
+                          ((date(2015, 1, 1), date(2015, 2, 1), date(2015, 2, 15)),
+                           (date(2015, 7, 1), date(2015, 8, 1), date(2015, 8, 15))))
+
 
 class TestReturnAccountBalance(unittest.TestCase):
 
@@ -91,6 +132,8 @@ class TestReturnAccountBalance(unittest.TestCase):
     def tearDownClass(cls):
         db.session.delete(cls.test_insured)
         db.session.delete(cls.test_agent)
+        PolicyBalance.query.filter_by(policy_id=cls.policy.id).delete()
+        AccountingEvent.query.filter_by(policy_id=cls.policy.id).delete()
         db.session.delete(cls.policy)
         db.session.commit()
 
@@ -196,6 +239,48 @@ class TestReturnAccountBalance(unittest.TestCase):
                                                  date_cursor=invoice.bill_date, amount=invoice.amount_due))
             self.assertEquals(pa.return_account_balance(date_cursor=invoice.bill_date), 0)
 
+    def test_balance_before_eff_date(self):
+        self.policy.billing_schedule = "Monthly"
+        pa = PolicyAccounting(self.policy.id)
+        # Nothing has been billed yet, the aggregates of an empty set must not break the balance
+        self.assertEquals(pa.return_account_balance(date_cursor=date(2014, 12, 31)), 0)
+
+    def test_aggregate_balance_with_partial_payments(self):
+        self.policy.billing_schedule = "Monthly"
+        pa = PolicyAccounting(self.policy.id)
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .order_by(Invoice.bill_date).all()
+        for invoice in invoices[:3]:
+            self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                                 date_cursor=invoice.bill_date, amount=30))
+        self.assertEquals(account_balance(self.policy.id, invoices[2].bill_date), 210)
+        self.assertEquals(pa.return_account_balance(date_cursor=invoices[-1].bill_date), 1110)
+
+    def test_balance_timeline(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 2, 15), amount=300))
+
+        timeline = pa.balance_timeline(date(2014, 12, 31), date(2015, 12, 31), relativedelta(days=1))
+        self.assertEquals(len(timeline), 366)
+        for date_cursor, balance in timeline:
+            self.assertEquals(balance, pa.return_account_balance(date_cursor))
+
+        timeline = pa.balance_timeline(date(2015, 1, 1), date(2015, 12, 31), relativedelta(months=3))
+        self.assertEquals(timeline, [(date(2015, 1, 1), 300), (date(2015, 4, 1), 300),
+                                     (date(2015, 7, 1), 600), (date(2015, 10, 1), 900)])
+        self.assertEquals(len(pa.balance_timeline(date(2015, 1, 1), date(2015, 12, 31), relativedelta(months=3),
+                                                  max_points=4)), 4)
+
+        self.assertRaises(ValueError, pa.balance_timeline, date(2015, 1, 1), date(2015, 12, 31),
+                          relativedelta(months=3), max_points=3)
+        # The steps must move forward, even when they mix months and days
+        self.assertRaises(ValueError, pa.balance_timeline, date(2015, 1, 1), date(2015, 12, 31),
+                          relativedelta(days=0))
+        self.assertRaises(ValueError, pa.balance_timeline, date(2015, 2, 1), date(2015, 12, 31),
+                          relativedelta(months=1, days=-30))
+
     def test_policy_change_billing_schedule(self):
         self.policy.billing_schedule = "Quarterly"
         pa = PolicyAccounting(self.policy.id)
@@ -224,6 +309,59 @@ class TestReturnAccountBalance(unittest.TestCase):
         # The pending balance should still be 900 even when new invoices were created.
         self.assertEquals(pa.return_account_balance(invoices[-1].due_date), 900)
 
+    def test_policy_change_billing_schedule_incremental(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=300))
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 15)), 300)
+
+        # Only the invoices after the change are replaced
+        pa.policy.billing_schedule = 'Monthly'
+        pa.make_invoices(date(2015, 4, 15))
+
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id, deleted=False)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals(len(invoices), 10)
+        self.assertEquals([invoice.amount_due for invoice in invoices[:2]], [300, 300])
+        self.assertEquals(invoices[2].bill_date, date(2015, 5, 1))
+        self.assertEquals(set(invoice.amount_due for invoice in invoices[2:]), set([75]))
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy.id, deleted=True).count(), 2)
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 15)), 300)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 900)
+        self.assertEquals(check_policy_balances([self.policy.id]), [])
+
+        # Nothing is written when the schedule is already up to date
+        self.assertEquals(regenerate_invoices([pa.policy], date(2015, 4, 15)),
+                          {'kept': 10, 'inserted': 0, 'deleted': 0})
+
+        # A schedule without bills left charges the rest of the premium the next day
+        pa.policy.billing_schedule = 'Annual'
+        pa.make_invoices(date(2015, 6, 15))
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id, deleted=False)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals(invoices[-1].bill_date, date(2015, 6, 16))
+        self.assertEquals(invoices[-1].amount_due, 450)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 900)
+
+    def test_premium_lowered_below_the_amount_billed(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy.id)
+
+        # 900 were billed until August, the new premium is 600
+        pa.policy.annual_premium = 600
+        try:
+            pa.make_invoices(date(2015, 8, 15))
+            invoices = Invoice.query.filter_by(policy_id=self.policy.id, deleted=False).all()
+            self.assertEquals(len(invoices), 3)
+            self.assertTrue(all(invoice.amount_due >= 0 for invoice in invoices))
+            self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 900)
+            self.assertEquals(check_policy_balances([self.policy.id]), [])
+        finally:
+            # The policy is shared by the tests of this class
+            pa.policy.annual_premium = 1200
+            db.session.commit()
+
 
 class TestGeneralOperations(unittest.TestCase):
 
@@ -249,6 +387,8 @@ class TestGeneralOperations(unittest.TestCase):
         for policy in self.policies:
             for invoice in policy.invoices:
                 db.session.delete(invoice)
+            PolicyBalance.query.filter_by(policy_id=policy.id).delete()
+            AccountingEvent.query.filter_by(policy_id=policy.id).delete()
             db.session.delete(policy)
         for payment in self.payments:
             db.session.delete(payment)
@@ -358,4 +498,1308 @@ class TestGeneralOperations(unittest.TestCase):
         pa.evaluate_cancel(date_cursor=date(2015, 3, 15))
         self.assertEqual(pa.policy.status, 'Canceled')
         self.assertEqual(pa.policy.cancel_date, date(2015, 3, 15))
-        self.assertEqual(pa.policy.cancel_reason, "Lack of payment")
\ No newline at end of file
+        self.assertEqual(pa.policy.cancel_reason, "Lack of payment")
+
+    def test_evaluate_cancellations_matches_evaluate_cancel(self):
+        policies = []
+        for billing_schedule in ["Annual", "Monthly", "Quarterly"]:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            self.policies.append(policy)
+            policies.append(policy)
+            db.session.add(policy)
+        db.session.commit()
+
+        for policy in policies:
+            PolicyAccounting(policy.id)
+        # The annual policy is paid in full, the monthly one only the first invoice and the quarterly one nothing.
+        self.payments.append(PolicyAccounting(policies[0].id).make_payment(date_cursor=date(2015, 1, 1),
+                                                                           amount=1200))
+        self.payments.append(PolicyAccounting(policies[1].id).make_payment(date_cursor=date(2015, 1, 1),
+                                                                           amount=100))
+
+        policy_ids = [policy.id for policy in policies]
+        # Nothing should be canceled before the first cancel date.
+        self.assertEquals(evaluate_cancellations(date(2015, 2, 14), policy_ids=policy_ids), [])
+        # The quarterly policy passes its first cancel date without payment, the monthly one is still covered.
+        self.assertEquals(evaluate_cancellations(date(2015, 2, 15), policy_ids=policy_ids, chunk_size=1),
+                          [policies[2].id])
+        self.assertEqual(policies[2].status, 'Canceled')
+        self.assertEqual(policies[2].cancel_date, date(2015, 2, 15))
+        self.assertEqual(policies[2].cancel_reason, "Lack of payment")
+
+        # Compare the sweep against the single policy evaluation on the monthly policy.
+        pa = PolicyAccounting(policies[1].id)
+        pa.evaluate_cancel(date_cursor=date(2015, 3, 14))
+        self.assertEqual(pa.policy.status, 'Active')
+        self.assertEquals(evaluate_cancellations(date(2015, 3, 14), policy_ids=policy_ids), [])
+        self.assertEquals(evaluate_cancellations(date(2015, 3, 15), policy_ids=policy_ids), [policies[1].id])
+        self.assertEqual(policies[0].status, 'Active')
+        self.assertEqual(policies[1].status, 'Canceled')
+
+    def test_evaluate_portfolio(self):
+        policies = []
+        for billing_schedule in ["Annual", "Monthly", "Quarterly"]:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            self.policies.append(policy)
+            policies.append(policy)
+            db.session.add(policy)
+        db.session.commit()
+        make_invoices_for_policies(policies)
+        self.payments.append(PolicyAccounting(policies[0].id).make_payment(date_cursor=date(2015, 1, 1),
+                                                                           amount=1200))
+        policy_ids = [policy.id for policy in policies]
+
+        # The monthly policy is pending cancellation, the quarterly one passed its cancel date
+        evaluation = evaluate_portfolio(date(2015, 3, 2), policy_ids, workers=2, shard_size=2)
+        results = dict((result['policy_id'], result) for result in evaluation['results'])
+        self.assertEquals([results[policy_id]['balance'] for policy_id in policy_ids], [0, 300, 300])
+        self.assertEquals([results[policy_id]['pending_cancellation'] for policy_id in policy_ids],
+                          [False, True, False])
+        self.assertEquals(evaluation['canceled'], [policies[1].id, policies[2].id])
+        self.assertEqual(policies[0].status, 'Active')
+        self.assertEqual(policies[1].status, 'Canceled')
+        self.assertEqual(policies[2].cancel_reason, 'Lack of payment')
+
+    def test_make_invoices_for_policies(self):
+        policies = []
+        for billing_schedule in ["Two-Pay", "Quarterly", "Quarterly"]:
+            policy = Policy('Test Policy', date(2015, 1, 31), 1000)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            self.policies.append(policy)
+            policies.append(policy)
+            db.session.add(policy)
+        db.session.commit()
+
+        make_invoices_for_policies(policies)
+        self.assertEquals(len(policies[0].invoices), 2)
+        self.assertEquals(len(policies[1].invoices), 4)
+        self.assertEquals(len(policies[2].invoices), 4)
+        invoices = Invoice.query.filter_by(policy_id=policies[1].id)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals([invoice.amount_due for invoice in invoices], [250] * 4)
+        # Dates are calculated from the effective date, so the end of the month is kept when possible
+        self.assertEquals([invoice.bill_date for invoice in invoices],
+                          [date(2015, 1, 31), date(2015, 4, 30), date(2015, 7, 31), date(2015, 10, 31)])
+        self.assertEquals(invoices[0].due_date, date(2015, 2, 28))
+        self.assertEquals(invoices[0].cancel_date, date(2015, 3, 14))
+
+        # Regenerating the invoices marks the previous ones as deleted
+        policies[0].billing_schedule = "Quarterly"
+        make_invoices_for_policies(policies[:1])
+        self.assertEquals(len(policies[0].invoices), 6)
+        self.assertEquals(len([invoice for invoice in policies[0].invoices if invoice.deleted]), 2)
+
+    def test_policy_balances_ledger(self):
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = self.test_insured.id
+        policy.agent = self.test_agent.id
+        self.policies.append(policy)
+        db.session.add(policy)
+        db.session.commit()
+
+        pa = PolicyAccounting(policy.id)
+        # One ledger row per bill date
+        self.assertEquals(PolicyBalance.query.filter_by(policy_id=policy.id).count(), 4)
+        # A payment between two bill dates adds a row, a back dated one updates every later row
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 2, 15), amount=300))
+        self.payments.append(pa.make_payment(date_cursor=date(2015, 1, 1), amount=100))
+        self.assertEquals(PolicyBalance.query.filter_by(policy_id=policy.id).count(), 5)
+        self.assertEquals(check_policy_balances([policy.id]), [])
+        self.assertEquals(pa.return_account_balance(date(2015, 1, 1)), 200)
+        self.assertEquals(pa.return_account_balance(date(2015, 2, 14)), 200)
+        self.assertEquals(pa.return_account_balance(date(2015, 2, 15)), -100)
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 200)
+
+        # Changes made behind the ledger's back are detected and repaired
+        PolicyBalance.query.filter_by(policy_id=policy.id).delete()
+        db.session.commit()
+        self.assertEquals(check_policy_balances([policy.id]), [policy.id])
+        rebuild_policy_balances([policy.id])
+        self.assertEquals(check_policy_balances([policy.id]), [])
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 200)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction_and_invalidation(self):
+        cache = LRUCache(2)
+        cache.set((1, date(2015, 1, 1)), 'a')
+        cache.set((1, date(2015, 2, 1)), 'b')
+        # Reading the first entry makes the second one the least recently used
+        self.assertEquals(cache.get((1, date(2015, 1, 1))), 'a')
+        cache.set((2, date(2015, 1, 1)), 'c')
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get((1, date(2015, 2, 1))), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+        cache.invalidate([1])
+        self.assertEquals(cache.get((1, date(2015, 1, 1))), None)
+        self.assertEquals(cache.get((2, date(2015, 1, 1))), 'c')
+
+    def test_entries_of_several_policies(self):
+        cache = LRUCache(10)
+        cache.set(('Agent', 1, date(2015, 1, 1)), 'a', [1, 2, ('Agent', 1)])
+        cache.set(('Agent', 2, date(2015, 1, 1)), 'b', [3, ('Agent', 2)])
+        cache.invalidate([2])
+        self.assertEquals(cache.get(('Agent', 1, date(2015, 1, 1))), None)
+        self.assertEquals(cache.get(('Agent', 2, date(2015, 1, 1))), 'b')
+        cache.invalidate([('Agent', 2)])
+        self.assertEquals(len(cache), 0)
+
+    def test_expired_entries(self):
+        cache = LRUCache(10, ttl=0)
+        cache.set((1, date(2015, 1, 1)), 'a')
+        self.assertEquals(cache.get((1, date(2015, 1, 1))), None)
+        self.assertEquals(len(cache), 0)
+
+        cache.ttl = 60
+        cache.set((1, date(2015, 1, 1)), 'a')
+        self.assertEquals(cache.get((1, date(2015, 1, 1))), 'a')
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def query_plan(self, query):
+        """Return the details of the SQLite query plan of an ORM query."""
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        rows = db.engine.execute("EXPLAIN QUERY PLAN " + unicode(compiled), *params).fetchall()
+        return " ".join(row['detail'] for row in rows)
+
+    def test_invoices_by_bill_date_use_index(self):
+        query = Invoice.query.filter_by(policy_id=1)\
+                             .filter(Invoice.bill_date <= date(2015, 3, 1))\
+                             .filter(Invoice.deleted == False)
+        self.assertTrue('ix_invoices_policy_deleted_bill_date' in self.query_plan(query))
+
+    def test_invoices_by_cancel_date_use_index(self):
+        query = Invoice.query.filter_by(policy_id=1)\
+                             .filter(Invoice.cancel_date <= date(2015, 3, 1))\
+                             .filter(Invoice.deleted == False)
+        self.assertTrue('ix_invoices_policy_deleted_cancel_date' in self.query_plan(query))
+
+    def test_payments_by_transaction_date_use_index(self):
+        query = Payment.query.filter_by(policy_id=1)\
+                             .filter(Payment.transaction_date <= date(2015, 3, 1))
+        self.assertTrue('ix_payments_policy_transaction_date' in self.query_plan(query))
+
+    def test_keyset_pages_use_index(self):
+        query = db.session.query(Invoice.id, Invoice.bill_date)\
+                          .filter(Invoice.policy_id == 1)\
+                          .filter(Invoice.bill_date > date(2015, 3, 1))\
+                          .order_by(Invoice.bill_date, Invoice.id)
+        self.assertTrue('ix_invoices_policy_bill_date' in self.query_plan(query))
+        query = db.session.query(Payment.id, Payment.transaction_date)\
+                          .filter(Payment.policy_id == 1)\
+                          .filter(Payment.transaction_date > date(2015, 3, 1))\
+                          .order_by(Payment.transaction_date, Payment.id)
+        self.assertTrue('ix_payments_policy_transaction_date' in self.query_plan(query))
+
+
+class TestViews(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+        # The session is removed at the end of every request, so only the identifiers are kept.
+        cls.test_agent_id = test_agent.id
+        cls.test_insured_id = test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.policy_ids = []
+
+    def tearDown(self):
+        policy_cache.clear()
+        summary_cache.clear()
+        # The session is removed at the end of every request, so the rows are deleted by id.
+        if self.policy_ids:
+            Invoice.query.filter(Invoice.policy_id.in_(self.policy_ids)).delete(synchronize_session=False)
+            Payment.query.filter(Payment.policy_id.in_(self.policy_ids)).delete(synchronize_session=False)
+            PolicyBalance.query.filter(PolicyBalance.policy_id.in_(self.policy_ids))\
+                               .delete(synchronize_session=False)
+            AccountingEvent.query.filter(AccountingEvent.policy_id.in_(self.policy_ids))\
+                             .delete(synchronize_session=False)
+            Policy.query.filter(Policy.id.in_(self.policy_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    def create_policy(self, policy_number, effective_date, billing_schedule='Annual'):
+        policy = Policy(policy_number, effective_date, 1200)
+        policy.billing_schedule = billing_schedule
+        policy.named_insured = self.test_insured_id
+        policy.agent = self.test_agent_id
+        db.session.add(policy)
+        db.session.commit()
+        return policy.id
+
+    def consult(self, policy_id, date_cursor):
+        return json.loads(self.client.post('/consult_policy', content_type='application/json',
+                                           data=json.dumps({'date': date_cursor,
+                                                            'policy_id': {'id': policy_id}})).data)
+
+    def test_consult_policy_cache_invalidation(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1))
+        self.policy_ids.append(policy_id)
+
+        self.assertEquals(self.consult(policy_id, '2015-01-01')['total_balance'], 1200)
+        # The second consultation is served from the cache
+        self.assertEquals(self.consult(policy_id, '2015-01-01')['total_balance'], 1200)
+        self.client.post('/make_payment', content_type='application/json',
+                         data=json.dumps({'date': '2015-01-01', 'payment_amount': 1200,
+                                          'policy_id': {'id': policy_id}}))
+        response = self.consult(policy_id, '2015-01-01')
+        self.assertEquals(response['total_balance'], 0)
+        self.assertEquals(len(response['payments']), 1)
+
+        PolicyAccounting(policy_id).evaluate_cancel(date(2015, 1, 2), cancellation_reason="Underwriting")
+        self.assertEquals(self.consult(policy_id, '2015-01-01')['policy_status'], 'Canceled')
+
+    def test_cache_invalidated_after_commit(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1))
+        self.policy_ids.append(policy_id)
+        self.consult(policy_id, '2015-01-01')
+
+        # Until the changes are committed other requests still read the previous data, keep serving it
+        rebuild_policy_balances([policy_id], commit=False)
+        self.assertNotEqual(policy_cache.get((policy_id, date(2015, 1, 1))), None)
+        db.session.commit()
+        rebuild_policy_balances([policy_id])
+        self.assertEquals(policy_cache.get((policy_id, date(2015, 1, 1))), None)
+
+    def test_balance_timeline_endpoint(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1), 'Two-Pay')
+        self.policy_ids.append(policy_id)
+
+        data = {'start': '2015-01-01', 'end': '2015-12-31', 'step_days': 181, 'policy_id': {'id': policy_id}}
+        response = self.client.post('/balance_timeline', content_type='application/json', data=json.dumps(data))
+        self.assertEquals(json.loads(response.data)['timeline'],
+                          [{'date': '01/01/2015', 'balance': 600}, {'date': '07/01/2015', 'balance': 1200},
+                           {'date': '12/29/2015', 'balance': 1200}])
+
+        data['end'] = '2014-12-31'
+        response = self.client.post('/balance_timeline', content_type='application/json', data=json.dumps(data))
+        self.assertEquals(response.status_code, 400)
+
+        data.update(end='2100-12-31', step_days=1)
+        response = self.client.post('/balance_timeline', content_type='application/json', data=json.dumps(data))
+        self.assertEquals(response.status_code, 400)
+
+    def test_streamed_responses_match(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1), 'Monthly')
+        self.policy_ids.append(policy_id)
+        PolicyAccounting(policy_id).make_payment(date_cursor=date(2015, 1, 1), amount=100)
+
+        data = json.dumps({'date': '2015-06-01', 'policy_id': {'id': policy_id}})
+        streamed = self.client.post('/consult_policy?stream=1', content_type='application/json', data=data)
+        self.assertEquals(streamed.mimetype, 'application/json')
+        streamed = json.loads(streamed.data)
+        self.assertEquals(len(streamed['invoices']), 6)
+        self.assertEquals(streamed['invoices'][0]['due_date'], '02/01/2015')
+        self.assertEquals(streamed, self.consult(policy_id, '2015-06-01'))
+
+        for url in ['/list_policies', '/list_policies?limit=2&offset=1', '/users']:
+            separator = '&' if '?' in url else '?'
+            self.assertEquals(json.loads(self.client.get(url + separator + 'stream=1').data),
+                              json.loads(self.client.get(url).data))
+
+    def test_formatted_dates_memo_is_bounded(self):
+        for days in range(streaming.FORMATTED_DATES_SIZE + 10):
+            streaming.format_date(date(2000, 1, 1) + relativedelta(days=days))
+        self.assertTrue(len(streaming._formatted_dates) <= streaming.FORMATTED_DATES_SIZE)
+        self.assertEquals(streaming.format_date(date(2015, 2, 1)), '02/01/2015')
+
+    def test_contact_summaries(self):
+        first = self.create_policy('Test Policy', date(2015, 1, 1), 'Quarterly')
+        self.policy_ids.append(first)
+        PolicyAccounting(first)
+
+        def summary(url):
+            return json.loads(self.client.get(url + '?date=2015-04-10').data)
+
+        agent_url = '/agents/%d/summary' % self.test_agent_id
+        data = summary(agent_url)
+        self.assertEquals((data['policies'], data['active_policies'], data['annual_premium']), (1, 1, 1200))
+        self.assertEquals(data['balance'], 600)
+        # The invoice billed on 04/01 is due on 05/01, the first one is already past its cancel date
+        self.assertEquals(data['pending_cancellations'], 0)
+
+        # A new policy and a payment are reflected even though the summary was cached
+        second = self.create_policy('Test Policy', date(2015, 3, 1), 'Monthly')
+        self.policy_ids.append(second)
+        PolicyAccounting(second)
+        self.client.post('/make_payment', content_type='application/json',
+                         data=json.dumps({'date': '2015-01-01', 'payment_amount': 300,
+                                          'policy_id': {'id': first}}))
+        data = summary(agent_url)
+        self.assertEquals(data['policies'], 2)
+        self.assertEquals(data['balance'], 300 + 200)
+        # The March invoice of the second policy was due on 04/01
+        self.assertEquals(data['pending_cancellations'], 1)
+        self.assertEquals(summary('/insureds/%d/summary' % self.test_insured_id), dict(data, role='Named Insured',
+                                                                                    id=self.test_insured_id,
+                                                                                    name='Test Insured'))
+
+        PolicyAccounting(second).evaluate_cancel(date(2015, 4, 10), cancellation_reason="Underwriting")
+        data = summary(agent_url)
+        self.assertEquals((data['active_policies'], data['pending_cancellations']), (1, 0))
+
+        self.assertEquals(self.client.get('/agents/%d/summary' % self.test_insured_id).status_code, 404)
+
+    def test_payments_update_cached_summaries(self):
+        first = self.create_policy('Test Policy', date(2015, 1, 1), 'Quarterly')
+        second = self.create_policy('Test Policy', date(2015, 3, 1), 'Monthly')
+        self.policy_ids.extend([first, second])
+        PolicyAccounting(first)
+        PolicyAccounting(second)
+        key = ('Agent', self.test_agent_id, date(2015, 4, 10))
+        summary = contact_summary('Agent', self.test_agent_id, date(2015, 4, 10))
+        self.assertEquals((summary['balance'], summary['pending_cancellations']), (800, 1))
+
+        # The balance of the cached summary is updated in place, the later payment doesn't change it
+        PolicyAccounting(first).make_payment(date_cursor=datetime(2015, 1, 1), amount=300)
+        PolicyAccounting(first).make_payment(date_cursor=date(2015, 5, 1), amount=100)
+        self.assertEquals(summary_cache.get(key)[0]['balance'], 500)
+        self.assertEquals(contact_summary('Agent', self.test_agent_id, date(2015, 4, 10)),
+                          contact_summary('Agent', self.test_agent_id, date(2015, 4, 10), use_cache=False))
+
+        # The second policy is pending cancellation, paying it may take it out, the summary is calculated again
+        PolicyAccounting(second).make_payment(date_cursor=date(2015, 4, 5), amount=200)
+        self.assertEquals(summary_cache.get(key), None)
+        summary = contact_summary('Agent', self.test_agent_id, date(2015, 4, 10))
+        self.assertEquals((summary['balance'], summary['pending_cancellations']), (300, 0))
+
+    def test_history_pagination(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1), 'Monthly')
+        self.policy_ids.append(policy_id)
+        pa = PolicyAccounting(policy_id)
+        for day in [1, 1, 1, 2, 3]:
+            pa.make_payment(date_cursor=date(2015, 1, day), amount=10)
+        # The first set of invoices is replaced, it is only listed with deleted=1
+        pa.make_invoices()
+
+        def pages(url):
+            items = []
+            cursor = None
+            while True:
+                data = json.loads(self.client.get(url + ('&cursor=' + cursor if cursor else '')).data)
+                items.append(data[url.split('?')[0].rsplit('/', 1)[-1]])
+                cursor = data.get('next_cursor')
+                if cursor is None:
+                    return items
+
+        invoices = pages('/policies/%d/invoices?limit=5' % policy_id)
+        self.assertEquals([len(page) for page in invoices], [5, 5, 2])
+        self.assertEquals(invoices[0][0]['bill_date'], '01/01/2015')
+        self.assertEquals(invoices[2][1]['bill_date'], '12/01/2015')
+        self.assertEquals(sum([len(page) for page in pages('/policies/%d/invoices?limit=5&deleted=1' % policy_id)],
+                              0), 24)
+
+        payments = pages('/policies/%d/payments?limit=2' % policy_id)
+        self.assertEquals([len(page) for page in payments], [2, 2, 1])
+        ids = [payment['id'] for page in payments for payment in page]
+        self.assertEquals(ids, sorted(ids))
+        self.assertEquals(payments[2][0]['transaction_date'], '01/03/2015')
+
+        self.assertEquals(self.client.get('/policies/%d/payments?cursor=bad' % policy_id).status_code, 400)
+        for out_of_range in ([10 ** 30, 1], [0, 1], [1, 10 ** 30]):
+            cursor = base64.urlsafe_b64encode(json.dumps(out_of_range))
+            self.assertEquals(self.client.get('/policies/%d/payments?cursor=%s' % (policy_id, cursor)).status_code,
+                              400)
+        self.assertEquals(self.client.get('/policies/%d/payments?limit=0' % policy_id).status_code, 400)
+        self.assertEquals(self.client.get('/policies/0/payments').status_code, 404)
+
+    def test_enqueue_payment(self):
+        policy_id = self.create_policy('Test Policy', date(2015, 1, 1), 'Quarterly')
+        self.policy_ids.append(policy_id)
+        PolicyAccounting(policy_id)
+
+        def enqueue(amount, ack):
+            return self.client.post('/enqueue_payment', content_type='application/json',
+                                    data=json.dumps({'date': '2015-01-01', 'payment_amount': amount, 'ack': ack,
+                                                     'policy_id': {'id': policy_id}}))
+
+        committed = payment_queue.metrics()['committed']
+        for _ in range(3):
+            self.assertEquals(enqueue(50, 'queued').status_code, 202)
+        response = enqueue(50, 'durable')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data)['status'], 'committed')
+        payment_queue.drain()
+
+        self.assertEquals(account_balance(policy_id, date(2015, 1, 1)), 100)
+        self.assertEquals(check_policy_balances([policy_id]), [])
+        ticket = json.loads(self.client.get('/payment_queue/%d' % json.loads(response.data)['ticket']).data)
+        self.assertEquals(ticket['status'], 'committed')
+        metrics = json.loads(self.client.get('/payment_queue/metrics').data)
+        self.assertEquals(metrics['committed'] - committed, 4)
+        self.assertEquals(metrics['depth'], 0)
+
+        self.assertEquals(enqueue(50, 'eventually').status_code, 400)
+
+    def test_list_policies_pagination(self):
+        # Policies effective far in the future are always listed last
+        for number in range(3):
+            self.policy_ids.append(self.create_policy('Test Policy %d' % number, date(2099, 1, 1)))
+
+        policies = json.loads(self.client.get('/list_policies').data)['policies']
+        self.assertEquals([policy['policy_number'] for policy in policies[-3:]],
+                          ['Test Policy 0', 'Test Policy 1', 'Test Policy 2'])
+        self.assertEquals(policies[-1]['insured_name'], 'Test Insured')
+        self.assertEquals(policies[-1]['agent_name'], 'Test Agent')
+
+        response = json.loads(self.client.get('/list_policies?limit=2&offset=%d' % (len(policies) - 3)).data)
+        self.assertEquals([policy['policy_number'] for policy in response['policies']],
+                          ['Test Policy 0', 'Test Policy 1'])
+        self.assertEquals(response['next_offset'], len(policies) - 1)
+        response = json.loads(self.client.get('/list_policies?limit=2&offset=%d' % response['next_offset']).data)
+        self.assertEquals([policy['policy_number'] for policy in response['policies']], ['Test Policy 2'])
+        self.assertFalse('next_offset' in response)
+
+        # The offset applies without a limit as well
+        response = json.loads(self.client.get('/list_policies?offset=%d' % (len(policies) - 2)).data)
+        self.assertEquals([policy['policy_number'] for policy in response['policies']],
+                          ['Test Policy 1', 'Test Policy 2'])
+        self.assertFalse('next_offset' in response)
+
+        self.assertEquals(self.client.get('/list_policies?limit=0').status_code, 400)
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        policy_ids = [policy.id for policy in Policy.query.filter(Policy.policy_number.like('Import Policy%'))]
+        if policy_ids:
+            Invoice.query.filter(Invoice.policy_id.in_(policy_ids)).delete(synchronize_session=False)
+            Payment.query.filter(Payment.policy_id.in_(policy_ids)).delete(synchronize_session=False)
+            PolicyBalance.query.filter(PolicyBalance.policy_id.in_(policy_ids)).delete(synchronize_session=False)
+            AccountingEvent.query.filter(AccountingEvent.policy_id.in_(policy_ids))\
+                                 .delete(synchronize_session=False)
+            Policy.query.filter(Policy.id.in_(policy_ids)).delete(synchronize_session=False)
+        Contact.query.filter(Contact.name.like('Import %')).delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_import_csv(self):
+        data = ("record_type,policy_number,effective_date,billing_schedule,annual_premium,named_insured,agent,"
+                "transaction_date,amount,contact,contact_role\n"
+                "policy,Import Policy 1,2015-01-01,Monthly,1200,Import Insured,Import Agent,,,,\n"
+                "policy,Import Policy 2,2015-02-01,Quarterly,800,Import Insured,Import Agent,,,,\n"
+                "payment,Import Policy 1,,,,,,2015-01-01,100,,\n"
+                "payment,Import Policy 2,,,,,,2015-02-01,200,Import Agent,Agent\n")
+        stats = import_policies_file(StringIO(data), 'csv', chunk_size=2)
+        self.assertEquals(stats['records'], 4)
+        self.assertEquals(stats['policies'], 2)
+        self.assertEquals(stats['payments'], 2)
+        # Both policies share the same insured and agent
+        self.assertEquals(stats['contacts'], 2)
+        self.assertEquals(Contact.query.filter(Contact.name.like('Import %')).count(), 2)
+
+        first = Policy.query.filter_by(policy_number='Import Policy 1').one()
+        second = Policy.query.filter_by(policy_number='Import Policy 2').one()
+        self.assertEquals(len(first.invoices), 12)
+        self.assertEquals(len(second.invoices), 4)
+        self.assertEquals(account_balance(first.id, date(2015, 1, 1)), 0)
+        self.assertEquals(account_balance(second.id, date(2015, 2, 1)), 0)
+        payment = Payment.query.filter_by(policy_id=second.id).one()
+        self.assertEquals(payment.contact_id, second.agent)
+
+    def test_import_endpoint(self):
+        data = ('{"policy_number": "Import Policy 3", "effective_date": "2015-01-01", "annual_premium": 500, '
+                '"named_insured": "Import Insured", "agent": "Import Agent"}\n'
+                '{"record_type": "payment", "policy_number": "Import Policy 3", "transaction_date": "2015-01-01", '
+                '"amount": 500}\n')
+        response = self.client.post('/import_policies', data={'file': (StringIO(data), 'policies.jsonl')})
+        self.assertEquals(response.status_code, 200)
+        stats = json.loads(response.data)
+        self.assertEquals(stats['policies'], 1)
+        self.assertEquals(stats['payments'], 1)
+
+        response = self.client.post('/import_policies',
+                                    data={'file': (StringIO('{"policy_number": "Import Policy 4"}\n'),
+                                                   'policies.jsonl')})
+        self.assertEquals(response.status_code, 400)
+
+    def test_unknown_billing_schedule(self):
+        data = ("policy_number,effective_date,billing_schedule,annual_premium,named_insured,agent\n"
+                "Import Policy 5,2015-01-01,Weekly,1200,Import Insured,Import Agent\n")
+        with self.assertRaises(ValueError) as context:
+            import_policies_file(StringIO(data), 'csv')
+        self.assertEquals(str(context.exception), "Line 2: unknown billing schedule Weekly")
+        self.assertEquals(Policy.query.filter_by(policy_number='Import Policy 5').count(), 0)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def tearDown(self):
+        remove_portfolio()
+
+    def test_synthetic_records_are_deterministic(self):
+        first = list(synthetic_records(20, 40, seed=3))
+        self.assertEquals(first, list(synthetic_records(20, 40, seed=3)))
+        self.assertNotEquals(first, list(synthetic_records(20, 40, seed=4)))
+        self.assertEquals(len([record for line_number, record in first if record['record_type'] == 'payment']), 40)
+
+    def test_generate_and_remove_portfolio(self):
+        stats = generate_portfolio(policies=20, payments=40, seed=3)
+        self.assertEquals(stats['policies'], 20)
+        self.assertEquals(stats['payments'], 40)
+        self.assertEquals(Policy.query.filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %')).count(), 20)
+        remove_portfolio()
+        self.assertEquals(Policy.query.filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %')).count(), 0)
+        self.assertEquals(Contact.query.filter(Contact.name.like(SYNTHETIC_PREFIX + ' %')).count(), 0)
+
+    def test_remove_archived_rows(self):
+        generate_portfolio(policies=5, payments=10, seed=3)
+        policy = Policy.query.filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %')).first()
+        db.session.add(ArchivedInvoice(id=10 ** 6, policy_id=policy.id, bill_date=date(2015, 1, 1),
+                                       due_date=date(2015, 2, 1), cancel_date=date(2015, 2, 15), amount_due=100,
+                                       deleted=True, archived_on=date(2016, 1, 1)))
+        db.session.add(ArchivedPayment(id=10 ** 6, policy_id=policy.id, contact_id=policy.named_insured,
+                                       amount_paid=100, transaction_date=date(2015, 1, 1),
+                                       archived_on=date(2016, 1, 1)))
+        db.session.commit()
+        policy_id = policy.id
+        remove_portfolio()
+        self.assertEquals(ArchivedInvoice.query.filter_by(policy_id=policy_id).count(), 0)
+        self.assertEquals(ArchivedPayment.query.filter_by(policy_id=policy_id).count(), 0)
+        self.assertEquals(Policy.query.filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %')).count(), 0)
+
+    def test_suite_times_the_write_endpoints(self):
+        suite = run_suite(policies=20, payments=40, samples=3, seed=3)
+        self.assertEquals(suite['results']['view_make_payment']['calls'], 3)
+        self.assertEquals(suite['results']['view_create_policy']['calls'], 3)
+        self.assertEquals(suite['results']['view_import_policies']['calls'], 5)
+        self.assertEquals(Policy.query.filter(Policy.policy_number.like(SYNTHETIC_PREFIX + ' %')).count(), 0)
+
+    def test_compare_results(self):
+        baseline = {'results': {'a': {'mean_ms': 1.0}, 'b': {'mean_ms': 2.0}}}
+        current = {'results': {'a': {'mean_ms': 1.5}, 'b': {'mean_ms': 2.0}, 'c': {'mean_ms': 1.0}}}
+        self.assertEquals(compare_results(baseline, current),
+                          [('a', 1.0, 1.5, 1.5, True), ('b', 2.0, 2.0, 1.0, False)])
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.records = []
+        metrics.reset()
+        metrics.add_sink(self.records.append)
+
+    def tearDown(self):
+        metrics.remove_sink(self.records.append)
+
+    def test_request_queries_are_counted(self):
+        self.client.get('/users')
+        self.assertEquals(len(self.records), 1)
+        self.assertEquals(self.records[0]['endpoint'], 'users_data')
+        self.assertEquals(self.records[0]['status_code'], 200)
+        # The agents and the insureds
+        self.assertEquals(self.records[0]['queries'], 2)
+
+        data = json.loads(self.client.get('/metrics').data)
+        self.assertEquals(data['requests']['users_data']['count'], 1)
+        self.assertEquals(data['requests']['users_data']['queries_per_request'], 2.0)
+        self.assertTrue(data['queries']['count'] >= 2)
+
+    def test_policy_accounting_methods_are_timed(self):
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        db.session.add(policy)
+        db.session.commit()
+        try:
+            # Read only, nothing else of the policy is stored
+            pa = PolicyAccounting(policy.id, readonly=True)
+            pa.return_account_balance(date(2015, 3, 1))
+            pa.return_account_balance(date(2015, 4, 1))
+            methods = metrics.snapshot()['methods']
+            self.assertEquals(methods['PolicyAccounting.return_account_balance']['count'], 2)
+            self.assertFalse('PolicyAccounting.make_payment' in methods)
+
+            app.config['METRICS_ENABLED'] = False
+            try:
+                pa.return_account_balance(date(2015, 5, 1))
+            finally:
+                app.config['METRICS_ENABLED'] = True
+            self.assertEquals(metrics.snapshot()['methods']['PolicyAccounting.return_account_balance']['count'], 2)
+        finally:
+            db.session.delete(policy)
+            db.session.commit()
+
+
+class TestDatabase(unittest.TestCase):
+
+    def test_sqlite_pragmas(self):
+        self.assertEquals(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        # NORMAL
+        self.assertEquals(db.session.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEquals(db.session.execute('PRAGMA busy_timeout').scalar(), 30000)
+
+    def test_connections_are_pooled(self):
+        self.assertEquals(db.engine.pool.size(), app.config['SQLALCHEMY_POOL_SIZE'])
+        idle = db.engine.pool.checkedin()
+        for _ in range(5):
+            db.engine.connect().close()
+        # A single connection was opened at most, then reused
+        self.assertEquals(db.engine.pool.checkedin(), max(idle, 1))
+
+
+class TestReadOnlyAccounting(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        db.session.add(self.policy)
+        db.session.commit()
+
+    def tearDown(self):
+        Invoice.query.filter_by(policy_id=self.policy.id).delete()
+        Payment.query.filter_by(policy_id=self.policy.id).delete()
+        PolicyBalance.query.filter_by(policy_id=self.policy.id).delete()
+        AccountingEvent.query.filter_by(policy_id=self.policy.id).delete()
+        db.session.delete(self.policy)
+        db.session.commit()
+
+    def test_readonly_projects_invoices(self):
+        pa = PolicyAccounting(self.policy.id, readonly=True)
+        self.assertFalse(pa.has_invoices)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy.id).count(), 0)
+        self.assertEquals(len(pa.projected_invoices(date(2015, 4, 1))), 2)
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 600)
+        self.assertEquals(pa.balance_timeline(date(2015, 1, 1), date(2015, 7, 1), relativedelta(months=3)),
+                          [(date(2015, 1, 1), 300), (date(2015, 4, 1), 600), (date(2015, 7, 1), 900)])
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy.id).count(), 0)
+
+        # The balances are the same once the invoices are stored
+        pa = PolicyAccounting(self.policy.id)
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 600)
+        self.assertEquals(pa.projected_invoices(), [])
+
+    def test_readonly_does_not_write(self):
+        pa = PolicyAccounting(self.policy.id, readonly=True)
+        self.assertRaises(RuntimeError, pa.make_payment, date_cursor=date(2015, 1, 1), amount=100)
+        self.assertRaises(RuntimeError, pa.evaluate_cancel, date(2015, 1, 1), "Underwriting")
+        self.assertRaises(RuntimeError, pa.make_invoices)
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy.id).count(), 0)
+        self.assertEquals(Policy.query.get(self.policy.id).status, 'Active')
+
+
+class TestPortfolioSnapshot(unittest.TestCase):
+
+    def tearDown(self):
+        remove_portfolio()
+
+    def test_snapshot_matches_policy_accounting(self):
+        generate_portfolio(policies=40, payments=120, seed=5)
+        snapshot = PortfolioSnapshot.load(chunk_size=50)
+        self.assertEquals(len(snapshot), Policy.query.count())
+        self.assertTrue(snapshot.nbytes() > 0)
+
+        for date_cursor in [date(2015, 3, 1), date(2015, 8, 20), date(2016, 2, 1)]:
+            balances = snapshot.balances(date_cursor)
+            pending = snapshot.pending_cancellations(date_cursor)
+            cancel = snapshot.cancellations(date_cursor)
+            for position, policy_id in enumerate(snapshot.policy_ids):
+                pa = PolicyAccounting(policy_id, readonly=True)
+                if not pa.has_invoices:
+                    continue
+                self.assertEquals(balances[position], pa.return_account_balance(date_cursor))
+                active = pa.policy.status != "Canceled"
+                self.assertEquals(bool(pending[position]),
+                                  bool(active and pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor)))
+                self.assertEquals(bool(cancel[position]), active and pa.cancellation_due_to_non_pay(date_cursor))
+
+        position = snapshot.position(snapshot.policy_ids[3])
+        self.assertEquals(position, 3)
+        self.assertEquals(snapshot.position(-1), None)
+
+
+class TestArchive(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        # compact_database removes the session, only the identifiers are kept
+        cls.test_agent_id = cls.test_agent.id
+        cls.test_insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.test_insured_id
+        self.policy.agent = self.test_agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+
+    def tearDown(self):
+        for model in (Invoice, Payment, ArchivedInvoice, ArchivedPayment, PolicyBalance, AccountingEvent):
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+        policy_cache.clear()
+
+    def test_archive_deleted_invoices(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 1), amount=300)
+        pa.policy.billing_schedule = 'Monthly'
+        pa.make_invoices()
+        balance = pa.return_account_balance(date(2015, 6, 1))
+
+        self.assertTrue(archive_deleted_invoices(chunk_size=3, archived_on=date(2016, 1, 1)) >= 4)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id, deleted=True).count(), 0)
+        self.assertEquals(ArchivedInvoice.query.filter_by(policy_id=self.policy_id).count(), 4)
+        self.assertEquals(pa.return_account_balance(date(2015, 6, 1)), balance)
+
+        invoices = audit_invoices(self.policy_id)
+        self.assertEquals(len(invoices), 16)
+        self.assertEquals(len([invoice for invoice in invoices if invoice['archived']]), 4)
+        self.assertEquals(invoices[0]['bill_date'], date(2015, 1, 1))
+
+    def test_archive_closed_payments(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 1), amount=300)
+        pa.make_payment(date_cursor=date(2015, 4, 1), amount=100)
+        pa.evaluate_cancel(date(2015, 5, 20))
+        self.assertEquals(pa.policy.status, 'Canceled')
+        balance = pa.return_account_balance(date(2015, 5, 20))
+
+        # Still within the retention window
+        self.assertEquals(archive_closed_payments(date(2016, 5, 1), retention_days=365), 0)
+        self.assertEquals(archive_closed_payments(date(2016, 6, 1), retention_days=365), 2)
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy_id).count(), 0)
+
+        # The balances don't change, even when the ledger is rebuilt
+        rebuild_policy_balances([self.policy_id])
+        self.assertEquals(check_policy_balances([self.policy_id]), [])
+        self.assertEquals(PolicyAccounting(self.policy_id).return_account_balance(date(2015, 5, 20)), balance)
+        self.assertEquals([payment['amount_paid'] for payment in audit_payments(self.policy_id)], [300, 100])
+
+        # The payment listings read the archive as well
+        client = app.test_client()
+        history = json.loads(client.get('/policies/%d/payments?limit=1' % self.policy_id).data)
+        self.assertEquals([(payment['amount_paid'], payment['archived']) for payment in history['payments']],
+                          [(300, True)])
+        history = json.loads(client.get('/policies/%d/payments?cursor=%s' % (self.policy_id,
+                                                                              history['next_cursor'])).data)
+        self.assertEquals([payment['amount_paid'] for payment in history['payments']], [100])
+        consult = json.loads(client.post('/consult_policy', content_type='application/json',
+                                         data=json.dumps({'date': '2015-05-20',
+                                                          'policy_id': {'id': self.policy_id}})).data)
+        self.assertEquals([payment['amount_paid'] for payment in consult['payments']], [300, 100])
+
+        compact_database(analyze=False)
+        self.assertEquals(ArchivedPayment.query.filter_by(policy_id=self.policy_id).count(), 2)
+
+    def test_archived_identifiers_are_not_reused(self):
+        pa = PolicyAccounting(self.policy_id)
+        # The latest invoices of the table are voided and archived before any other invoice is created
+        Invoice.query.filter_by(policy_id=self.policy_id).update({'deleted': True})
+        db.session.commit()
+        self.assertEquals(archive_deleted_invoices(archived_on=date(2016, 1, 1)), 4)
+        pa.policy.billing_schedule = 'Two-Pay'
+        pa.make_invoices()
+        pa.policy.billing_schedule = 'Annual'
+        pa.make_invoices()
+        self.assertEquals(archive_deleted_invoices(archived_on=date(2016, 1, 1)), 2)
+
+        archived_ids = set(row.id for row in ArchivedInvoice.query.filter_by(policy_id=self.policy_id))
+        self.assertEquals(len(archived_ids), 6)
+        live_ids = set(row.id for row in Invoice.query.filter_by(policy_id=self.policy_id))
+        self.assertEquals(len(live_ids), 1)
+        self.assertFalse(archived_ids & live_ids)
+        self.assertEquals(len(set(invoice['id'] for invoice in audit_invoices(self.policy_id))), 7)
+
+        pa.make_payment(date_cursor=date(2015, 1, 1), amount=300)
+        pa.evaluate_cancel(date(2015, 5, 20))
+        self.assertEquals(archive_closed_payments(date(2016, 6, 1), retention_days=365), 1)
+        payment = Payment(self.policy_id, self.test_insured_id, 10, date(2015, 5, 20))
+        db.session.add(payment)
+        db.session.commit()
+        self.assertNotEquals(payment.id, ArchivedPayment.query.filter_by(policy_id=self.policy_id).one().id)
+        self.assertEquals(len(set(payment['id'] for payment in audit_payments(self.policy_id))), 2)
+
+
+class TestAgingReport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.test_agent_id = cls.test_agent.id
+        cls.test_insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Monthly'
+        self.policy.named_insured = self.test_insured_id
+        self.policy.agent = self.test_agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+
+    def tearDown(self):
+        for model in (Invoice, Payment, PolicyBalance, AccountingEvent):
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+
+    def test_payments_settle_the_oldest_invoices(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 15), amount=150)
+
+        aging = [row for row in aging_rows(date(2015, 4, 10)) if row['policy_id'] == self.policy_id][0]
+        # January is paid and half of February, due on 03/01, April is not due yet
+        self.assertEquals(aging['balance'], 250)
+        self.assertEquals(aging['31-60'], 50)
+        self.assertEquals(aging['1-30'], 100)
+        self.assertEquals(aging['current'], 100)
+        self.assertEquals(aging['61+'], 0)
+        self.assertEquals(aging['past_cancel_date'], 50)
+        self.assertEquals(aging['credit'], 0)
+
+        # The totals of the book match the balances of every policy
+        report = aging_report(date(2015, 4, 10), details=True)
+        self.assertEquals(report['totals']['balance'],
+                          sum(account_balance(policy.id, date(2015, 4, 10)) for policy in Policy.query.all()))
+
+        data = json.loads(self.client.get('/reports/aging?date=2015-04-10&details=1').data)
+        self.assertEquals(data['totals'], report['totals'])
+        streamed = json.loads(self.client.get('/reports/aging?date=2015-04-10&details=1&stream=1').data)
+        self.assertEquals(streamed, data)
+        self.assertEquals(self.client.get('/reports/aging?date=04/10/2015').status_code, 400)
+
+    def test_credit(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 15), amount=250)
+        aging = [row for row in aging_rows(date(2015, 2, 10)) if row['policy_id'] == self.policy_id][0]
+        self.assertEquals(aging['balance'], -50)
+        self.assertEquals(aging['credit'], 50)
+        self.assertEquals(aging['current'], 0)
+
+    def test_past_cancel_date_on_the_cancel_date(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 15), amount=150)
+        # Half of February is unpaid on its cancel date, the day the policy is canceled
+        aging = [row for row in aging_rows(date(2015, 3, 15)) if row['policy_id'] == self.policy_id][0]
+        self.assertEquals(aging['past_cancel_date'], 50)
+        self.assertTrue(pa.cancellation_due_to_non_pay(date(2015, 3, 15)))
+
+
+class TestAccountingEvents(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.test_agent_id = cls.test_agent.id
+        cls.test_insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.test_insured_id
+        self.policy.agent = self.test_agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+
+    def tearDown(self):
+        for model in (Invoice, Payment, ArchivedInvoice, PolicyBalance, AccountingEvent, LedgerSnapshot):
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+
+    def event_types(self):
+        return [event['event_type'] for event in policy_events(self.policy_id)]
+
+    def test_events_of_invoices_created_after_the_archive(self):
+        PolicyAccounting(self.policy_id)
+        # The latest invoices of the table are voided and archived before any other invoice is created
+        Invoice.query.filter_by(policy_id=self.policy_id).update({'deleted': True})
+        record_missing_events([self.policy_id])
+        rebuild_policy_balances([self.policy_id])
+        archive_deleted_invoices(archived_on=date(2016, 1, 1))
+
+        make_invoices_for_policies([Policy.query.get(self.policy_id)], lazy=False)
+        record_missing_events([self.policy_id])
+        db.session.commit()
+        self.assertEquals(self.event_types().count('InvoiceIssued'), 8)
+        self.assertEquals(check_events([self.policy_id]), [])
+        self.assertEquals(event_balance(self.policy_id, date(2015, 12, 31)), 1200)
+        self.assertEquals(account_balance(self.policy_id, date(2015, 12, 31)), 1200)
+
+    def test_events_follow_the_ledger(self):
+        pa = PolicyAccounting(self.policy_id)
+        self.assertEquals(self.event_types(), ['InvoiceIssued'] * 4)
+        pa.make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        pa.policy.billing_schedule = 'Monthly'
+        pa.make_invoices(date(2015, 3, 1))
+
+        types = self.event_types()
+        self.assertEquals(types.count('PaymentReceived'), 1)
+        self.assertEquals(types.count('InvoiceVoided'), 3)
+        self.assertEquals(types.count('InvoiceIssued'), 4 + 9)
+        for day in (date(2015, 1, 1), date(2015, 2, 1), date(2015, 4, 1), date(2015, 12, 31)):
+            self.assertEquals(event_balance(self.policy_id, day), account_balance(self.policy_id, day))
+        self.assertEquals(check_events([self.policy_id]), [])
+        # Everything is already recorded
+        self.assertEquals(record_missing_events([self.policy_id]), 0)
+
+        pa.evaluate_cancel(date(2015, 5, 1), cancellation_reason='Underwriting')
+        event = policy_events(self.policy_id)[-1]
+        self.assertEquals((event['event_type'], event['details']), ('PolicyCanceled', 'Underwriting'))
+
+    def test_snapshots(self):
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        self.assertEquals(take_snapshots(date(2015, 6, 30), [self.policy_id]), 1)
+        # Nothing new since the snapshot
+        self.assertEquals(take_snapshots(date(2015, 6, 30), [self.policy_id]), 0)
+
+        # A payment recorded after the snapshot but effective before it is replayed
+        pa.make_payment(date_cursor=date(2015, 2, 1), amount=100)
+        totals = replay([self.policy_id], date(2015, 8, 1))[self.policy_id]
+        self.assertEquals(totals['snapshot_date'], date(2015, 6, 30))
+        self.assertEquals(totals['events'], 2)
+        for day in (date(2015, 1, 20), date(2015, 6, 30), date(2015, 8, 1)):
+            self.assertEquals(event_balance(self.policy_id, day), account_balance(self.policy_id, day))
+
+        self.assertEquals(take_snapshots(date(2015, 6, 30), [self.policy_id]), 1)
+        self.assertEquals(LedgerSnapshot.query.filter_by(policy_id=self.policy_id).count(), 1)
+        self.assertEquals(event_balance(self.policy_id, date(2015, 8, 1)), 500)
+
+    def test_audit_view(self):
+        PolicyAccounting(self.policy_id).make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        data = json.loads(app.test_client().get('/policies/%d/audit' % self.policy_id).data)
+        self.assertEquals([event['event_type'] for event in data['events']], self.event_types())
+        self.assertEquals(data['events'][-1]['effective_date'], '01/15/2015')
+
+
+class TestLazyBilling(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.test_agent_id = cls.test_agent.id
+        cls.test_insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy_ids = []
+        # Far enough in the future that nothing is billed when the policies are created
+        for lazy in (True, False):
+            app.config['LAZY_BILLING'] = lazy
+            policy = Policy('Test Policy', date(2100, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.test_insured_id
+            policy.agent = self.test_agent_id
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+            PolicyAccounting(policy.id)
+        self.lazy_id, self.eager_id = self.policy_ids
+
+    def tearDown(self):
+        app.config['LAZY_BILLING'] = False
+        for model in (Invoice, Payment, PolicyBalance, AccountingEvent, BillingPlan):
+            model.query.filter(model.policy_id.in_(self.policy_ids)).delete(synchronize_session=False)
+        Policy.query.filter(Policy.id.in_(self.policy_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        policy_cache.clear()
+
+    def assertSameBalances(self, *dates):
+        lazy, eager = PolicyAccounting(self.lazy_id), PolicyAccounting(self.eager_id)
+        for date_cursor in dates:
+            self.assertEquals(lazy.return_account_balance(date_cursor), eager.return_account_balance(date_cursor))
+
+    def issued(self):
+        return Invoice.query.filter_by(policy_id=self.lazy_id, deleted=False).count()
+
+    def test_billing_run(self):
+        self.assertEquals(self.issued(), 0)
+        self.assertTrue(PolicyAccounting(self.lazy_id).has_plan)
+        self.assertEquals(BillingPlan.query.get(self.lazy_id).next_bill_date, date(2100, 1, 1))
+        self.assertSameBalances(date(2100, 1, 1), date(2100, 5, 1), date(2101, 1, 1))
+
+        # The run catches up every installment billed until its date
+        self.assertTrue(self.lazy_id in due_policy_ids(date(2100, 4, 15)))
+        self.assertEquals(run_billing(date(2100, 4, 15), [self.lazy_id]), {'policies': 1, 'invoices': 2})
+        self.assertEquals(run_billing(date(2100, 4, 15), [self.lazy_id]), {'policies': 0, 'invoices': 0})
+        self.assertEquals(self.issued(), 2)
+        self.assertEquals(BillingPlan.query.get(self.lazy_id).next_bill_date, date(2100, 7, 1))
+        self.assertSameBalances(date(2100, 1, 1), date(2100, 5, 1), date(2101, 1, 1))
+        self.assertEquals(check_policy_balances([self.lazy_id]), [])
+        self.assertEquals(check_events([self.lazy_id]), [])
+
+        pa = PolicyAccounting(self.lazy_id, readonly=True)
+        self.assertEquals([invoice.bill_date for invoice in pa.projected_invoices(date(2100, 9, 1))],
+                          [date(2100, 7, 1)])
+        data = json.loads(app.test_client().post('/consult_policy',
+                                                 data=json.dumps({'date': '2100-12-31',
+                                                                  'policy_id': {'id': self.lazy_id}}),
+                                                 content_type='application/json').data)
+        self.assertEquals(len(data['invoices']), 4)
+        self.assertEquals(data['total_balance'], 1200)
+
+    def test_ledger_only_has_issued_installments(self):
+        self.assertEquals(PolicyBalance.query.filter_by(policy_id=self.lazy_id).count(), 0)
+        self.assertEquals(PolicyBalance.query.filter_by(policy_id=self.eager_id).count(), 4)
+
+        # The installments billed until the date of the billing are issued, whatever the clock says
+        make_invoices_for_policies([Policy.query.get(self.lazy_id)], lazy=True, date_cursor=date(2100, 4, 15))
+        self.assertEquals(self.issued(), 2)
+        self.assertEquals([row.as_of_date for row in PolicyBalance.query.filter_by(policy_id=self.lazy_id)
+                                                                        .order_by(PolicyBalance.as_of_date)],
+                          [date(2100, 1, 1), date(2100, 4, 1)])
+        self.assertEquals(BillingPlan.query.get(self.lazy_id).next_bill_date, date(2100, 7, 1))
+        self.assertSameBalances(date(2100, 1, 1), date(2100, 5, 1), date(2101, 1, 1))
+        self.assertEquals(check_policy_balances([self.lazy_id]), [])
+        self.assertEquals(check_events([self.lazy_id]), [])
+
+        timeline = PolicyAccounting(self.lazy_id).balance_timeline(date(2100, 1, 1), date(2100, 12, 1),
+                                                                   relativedelta(months=1))
+        self.assertEquals(timeline, PolicyAccounting(self.eager_id).balance_timeline(date(2100, 1, 1),
+                                                                                     date(2100, 12, 1),
+                                                                                     relativedelta(months=1)))
+
+    def test_schedule_change(self):
+        run_billing(date(2100, 4, 15), [self.lazy_id])
+        for policy_id in self.policy_ids:
+            pa = PolicyAccounting(policy_id)
+            pa.policy.billing_schedule = 'Monthly'
+            pa.make_invoices(date(2100, 8, 15))
+
+        # July is issued, September to December stay in the plan
+        self.assertEquals(self.issued(), 3)
+        plan = BillingPlan.query.get(self.lazy_id)
+        self.assertEquals((plan.next_bill_date, plan.amount_due), (date(2100, 9, 1), 75))
+        self.assertSameBalances(date(2100, 7, 1), date(2100, 9, 1), date(2100, 12, 31))
+        self.assertEquals(check_policy_balances([self.lazy_id]), [])
+
+    def test_premium_lowered_below_the_amount_billed(self):
+        run_billing(date(2100, 8, 15), [self.lazy_id])
+        for policy_id in self.policy_ids:
+            pa = PolicyAccounting(policy_id)
+            pa.policy.annual_premium = 600
+            pa.make_invoices(date(2100, 8, 15))
+
+        # Nothing is left to bill, the 900 billed until August stay billed
+        plan = BillingPlan.query.get(self.lazy_id)
+        self.assertEquals(plan.next_bill_date, None)
+        self.assertEquals(PolicyAccounting(self.lazy_id, readonly=True).projected_invoices(), [])
+        self.assertSameBalances(date(2100, 8, 15), date(2100, 12, 31))
+        self.assertEquals(account_balance(self.lazy_id, date(2100, 12, 31)), 900)
+        self.assertEquals(check_policy_balances([self.lazy_id]), [])
+
+    def test_installments_not_issued(self):
+        # No billing run, the shared readers still see the installments of the plan
+        for date_cursor in (date(2100, 1, 1), date(2100, 8, 1)):
+            self.assertEquals(account_balance(self.lazy_id, date_cursor),
+                              account_balance(self.eager_id, date_cursor))
+        self.assertEquals(account_balance(self.lazy_id, date(2100, 8, 1)), 900)
+        self.assertEquals(check_events([self.lazy_id]), [])
+
+        agings = dict((aging['policy_id'], aging) for aging in aging_rows(date(2100, 8, 1))
+                      if aging['policy_id'] in self.policy_ids)
+        for aging in agings.values():
+            del aging['policy_id']
+        self.assertEquals(agings[self.lazy_id], agings[self.eager_id])
+        self.assertEquals(agings[self.lazy_id]['past_cancel_date'], 600)
+
+        snapshot = PortfolioSnapshot.load()
+        self.assertEquals(snapshot.evaluate(date(2100, 8, 1))['balance'].get(self.lazy_id), 900)
+
+        summary = contact_summary('Named Insured', self.test_insured_id, date(2100, 2, 5), use_cache=False)
+        self.assertEquals((summary['balance'], summary['pending_cancellations']), (600, 2))
+
+        self.assertEquals(sorted(evaluate_cancellations(date(2100, 3, 1), self.policy_ids)),
+                          sorted(self.policy_ids))
+
+
+class TestExport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.test_agent_id = cls.test_agent.id
+        cls.test_insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        Contact.query.filter(Contact.id.in_([cls.test_agent_id, cls.test_insured_id]))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.policy = Policy(u'Test Policy \xe9', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Monthly'
+        self.policy.named_insured = self.test_insured_id
+        self.policy.agent = self.test_agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+        self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        for model in (Invoice, Payment, ArchivedInvoice, PolicyBalance, AccountingEvent):
+            model.query.filter_by(policy_id=self.policy_id).delete()
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+
+    def test_chunks(self):
+        chunks = list(export_chunks(Invoice.__table__, chunk_size=5))
+        self.assertTrue(max(len(rows) for rows in chunks) <= 5)
+        ids = [row['id'] for rows in chunks for row in rows]
+        self.assertEquals(ids, sorted(ids))
+        self.assertEquals(len(ids), Invoice.query.count())
+
+        dated = [row for rows in export_chunks(Invoice.__table__, 'bill_date', since_date=date(2015, 12, 1))
+                 for row in rows]
+        self.assertEquals(len(dated), Invoice.query.filter(Invoice.bill_date >= date(2015, 12, 1)).count())
+
+    def test_formats(self):
+        for file_format in ('csv', 'jsonl', 'columns'):
+            stream = StringIO()
+            stats = export_table('invoices', stream, file_format, chunk_size=4)
+            self.assertEquals(stats['rows'], Invoice.query.count() + ArchivedInvoice.query.count())
+            lines = stream.getvalue().splitlines()
+            if file_format == 'csv':
+                self.assertEquals(lines[0],
+                                  'id,policy_id,bill_date,due_date,cancel_date,amount_due,deleted,archived')
+                self.assertEquals(len(lines), stats['rows'] + 1)
+            elif file_format == 'jsonl':
+                self.assertEquals(json.loads(lines[len(lines) - 1])['id'], stats['last_id'])
+            else:
+                chunk = json.loads(lines[0])
+                self.assertEquals((chunk['rows'], len(chunk['values'][0])), (4, 4))
+                self.assertEquals(chunk['columns'][2], 'bill_date')
+
+        stream = StringIO()
+        export_table('policies', stream, 'csv')
+        self.assertTrue('Test Policy \xc3\xa9' in stream.getvalue())
+        self.assertRaises(ValueError, export_table, 'contacts', StringIO())
+
+    def test_archived_rows(self):
+        self.pa.policy.billing_schedule = 'Quarterly'
+        self.pa.make_invoices()
+        self.assertEquals(archive_deleted_invoices(archived_on=date(2016, 1, 1)), 12)
+
+        stream = StringIO()
+        stats = export_table('invoices', stream, 'jsonl', chunk_size=5)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEquals([row['id'] for row in rows], sorted(row['id'] for row in rows))
+        self.assertEquals(stats['rows'], Invoice.query.count() + ArchivedInvoice.query.count())
+        invoices = [row for row in rows if row['policy_id'] == self.policy_id]
+        self.assertEquals([row['archived'] for row in invoices], [True] * 12 + [False] * 4)
+        self.assertTrue(all(row['deleted'] for row in invoices[:12]))
+
+        stream = StringIO()
+        export_table('invoices', stream, 'jsonl', since_date=date(2015, 12, 1))
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEquals([row['archived'] for row in rows if row['policy_id'] == self.policy_id], [True])
+
+    def test_incremental_export(self):
+        state_path = os.path.join(self.output_dir, 'state.json')
+        results = run_export(self.output_dir, 'jsonl', 'gzip', tables=list(EXPORTS), state_path=state_path)
+        self.assertEquals(results['payments']['rows'], Payment.query.count() + ArchivedPayment.query.count())
+        lines = gzip.open(results['invoices']['path']).read().splitlines()
+        self.assertEquals(len(lines), Invoice.query.count() + ArchivedInvoice.query.count())
+
+        # Only the rows added since the previous export
+        self.pa.make_payment(date_cursor=date(2015, 2, 15), amount=100)
+        results = run_export(self.output_dir, 'csv', tables=list(EXPORTS), state_path=state_path)
+        self.assertEquals(results['invoices']['rows'], 0)
+        self.assertEquals(results['payments']['rows'], 1)
+        self.assertEquals(results['events']['rows'], 1)
+        self.assertEquals(json.load(open(state_path))['payments'], results['payments']['last_id'])
+        results = run_export(self.output_dir, 'csv', tables=list(EXPORTS), state_path=state_path)
+        self.assertEquals(sum(stats['rows'] for stats in results.values()), 0)
+
+        # The cancellation updates a policy already exported, it is only carried by the events
+        self.pa.evaluate_cancel(date(2015, 3, 1), cancellation_reason="Underwriting")
+        results = run_export(self.output_dir, 'csv', state_path=state_path)
+        self.assertEquals(results['policies']['rows'], 0)
+        self.assertEquals(results['events']['rows'], 1)
+        self.assertTrue('PolicyCanceled' in open(results['events']['path']).read())
@@ -1,10 +1,18 @@
 #!/user/bin/env python2.7
 
+import logging
 from datetime import date, datetime
+from itertools import groupby
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import func
+from sqlalchemy.engine.reflection import Inspector
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
+from accounting import app, db
+from cache import apply_payments, invalidate_contact, invalidate_policies
+from instrumentation import timed
+from ledger import record_cancellations, record_event, record_missing_events
+from models import AccountingEvent, ArchivedInvoice, ArchivedPayment, BillingPlan, Contact, Invoice, Payment, \
+    Policy, PolicyBalance
 
 """
 #######################################################
@@ -12,27 +20,87 @@ This is the base code for the engineer project.
 #######################################################
 """
 
+log = logging.getLogger('accounting.utils')
+
+
+def ledger_totals(policy_id, date_cursor):
+    """Return the amount billed and paid on a policy until a date.
+
+    The totals are read from the policy_balances ledger, which stores them cumulatively for every date in
+    which an invoice was billed or a payment received, so only the latest row until the date is needed. The
+    installments of its billing plan billed until the date and not issued yet are added to the amount billed.
+
+    :param policy_id: The identifier of the policy.
+    :type  policy_id: int
+    :param date_cursor: Date used as basis for the totals.
+    :type  date_cursor: datetime.date
+    :returns: tuple -- (billed, paid) until the date specified
+    """
+    totals = db.session.query(PolicyBalance.billed, PolicyBalance.paid)\
+                       .filter(PolicyBalance.policy_id == policy_id)\
+                       .filter(PolicyBalance.as_of_date <= date_cursor)\
+                       .order_by(PolicyBalance.as_of_date.desc())\
+                       .first()
+    planned = planned_billed(date_cursor, [policy_id]).get(policy_id, 0)
+    if totals is None:
+        return planned, 0
+    return totals.billed + planned, totals.paid
+
+
+def account_balance(policy_id, date_cursor):
+    """Calculate the balance of a policy with a single lookup on the policy_balances ledger.
+
+    :param policy_id: The identifier of the policy.
+    :type  policy_id: int
+    :param date_cursor: Date used as basis for the balance calculation.
+    :type  date_cursor: datetime.date
+    :returns: int -- Amount due until the date specified
+    """
+    billed, paid = ledger_totals(policy_id, date_cursor)
+    return billed - paid
+
+
+def scale_step(step, times):
+    """Multiply an interval of dates, relativedelta can't be multiplied without losing its integer fields."""
+    if isinstance(step, relativedelta):
+        return relativedelta(years=step.years * times, months=step.months * times, days=step.days * times)
+    return step * times
+
+
 class PolicyAccounting(object):
     """
      Each policy has its own instance of accounting.
 
+     A read only instance never writes to the database, not even the invoices of a policy that doesn't have
+     them yet, those invoices are projected from the billing schedule instead, so it can be used to serve
+     consultations from concurrent readers or a replica.
+
      :param policy_id: The identifier of the policy whose data will be used.
      :type  policy_id: int
+     :param readonly: If True the methods that write raise a RuntimeError. (default = False)
+     :type  readonly: bool
      :ivar  policy:    Local variable used to store the policy that is obtained from the database.
      :vartype policy:  Policy object
+     :ivar  has_invoices: False while the invoices of the policy are not stored.
+     :vartype has_invoices: bool
+     :ivar  has_plan: True if the policy is billed lazily, its invoices are issued by the billing run.
+     :vartype has_plan: bool
     """
-    def __init__(self, policy_id):
+    def __init__(self, policy_id, readonly=False):
         try:
             self.policy = Policy.query.filter_by(id=policy_id).one()
         except:
             raise ValueError("No Policy was found with that ID")
+        self.readonly = readonly
 
-        if not self.policy.invoices:
+        self.check_billing()
+        if not self.has_invoices and not self.has_plan and not readonly:
             # The invoices are created at this point, according to the billing schedule, the annual premium
             # is divided equally according to the number of payments
-            print "Creating invoices for Policy %d" % policy_id
+            log.debug("Creating invoices for Policy %d", policy_id)
             self.make_invoices()
 
+    @timed
     def return_account_balance(self, date_cursor=None):
         """Calculate the pending balance in a policy.
 
@@ -45,32 +113,74 @@ class PolicyAccounting(object):
         """
         if not date_cursor:
             date_cursor = datetime.now().date()
-            print "No date provided, today date will be used: " + str(date_cursor)
-
-        # Get the invoices from the database whose bill date is earlier or equal to the date provided.
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.bill_date <= date_cursor)\
-                                .filter(Invoice.deleted == False)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-        print "Number of due Invoices: %d" % len(invoices)
-        due_now = 0
-        # Calculate the sum of all the invoices until the specified date
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        # Get all the payments that were performed to this policy based on the date provided
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
-        print "Number if payments: %d" % len(payments)
-        # Subtract the payments already performed to this policy.
-        for payment in payments:
-            due_now -= payment.amount_paid
-
-        print "Total amount due: %d" % due_now
+            log.debug("No date provided, today date will be used: %s", date_cursor)
+
+        # The balance is read from the policy balances ledger with a single lookup instead of loading
+        # every invoice and payment of the policy.
+        due_now = account_balance(self.policy.id, date_cursor) + self.projected_billed(date_cursor)
+
+        log.debug("Total amount due: %d", due_now)
         return due_now
 
+    @timed
+    def balance_timeline(self, start, end, step=None, max_points=None):
+        """Calculate the balance of this policy at regular intervals.
+
+        The ledger rows of the policy until the end date are read once and swept along with the dates of the
+        timeline, each row holds the running totals billed and paid, so the cost grows with the number of
+        rows plus the number of steps instead of one query per step.
+
+        :param start: First date of the timeline.
+        :type  start: datetime.date
+        :param end: Last date that can be included in the timeline.
+        :type  end: datetime.date
+        :param step: Interval between two dates of the timeline. (default = one day)
+        :type  step: datetime.timedelta or dateutil.relativedelta.relativedelta
+        :param max_points: Maximum number of dates of the timeline, unlimited if omitted. (default = None)
+        :type  max_points: int
+        :returns: list -- (date, balance) tuples ordered by date, each balance is the same that
+                          return_account_balance returns for that date.
+        :raises: ValueError if a step doesn't move the date forward or the timeline has more than max_points
+                 dates.
+        """
+        if step is None:
+            step = relativedelta(days=1)
+
+        rows = db.session.query(PolicyBalance.as_of_date, PolicyBalance.billed, PolicyBalance.paid)\
+                         .filter(PolicyBalance.policy_id == self.policy.id)\
+                         .filter(PolicyBalance.as_of_date <= end)\
+                         .order_by(PolicyBalance.as_of_date)\
+                         .all()
+
+        # Installments of the billing plan not issued yet and invoices of a read only policy that doesn't have
+        # them stored yet, swept the same way
+        projected = self.projected_invoices(end) if self.readonly or self.has_plan else []
+
+        timeline = []
+        balance = 0
+        billed = 0
+        row = 0
+        invoice = 0
+        steps = 0
+        date_cursor = start
+        while date_cursor <= end:
+            while row < len(rows) and rows[row].as_of_date <= date_cursor:
+                balance = rows[row].billed - rows[row].paid
+                row += 1
+            while invoice < len(projected) and projected[invoice].bill_date <= date_cursor:
+                billed += projected[invoice].amount_due
+                invoice += 1
+            timeline.append((date_cursor, balance + billed))
+            steps += 1
+            # Every date is calculated from the start, so month steps keep the day of the month when possible
+            previous, date_cursor = date_cursor, start + scale_step(step, steps)
+            if date_cursor <= previous:
+                raise ValueError("The step must move the dates of the timeline forward")
+            if max_points is not None and steps >= max_points and date_cursor <= end:
+                raise ValueError("The timeline has more than %d dates" % max_points)
+        return timeline
+
+    @timed
     def make_payment(self, contact_id=None, date_cursor=None, amount=0):
         """Registers a payment to a policy
 
@@ -85,20 +195,22 @@ class PolicyAccounting(object):
         :returns: Payment -- Payment class created with the provided data or None if it wasn't possible to make
                              the payment.
         """
+        self.check_writable()
         if self.policy.status == "Canceled":
-            print "Payment denied since the policy is canceled"
+            log.warning("Payment denied since Policy %d is canceled", self.policy.id)
             return
 
         if not date_cursor:
             date_cursor = datetime.now().date()
-            print "No date provided, today date will be used: " + str(date_cursor)
+            log.debug("No date provided, today date will be used: %s", date_cursor)
 
         # If no name is provided for the insured, use the one stored in the policy
         if not contact_id:
             if not self.policy.named_insured:
                 # Return if no name was found in the parameter passed to the function
                 # or in the policy for the named_insured
-                print "Missing contact identifier for this payment, aborting payment."
+                log.warning("Missing contact identifier for a payment of Policy %d, aborting payment.",
+                            self.policy.id)
                 return
             else:
                 contact_id = self.policy.named_insured
@@ -108,10 +220,17 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
+        # The payment needs its identifier for the event
+        db.session.flush()
+        # The ledgers are kept up to date in the same transaction as the payment.
+        record_payment_balance(self.policy.id, date_cursor, amount)
+        record_event(self.policy.id, 'PaymentReceived', date_cursor, amount, payment.id)
         db.session.commit()
+        apply_payments([(self.policy.id, date_cursor, amount)])
 
         return payment
 
+    @timed
     def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
         """Evaluates the cancellation status of an invoice
 
@@ -126,12 +245,12 @@ class PolicyAccounting(object):
                    False -- No invoice has passed the due date without payment.
         """
         if self.policy.status == "Canceled":
-            print "Policy already canceled"
+            log.debug("Policy %d already canceled", self.policy.id)
             return
 
         if not date_cursor:
             date_cursor = datetime.now().date()
-            print "No date provided, today date will be used: " + str(date_cursor)
+            log.debug("No date provided, today date will be used: %s", date_cursor)
 
         # Get all the invoices that are beyond the due date but still not passed their cancel date
         invoice = Invoice.query.filter_by(policy_id=self.policy.id)\
@@ -140,35 +259,59 @@ class PolicyAccounting(object):
                                .filter(Invoice.deleted == False)\
                                .order_by(Invoice.bill_date)\
                                .all()
+        # The installments of the billing plan not issued yet are billed after the stored invoices
+        invoice.extend(row for row in self.planned_invoices(date_cursor)
+                       if row.due_date < date_cursor < row.cancel_date)
         # If the date provided does not match any Invoice range, we assume that
         # there are not pending cancellations.
         if len(invoice) is 0:
             return False
 
-        # We need to get all the invoices that were billed with and before the
-        # one that is in the cancellation range to avoid accounting for an
-        # invoice that was just billed but still not passed the due date.
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.bill_date <= invoice[0].bill_date)\
-                                .filter(Invoice.deleted == False)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-        # In contrast we get all the payments until the date_cursor, this is to
-        # include the payments made after the bill date and before the due date
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
-
-        due_now = 0
-        for curr_invoice in invoices:
-            due_now += curr_invoice.amount_due
-
-        for payment in payments:
-            due_now -= payment.amount_paid
+        # We need the amount billed with and before the invoice that is in the
+        # cancellation range to avoid accounting for an invoice that was just
+        # billed but still not passed the due date. In contrast we use all the
+        # payments until the date_cursor, this is to include the payments made
+        # after the bill date and before the due date.
+        billed = ledger_totals(self.policy.id, invoice[0].bill_date)[0]
+        paid = ledger_totals(self.policy.id, date_cursor)[1]
+        due_now = billed - paid
 
         return due_now > 0
 
 
+    @timed
+    def cancellation_due_to_non_pay(self, date_cursor):
+        """Evaluates if an invoice passed its cancel date without being paid, nothing is modified.
+
+        :param date_cursor: The date used to verify the invoices.
+        :type  date_cursor: datetime.date
+        :returns: True  -- The policy should be canceled due lack of payment.
+                  False -- Every invoice past its cancel date was paid.
+        """
+        # Get the last invoice that is ready to be canceled, every invoice
+        # billed before it passed its cancellation date too.
+        invoice = Invoice.query.filter_by(policy_id=self.policy.id)\
+                               .filter(Invoice.cancel_date <= date_cursor)\
+                               .filter(Invoice.deleted == False)\
+                               .order_by(Invoice.bill_date.desc())\
+                               .first()
+        # The installments of the billing plan not issued yet are billed after the stored invoices
+        planned = [row for row in self.planned_invoices(date_cursor) if row.cancel_date <= date_cursor]
+        if planned:
+            invoice = planned[len(planned) - 1]
+
+        if invoice is None:
+            # If no invoices are past the cancellation date, nothing else to do
+            return False
+
+        # We get the sum of all that is due of the invoices that passed the
+        # cancellation date, minus all the payments until before the last
+        # invoice cancellation date
+        billed = ledger_totals(self.policy.id, invoice.bill_date)[0]
+        paid = ledger_totals(self.policy.id, invoice.cancel_date - relativedelta(days=1))[1]
+        return billed - paid > 0
+
+    @timed
     def evaluate_cancel(self, date_cursor=None, cancellation_reason=None):
         """Evaluates if a policy should be canceled.
 
@@ -178,62 +321,88 @@ class PolicyAccounting(object):
                                     different than lack of payment
         :type  cancellation_reason: str
         """
+        self.check_writable()
         if self.policy.status == "Canceled":
-            print "Policy already canceled"
+            log.debug("Policy %d already canceled", self.policy.id)
             return
 
         if not date_cursor:
             date_cursor = datetime.now().date()
-            print "No date provided, today date will be used: " + str(date_cursor)
+            log.debug("No date provided, today date will be used: %s", date_cursor)
 
         # Validate if the cancellation reason is other than lack of payment
         if not cancellation_reason:
-            # Get the invoices that are ready to be canceled.
-            invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                    .filter(Invoice.cancel_date <= date_cursor)\
-                                    .filter(Invoice.deleted == False)\
-                                    .order_by(Invoice.bill_date)\
-                                    .all()
-
-            if len(invoices) is 0:
-                # If no invoices are past the cancellation date, nothing else to do
-                return
-
-            due_now = 0
-            # We get the sum of all that is due of the invoices that passed the
-            # cancellation date.
-            for invoice in invoices:
-                due_now += invoice.amount_due
-
-            # We get all the payments until before the last invoice cancellation
-            # date
-            payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                    .filter(Payment.transaction_date < invoices[-1].cancel_date)\
-                                    .all()
-
-            for payment in payments:
-                due_now -= payment.amount_paid
-
             # If some amount is still pending, then we can cancel the policy.
-            if due_now > 0:
-                print "This policy will be canceled due lack of payment"
+            if self.cancellation_due_to_non_pay(date_cursor):
+                log.info("Policy %d will be canceled due lack of payment", self.policy.id)
                 self.policy.status = "Canceled"
                 self.policy.cancel_date = date_cursor
                 self.policy.cancel_reason = "Lack of payment"
 
         else:
             # We assume that the cancel reason provided is valid
-            print "This policy will be canceled due: " + cancellation_reason
+            log.info("Policy %d will be canceled due: %s", self.policy.id, cancellation_reason)
             self.policy.status = "Canceled"
             self.policy.cancel_date = date_cursor
             self.policy.cancel_reason = cancellation_reason
 
         if self.policy.status == "Canceled":
             db.session.add(self.policy)
+            record_event(self.policy.id, 'PolicyCanceled', date_cursor, details=self.policy.cancel_reason)
             db.session.commit()
+            invalidate_policies([self.policy.id])
+
+
+    def check_writable(self):
+        if self.readonly:
+            raise RuntimeError("Policy %d was opened as read only" % self.policy.id)
 
+    def check_billing(self):
+        """Find out if the policy has invoices stored and a billing plan, they are not loaded."""
+        policy_id = self.policy.id
+        self.has_invoices = db.session.query(Invoice.id).filter(Invoice.policy_id == policy_id).first() is not None
+        self.has_plan = db.session.query(BillingPlan.policy_id)\
+                                  .filter(BillingPlan.policy_id == policy_id)\
+                                  .first() is not None
 
-    def make_invoices(self):
+    def projected_invoices(self, date_cursor=None):
+        """Return the invoices of this policy billed until a date that are not stored, nothing is stored.
+
+        Those are the installments of its billing plan the billing run didn't issue yet or, for a policy without
+        invoices nor plan, the invoices it would get.
+
+        :param date_cursor: Only the invoices billed until this date are returned, all of them if omitted.
+        :type  date_cursor: datetime.date
+        :returns: list -- Invoice objects that are not added to the session, empty if the policy already has
+                          invoices without a plan or is canceled without plan.
+        """
+        if self.has_plan:
+            # The plan is read every time, the billing run may have issued some installments meanwhile
+            plan = load_plans([self.policy.id]).get(self.policy.id)
+            rows = planned_invoice_rows(plan, date_cursor) if plan else []
+        elif self.has_invoices or self.policy.status == "Canceled":
+            return []
+        else:
+            rows = [row for row in invoice_rows(self.policy)
+                    if date_cursor is None or row['bill_date'] <= date_cursor]
+        return [Invoice(row['policy_id'], row['bill_date'], row['due_date'], row['cancel_date'], row['amount_due'])
+                for row in rows]
+
+    def planned_invoices(self, date_cursor):
+        """Return the installments of the billing plan of this policy billed until a date and not issued yet."""
+        return self.projected_invoices(date_cursor) if self.has_plan else []
+
+    def projected_billed(self, date_cursor):
+        """Amount the projected invoices of a read only policy without invoices nor plan bill until a date.
+
+        The installments of a billing plan are added by ledger_totals.
+        """
+        if self.has_plan or self.has_invoices or not self.readonly:
+            return 0
+        return sum(invoice.amount_due for invoice in self.projected_invoices(date_cursor))
+
+    @timed
+    def make_invoices(self, date_cursor=None):
         """Create invoices for this policy.
 
         This function creates invoices for this policy according to the billing schedule and the total annual
@@ -246,77 +415,646 @@ class PolicyAccounting(object):
         and not be accounted for any other operation on this policy, new invoices will be generated.
 
         The invoices are stored in the database and are related to the policy through the policy id.
+
+        With LAZY_BILLING only the invoices whose bill date arrived are stored, the rest are kept as a billing
+        plan and issued by the billing run.
+
+        :param date_cursor: If provided, the invoices billed until this date are kept and only the rest of the
+                            schedule is regenerated, see regenerate_invoices. (default = None)
+        :type  date_cursor: datetime.date
         """
+        self.check_writable()
+        if date_cursor is None:
+            make_invoices_for_policies([self.policy])
+        else:
+            regenerate_invoices([self.policy], date_cursor)
+        self.check_billing()
 
-        if self.policy.status == "Canceled":
-            print "Unable to create invoices since the policy is canceled"
-            return
 
-        invoices = []
-
-        # If there are pending invoices, they will be marked as "deleted" since we assume that the user
-        # made changes to the policy and rendered the previous invoices invalid.
-        for invoice in self.policy.invoices:
-            print "Deleting current invoices of this policy prior to the creation of new ones."
-            invoice.deleted = True
-            invoices.append(invoice)
-
-        billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
-
-        # Create the first invoice based on the effective date.
-        first_invoice = Invoice(self.policy.id,
-                                self.policy.effective_date, #bill_date
-                                self.policy.effective_date + relativedelta(months=1), #due
-                                self.policy.effective_date + relativedelta(months=1, days=14), #cancel
-                                self.policy.annual_premium)
-        invoices.append(first_invoice)
-
-        if self.policy.billing_schedule == "Annual":
-            # Since only one invoice is needed for this billing schedule and was already created previously,
-            # nothing else is needed.
-            pass
-        elif self.policy.billing_schedule == "Two-Pay":
-            first_invoice.amount_due = first_invoice.amount_due / billing_schedules.get(self.policy.billing_schedule)
-            for i in range(1, billing_schedules.get(self.policy.billing_schedule)):
-                # In a Two-Pay schedule only one invoices is needed after 6 months of the initial invoice.
-                months_after_eff_date = i*6
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
-                                  bill_date,
-                                  bill_date + relativedelta(months=1),
-                                  bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / billing_schedules.get(self.policy.billing_schedule))
-                invoices.append(invoice)
-        elif self.policy.billing_schedule == "Quarterly":
-            first_invoice.amount_due = first_invoice.amount_due / billing_schedules.get(self.policy.billing_schedule)
-            for i in range(1, billing_schedules.get(self.policy.billing_schedule)):
-                # For the Quarterly schedule, an invoice is created for every three months period
-                months_after_eff_date = i*3
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
-                                  bill_date,
-                                  bill_date + relativedelta(months=1),
-                                  bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / billing_schedules.get(self.policy.billing_schedule))
-                invoices.append(invoice)
-        elif self.policy.billing_schedule == "Monthly":
-            first_invoice.amount_due = first_invoice.amount_due / billing_schedules.get(self.policy.billing_schedule)
-            for i in range(1, billing_schedules.get(self.policy.billing_schedule)):
-                # In a monthly schedule, twelve invoices should be created.
-                months_after_eff_date = i
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
-                                  bill_date,
-                                  bill_date + relativedelta(months=1),
-                                  bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / billing_schedules.get(self.policy.billing_schedule))
-                invoices.append(invoice)
+# Months after the effective date in which an invoice is billed, for each billing schedule.
+BILLING_SCHEDULES = {'Annual': (0,),
+                     'Two-Pay': (0, 6),
+                     'Quarterly': (0, 3, 6, 9),
+                     'Monthly': tuple(range(12))}
+
+# The dates only depend on the effective date and the billing schedule, and a book has far less distinct
+# effective dates than policies, so they are calculated once per combination. The memo is emptied once it holds
+# INVOICE_DATES_CACHE_SIZE combinations, so a long running process importing years of policies stays bounded.
+INVOICE_DATES_CACHE_SIZE = 4096
+_invoice_dates_cache = {}
+
+
+def invoice_dates(effective_date, billing_schedule):
+    """Return the bill, due and cancel dates of every invoice of a billing schedule.
+
+    The due date is one month after the bill date and the cancel date two weeks after the due date.
+
+    :param effective_date: Effective date of the policy.
+    :type  effective_date: datetime.date
+    :param billing_schedule: Billing schedule of the policy.
+    :type  billing_schedule: str
+    :returns: tuple -- (bill_date, due_date, cancel_date) tuples ordered by bill date.
+    """
+    key = (effective_date, billing_schedule)
+    dates = _invoice_dates_cache.get(key)
+    if dates is None:
+        dates = []
+        for months in BILLING_SCHEDULES.get(billing_schedule, (0,)):
+            bill_date = effective_date + relativedelta(months=months)
+            dates.append((bill_date,
+                          bill_date + relativedelta(months=1),
+                          bill_date + relativedelta(months=1, days=14)))
+        if len(_invoice_dates_cache) >= INVOICE_DATES_CACHE_SIZE:
+            _invoice_dates_cache.clear()
+        dates = _invoice_dates_cache[key] = tuple(dates)
+    return dates
+
+
+def invoice_rows(policy):
+    """Return the invoices of a policy according to its billing schedule as dicts of invoice columns.
+
+    The annual premium is divided equally between the invoices.
+
+    :param policy: Policy whose invoices are calculated, nothing is written.
+    :type  policy: Policy object
+    :returns: list -- One dict per invoice, ordered by bill date.
+    """
+    periods = len(BILLING_SCHEDULES.get(policy.billing_schedule, ()))
+    if not periods:
+        # An unknown schedule is billed in a single invoice, just like an annual one
+        log.warning("Policy %d has a bad billing schedule: %s", policy.id, policy.billing_schedule)
+        periods = 1
+
+    amount_due = policy.annual_premium / periods
+    return [{'policy_id': policy.id,
+             'bill_date': bill_date,
+             'due_date': due_date,
+             'cancel_date': cancel_date,
+             'amount_due': amount_due,
+             'deleted': False}
+            for bill_date, due_date, cancel_date in invoice_dates(policy.effective_date, policy.billing_schedule)]
+
+
+def plan_bill_date(start_date, interval_months, installment):
+    return start_date + relativedelta(months=interval_months * installment)
+
+
+def next_bill_date(plan):
+    """Bill date of the next installment of a billing plan, None once every installment was issued."""
+    if plan['next_installment'] >= plan['installments']:
+        return None
+    return plan_bill_date(plan['start_date'], plan['interval_months'], plan['next_installment'])
+
+
+def billing_plan(policy, date_cursor=None, amount=None):
+    """Return the billing plan of a policy, the compact form of the invoices of its billing schedule.
+
+    A plan bills `installments` invoices of `amount_due` every `interval_months` since its start date, the
+    ones before `next_installment` were already issued.
+
+    :param policy: Policy whose plan is calculated, nothing is written.
+    :type  policy: Policy object
+    :param date_cursor: If provided, only the installments billed after this date are planned and they split
+                        the amount, as future_invoice_rows does, none if it isn't positive. (default = None)
+    :type  date_cursor: datetime.date
+    :param amount: Amount split between the installments billed after the date. (default = None)
+    :type  amount: int
+    :returns: dict -- The columns of its billing_plans row.
+    """
+    months = BILLING_SCHEDULES.get(policy.billing_schedule, (0,))
+    # Every schedule bills at regular intervals
+    interval_months = months[1] - months[0] if len(months) > 1 else 12
+    plan = {'policy_id': policy.id,
+            'start_date': policy.effective_date,
+            'interval_months': interval_months,
+            'installments': len(months),
+            'next_installment': 0,
+            'amount_due': policy.annual_premium / len(months)}
+    if date_cursor is not None:
+        while next_bill_date(plan) is not None and next_bill_date(plan) <= date_cursor:
+            plan['next_installment'] += 1
+        remaining = plan['installments'] - plan['next_installment']
+        if amount <= 0:
+            # What was billed until the date already covers the premium
+            plan['installments'] = plan['next_installment']
+        elif remaining:
+            plan['amount_due'] = amount / remaining
         else:
-            print "You have chosen a bad billing schedule."
+            # Nothing is billed after the date, the whole amount is billed the following day
+            plan.update(start_date=date_cursor + relativedelta(days=1), interval_months=12, installments=1,
+                        next_installment=0, amount_due=amount)
+    plan['next_bill_date'] = next_bill_date(plan)
+    return plan
+
+
+def planned_invoice_rows(plan, date_cursor=None):
+    """Return the installments of a billing plan not issued yet as dicts of invoice columns.
+
+    :param date_cursor: Only the installments billed until this date are returned, all of them if omitted.
+    :type  date_cursor: datetime.date
+    :returns: list -- One dict per invoice, ordered by bill date.
+    """
+    rows = []
+    for installment in range(plan['next_installment'], plan['installments']):
+        bill_date = plan_bill_date(plan['start_date'], plan['interval_months'], installment)
+        if date_cursor is not None and bill_date > date_cursor:
+            break
+        rows.append({'policy_id': plan['policy_id'],
+                     'bill_date': bill_date,
+                     'due_date': bill_date + relativedelta(months=1),
+                     'cancel_date': bill_date + relativedelta(months=1, days=14),
+                     'amount_due': plan['amount_due'],
+                     'deleted': False})
+    return rows
+
+
+def advance_plan(plan, date_cursor):
+    """Return the invoices of a billing plan billed until a date and move the plan past them."""
+    rows = planned_invoice_rows(plan, date_cursor)
+    plan['next_installment'] += len(rows)
+    plan['next_bill_date'] = next_bill_date(plan)
+    return rows
+
+
+def planned_installments(date_cursor=None, policy_ids=None):
+    """Return the installments of the billing plans that the billing run didn't issue yet.
+
+    :param date_cursor: Only the installments billed until this date are returned, all of them if omitted.
+    :type  date_cursor: datetime.date
+    :param policy_ids: Only the plans of these policies are read, every plan if omitted.
+    :type  policy_ids: list
+    :returns: dict -- Dicts of invoice columns ordered by bill date, indexed by policy id, only the policies
+                      with such installments are present.
+    """
+    query = db.session.query(*BillingPlan.__table__.columns).filter(BillingPlan.next_bill_date != None)
+    if date_cursor is not None:
+        query = query.filter(BillingPlan.next_bill_date <= date_cursor)
+    if policy_ids is None:
+        queries = [query]
+    else:
+        queries = [query.filter(BillingPlan.policy_id.in_(policy_ids[start:start + 500]))
+                   for start in range(0, len(policy_ids), 500)]
+
+    installments = {}
+    for chunk_query in queries:
+        for plan in chunk_query:
+            rows = planned_invoice_rows(dict(zip(plan.keys(), plan)), date_cursor)
+            if rows:
+                installments[plan.policy_id] = rows
+    return installments
+
 
-        for invoice in invoices:
-            db.session.add(invoice)
+def planned_billed(date_cursor, policy_ids=None):
+    """Return the amount the installments of the billing plans not issued yet bill until a date, per policy."""
+    return dict((policy_id, sum(row['amount_due'] for row in rows))
+                for policy_id, rows in planned_installments(date_cursor, policy_ids).items())
+
+
+def with_planned_rows(rows, planned):
+    """Yield rows ordered by policy with the planned rows of every policy after its own ones.
+
+    :param rows: Rows ordered by policy, the policy id is their first column.
+    :type  rows: iterable
+    :param planned: Rows of the same shape for some policies, indexed by policy id.
+    :type  planned: dict
+    :returns: generator -- The rows of both, still ordered by policy.
+    """
+    pending = sorted(planned)
+    position = 0
+    for policy_id, policy_rows in groupby(rows, lambda row: row[0]):
+        while position < len(pending) and pending[position] < policy_id:
+            for row in planned[pending[position]]:
+                yield row
+            position += 1
+        for row in policy_rows:
+            yield row
+        if position < len(pending) and pending[position] == policy_id:
+            for row in planned[policy_id]:
+                yield row
+            position += 1
+    for policy_id in pending[position:]:
+        for row in planned[policy_id]:
+            yield row
+
+
+def load_plans(policy_ids):
+    """Return the billing plans of some policies as dicts of columns, indexed by policy id."""
+    plans = {}
+    for start in range(0, len(policy_ids), 500):
+        for plan in db.session.query(*BillingPlan.__table__.columns)\
+                              .filter(BillingPlan.policy_id.in_(policy_ids[start:start + 500])):
+            plans[plan.policy_id] = dict(zip(plan.keys(), plan))
+    return plans
+
+
+def store_plans(policy_ids, plans, chunk_size=500):
+    """Replace the billing plans of some policies without committing, the ones without a new plan lose it."""
+    for start in range(0, len(policy_ids), chunk_size):
+        BillingPlan.query.filter(BillingPlan.policy_id.in_(policy_ids[start:start + chunk_size]))\
+                         .delete(synchronize_session=False)
+    if plans:
+        db.session.execute(BillingPlan.__table__.insert(), plans)
+
+
+def make_invoices_for_policies(policies, chunk_size=500, commit=True, lazy=None, date_cursor=None):
+    """Create the invoices of several policies at once.
+
+    The invoices previously created for the policies are marked as deleted with one update per chunk and the
+    new ones are stored with a single bulk insert, everything is committed at the end.
+
+    With lazy billing only the invoices billed until the date are stored, the rest of the schedule of every
+    policy is stored as a billing plan for the billing run and stays out of the policy balances ledger.
+
+    :param policies: Policies whose invoices will be (re)generated.
+    :type  policies: list of Policy objects
+    :param chunk_size: Number of policies per update statement. (default = 500)
+    :type  chunk_size: int
+    :param commit: If False the changes are left in the current transaction and the caller invalidates the
+                   cached data of the policies and their contacts once it commits them. (default = True)
+    :type  commit: bool
+    :param lazy: Bill the policies lazily, LAZY_BILLING if omitted.
+    :type  lazy: bool
+    :param date_cursor: Date of the lazy billing, today if omitted.
+    :type  date_cursor: datetime.date
+    """
+    if lazy is None:
+        lazy = app.config['LAZY_BILLING']
+    if date_cursor is None:
+        date_cursor = datetime.now().date()
+
+    rows = []
+    plans = []
+    policy_ids = []
+    for policy in policies:
+        if policy.status == "Canceled":
+            log.warning("Unable to create invoices for Policy %d since the policy is canceled", policy.id)
+            continue
+
+        if lazy:
+            plan = billing_plan(policy)
+            rows.extend(advance_plan(plan, date_cursor))
+            plans.append(plan)
+        else:
+            rows.extend(invoice_rows(policy))
+        policy_ids.append(policy.id)
+
+    if not policy_ids:
+        return
+
+    # If there are pending invoices, they will be marked as "deleted" since we assume that the user
+    # made changes to the policies and rendered the previous invoices invalid.
+    for start in range(0, len(policy_ids), chunk_size):
+        Invoice.query.filter(Invoice.policy_id.in_(policy_ids[start:start + chunk_size]))\
+                     .filter(Invoice.deleted == False)\
+                     .update({Invoice.deleted: True}, synchronize_session=False)
+
+    store_plans(policy_ids, plans, chunk_size)
+    if rows:
+        db.session.execute(Invoice.__table__.insert(), rows)
+    rebuild_policy_balances(policy_ids, chunk_size, commit=False)
+    record_missing_events(policy_ids, chunk_size)
+    if commit:
+        db.session.commit()
+        invalidate_policies(policy_ids)
+        # The policies may be new to their contacts, their summaries don't depend on them yet
+        for policy in policies:
+            invalidate_contact('Agent', policy.agent)
+            invalidate_contact('Named Insured', policy.named_insured)
+
+
+def future_invoice_rows(policy, date_cursor, amount):
+    """Return the invoices billed after a date by the schedule of a policy, splitting an amount between them.
+
+    If the schedule doesn't bill anything after the date the whole amount is billed the following day. Nothing
+    is billed if the amount isn't positive, e.g. when the premium was lowered below what was already billed,
+    the excess stays billed.
+
+    :returns: list -- One dict per invoice, ordered by bill date.
+    """
+    if amount <= 0:
+        return []
+    dates = [invoice for invoice in invoice_dates(policy.effective_date, policy.billing_schedule)
+             if invoice[0] > date_cursor]
+    if not dates:
+        bill_date = date_cursor + relativedelta(days=1)
+        dates = [(bill_date, bill_date + relativedelta(months=1), bill_date + relativedelta(months=1, days=14))]
+
+    amount_due = amount / len(dates)
+    return [{'policy_id': policy.id,
+             'bill_date': bill_date,
+             'due_date': due_date,
+             'cancel_date': cancel_date,
+             'amount_due': amount_due,
+             'deleted': False}
+            for bill_date, due_date, cancel_date in dates]
+
+
+def regenerate_invoices(policies, date_cursor, chunk_size=500, commit=True):
+    """Bring the invoices of some policies in line with their billing schedule without touching the past.
+
+    The invoices billed until the date are kept. The premium they don't cover is split between the dates of
+    the schedule after it, the invoices that already match one of those are kept as well, only the rest are
+    marked as deleted and only the missing ones are inserted. The policy balances ledger is only rewritten
+    after the date, so the balances until it don't change.
+
+    The policies billed lazily get the installments of their plan billed until the date issued first, then
+    their plan is replaced by one for the premium not covered, nothing after the date is inserted.
+
+    :param policies: Policies whose billing schedule or premium changed.
+    :type  policies: list of Policy objects
+    :param date_cursor: Date of the change.
+    :type  date_cursor: datetime.date
+    :param chunk_size: Number of policies per statement. (default = 500)
+    :type  chunk_size: int
+    :param commit: If False the changes are left in the current transaction and the caller invalidates the
+                   cached data of the policies once it commits them. (default = True)
+    :type  commit: bool
+    :returns: dict -- Number of invoices kept, inserted and deleted.
+    """
+    stats = {'kept': 0, 'inserted': 0, 'deleted': 0}
+    changed_ids = []
+    for start in range(0, len(policies), chunk_size):
+        chunk = []
+        for policy in policies[start:start + chunk_size]:
+            if policy.status == "Canceled":
+                log.warning("Unable to create invoices for Policy %d since the policy is canceled", policy.id)
+            else:
+                chunk.append(policy)
+        if not chunk:
+            continue
+
+        plans = load_plans([policy.id for policy in chunk])
+        existing = {}
+        for invoice in db.session.query(Invoice.id, Invoice.policy_id, Invoice.bill_date, Invoice.due_date,
+                                        Invoice.cancel_date, Invoice.amount_due)\
+                                 .filter(Invoice.policy_id.in_([policy.id for policy in chunk]))\
+                                 .filter(Invoice.deleted == False):
+            existing.setdefault(invoice.policy_id, []).append(invoice)
+
+        inserts = []
+        deletes = []
+        changed = []
+        new_plans = []
+        for policy in chunk:
+            invoices = existing.get(policy.id, [])
+            plan = plans.get(policy.id)
+            # The installments of a plan billed until the date count as kept invoices
+            due = advance_plan(plan, date_cursor) if plan else []
+            billed = sum(invoice.amount_due for invoice in invoices if invoice.bill_date <= date_cursor) + \
+                sum(row['amount_due'] for row in due)
+            stats['kept'] += len([invoice for invoice in invoices if invoice.bill_date <= date_cursor])
+            if plan:
+                new_plans.append(billing_plan(policy, date_cursor, policy.annual_premium - billed))
+                # The new plan changes the balances after the date even when nothing is inserted nor deleted
+                inserts.extend(due)
+                deletes.extend(invoice.id for invoice in invoices if invoice.bill_date > date_cursor)
+                changed.append(policy.id)
+                continue
+
+            # Identifiers of the future invoices, indexed by their content
+            future = {}
+            for invoice in invoices:
+                if invoice.bill_date > date_cursor:
+                    key = (invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due)
+                    future.setdefault(key, []).append(invoice.id)
+
+            policy_inserts = []
+            for row in future_invoice_rows(policy, date_cursor, policy.annual_premium - billed):
+                ids = future.get((row['bill_date'], row['due_date'], row['cancel_date'], row['amount_due']))
+                if ids:
+                    ids.pop()
+                    stats['kept'] += 1
+                else:
+                    policy_inserts.append(row)
+            policy_deletes = [invoice_id for ids in future.values() for invoice_id in ids]
+            if policy_inserts or policy_deletes:
+                inserts.extend(policy_inserts)
+                deletes.extend(policy_deletes)
+                changed.append(policy.id)
+
+        for delete_start in range(0, len(deletes), 500):
+            Invoice.query.filter(Invoice.id.in_(deletes[delete_start:delete_start + 500]))\
+                         .update({Invoice.deleted: True}, synchronize_session=False)
+        if new_plans:
+            store_plans([plan['policy_id'] for plan in new_plans], new_plans, chunk_size)
+        if inserts:
+            db.session.execute(Invoice.__table__.insert(), inserts)
+        if changed:
+            # The installments issued from a plan may be billed before the date
+            since = min([date_cursor] + [row['bill_date'] - relativedelta(days=1) for row in inserts])
+            rebuild_policy_balances(changed, chunk_size, commit=False, since=since)
+            record_missing_events(changed, chunk_size)
+            changed_ids.extend(changed)
+        stats['inserted'] += len(inserts)
+        stats['deleted'] += len(deletes)
+
+    if commit:
+        db.session.commit()
+        invalidate_policies(changed_ids)
+    return stats
+
+
+def expected_policy_balances(policy_ids):
+    """Calculate the ledger rows of some policies from the invoices and payments tables.
+
+    The archived payments are still part of the balance of their policies. The installments of the billing
+    plans that the billing run didn't issue yet are not, ledger_totals adds them when the balances are read.
+
+    :param policy_ids: Identifiers of the policies.
+    :type  policy_ids: list
+    :returns: dict -- List of (as_of_date, billed, paid) ordered by date, indexed by policy id.
+    """
+    events = {}
+    billed = db.session.query(Invoice.policy_id, Invoice.bill_date, func.sum(Invoice.amount_due))\
+                       .filter(Invoice.policy_id.in_(policy_ids))\
+                       .filter(Invoice.deleted == False)\
+                       .group_by(Invoice.policy_id, Invoice.bill_date)
+    for policy_id, bill_date, amount in billed:
+        events.setdefault(policy_id, {}).setdefault(bill_date, [0, 0])[0] += amount
+    paid = db.session.query(Payment.policy_id, Payment.transaction_date, func.sum(Payment.amount_paid))\
+                     .filter(Payment.policy_id.in_(policy_ids))\
+                     .group_by(Payment.policy_id, Payment.transaction_date)
+    archived = db.session.query(ArchivedPayment.policy_id, ArchivedPayment.transaction_date,
+                                func.sum(ArchivedPayment.amount_paid))\
+                         .filter(ArchivedPayment.policy_id.in_(policy_ids))\
+                         .group_by(ArchivedPayment.policy_id, ArchivedPayment.transaction_date)
+    for policy_id, transaction_date, amount in list(paid) + list(archived):
+        events.setdefault(policy_id, {}).setdefault(transaction_date, [0, 0])[1] += amount
+
+    balances = {}
+    for policy_id, dates in events.items():
+        total_billed = total_paid = 0
+        rows = balances[policy_id] = []
+        for as_of_date in sorted(dates):
+            total_billed += dates[as_of_date][0]
+            total_paid += dates[as_of_date][1]
+            rows.append((as_of_date, total_billed, total_paid))
+    return balances
+
+
+def rebuild_policy_balances(policy_ids=None, chunk_size=500, commit=True, since=None):
+    """Rebuild the policy_balances ledger from the invoices and payments tables.
+
+    :param policy_ids: Identifiers of the policies to rebuild, every policy is rebuilt if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies rebuilt per statement. (default = 500)
+    :type  chunk_size: int
+    :param commit: If False the changes are left in the current transaction and the caller invalidates the
+                   cached data of the policies once it commits them. (default = True)
+    :type  commit: bool
+    :param since: Only the rows after this date are rebuilt, when nothing changed until it. (default = None)
+    :type  since: datetime.date
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        stale = PolicyBalance.query.filter(PolicyBalance.policy_id.in_(chunk))
+        if since is not None:
+            stale = stale.filter(PolicyBalance.as_of_date > since)
+        stale.delete(synchronize_session=False)
+        rows = [{'policy_id': policy_id, 'as_of_date': as_of_date, 'billed': billed, 'paid': paid}
+                for policy_id, balances in expected_policy_balances(chunk).items()
+                for as_of_date, billed, paid in balances
+                if since is None or as_of_date > since]
+        if rows:
+            db.session.execute(PolicyBalance.__table__.insert(), rows)
+
+    if commit:
+        db.session.commit()
+        invalidate_policies(policy_ids)
+
+
+def check_policy_balances(policy_ids=None, chunk_size=500):
+    """Verify the policy_balances ledger against the invoices and payments tables.
+
+    :param policy_ids: Identifiers of the policies to verify, every policy is verified if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies verified per query. (default = 500)
+    :type  chunk_size: int
+    :returns: list -- Identifiers of the policies whose ledger doesn't match, they can be passed to
+                      rebuild_policy_balances.
+    """
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id).order_by(Policy.id)]
+
+    mismatches = []
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        expected = expected_policy_balances(chunk)
+        stored = {}
+        for row in db.session.query(PolicyBalance.policy_id, PolicyBalance.as_of_date,
+                                    PolicyBalance.billed, PolicyBalance.paid)\
+                             .filter(PolicyBalance.policy_id.in_(chunk))\
+                             .order_by(PolicyBalance.policy_id, PolicyBalance.as_of_date):
+            stored.setdefault(row.policy_id, []).append((row.as_of_date, row.billed, row.paid))
+        mismatches.extend(policy_id for policy_id in chunk
+                          if expected.get(policy_id, []) != stored.get(policy_id, []))
+
+    return mismatches
+
+
+def record_payment_balance(policy_id, date_cursor, amount):
+    """Add a payment to the policy_balances ledger without committing it.
+
+    Every ledger row since the date of the payment accumulates the amount paid, a row is added for that date
+    if the policy didn't have one. The caller invalidates the cached data of the policy once it commits it.
+    """
+    if isinstance(date_cursor, datetime):
+        date_cursor = date_cursor.date()
+
+    previous = db.session.query(PolicyBalance.as_of_date, PolicyBalance.billed, PolicyBalance.paid)\
+                         .filter(PolicyBalance.policy_id == policy_id)\
+                         .filter(PolicyBalance.as_of_date <= date_cursor)\
+                         .order_by(PolicyBalance.as_of_date.desc())\
+                         .first()
+    if previous is None or previous.as_of_date != date_cursor:
+        db.session.execute(PolicyBalance.__table__.insert(),
+                           {'policy_id': policy_id,
+                            'as_of_date': date_cursor,
+                            'billed': previous.billed if previous else 0,
+                            'paid': previous.paid if previous else 0})
+    PolicyBalance.query.filter(PolicyBalance.policy_id == policy_id)\
+                       .filter(PolicyBalance.as_of_date >= date_cursor)\
+                       .update({PolicyBalance.paid: PolicyBalance.paid + amount}, synchronize_session=False)
+
+
+def evaluate_cancellations(date_cursor=None, policy_ids=None, chunk_size=500):
+    """Cancel every policy with an unpaid invoice past its cancel date.
+
+    This is the portfolio wide version of PolicyAccounting.evaluate_cancel, it takes the same decisions but
+    evaluates a whole chunk of policies with one grouped query and cancels them with one bulk update and a
+    single commit per chunk.
+
+    :param date_cursor: The date used to verify if the policies should be canceled. (default = None)
+    :type  date_cursor: datetime.date
+    :param policy_ids: Identifiers of the policies to evaluate, every policy is evaluated if omitted.
+    :type  policy_ids: list
+    :param chunk_size: Number of policies evaluated and committed together. (default = 500)
+    :type  chunk_size: int
+    :returns: list -- Identifiers of the policies that were canceled.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+        log.debug("No date provided, today date will be used: %s", date_cursor)
+
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)
+                                                  .filter(Policy.status != "Canceled")
+                                                  .order_by(Policy.id)]
+
+    canceled = []
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+
+        # Sum of the invoices past their cancel date and the latest of those cancel dates, per policy.
+        overdue = db.session.query(Invoice.policy_id.label('policy_id'),
+                                   func.sum(Invoice.amount_due).label('amount_due'),
+                                   func.max(Invoice.cancel_date).label('cancel_date'))\
+                            .join(Policy, Policy.id == Invoice.policy_id)\
+                            .filter(Policy.status != "Canceled")\
+                            .filter(Invoice.policy_id.in_(chunk))\
+                            .filter(Invoice.cancel_date <= date_cursor)\
+                            .filter(Invoice.deleted == False)\
+                            .group_by(Invoice.policy_id)\
+                            .subquery()
+        # Payments received before that last cancel date, as evaluate_cancel does, archived ones included.
+        paid = db.session.query(func.coalesce(func.sum(Payment.amount_paid), 0))\
+                         .filter(Payment.policy_id == overdue.c.policy_id)\
+                         .filter(Payment.transaction_date < overdue.c.cancel_date)\
+                         .correlate(overdue)\
+                         .as_scalar()
+        archived = db.session.query(func.coalesce(func.sum(ArchivedPayment.amount_paid), 0))\
+                             .filter(ArchivedPayment.policy_id == overdue.c.policy_id)\
+                             .filter(ArchivedPayment.transaction_date < overdue.c.cancel_date)\
+                             .correlate(overdue)\
+                             .as_scalar()
+        to_cancel = [row.policy_id for row in db.session.query(overdue.c.policy_id)
+                                                        .filter(overdue.c.amount_due - paid - archived > 0)]
+        # Installments of a billing plan past their cancel date are only left when a billing run was skipped,
+        # those few policies are evaluated one at a time.
+        for policy_id, rows in sorted(planned_installments(date_cursor, chunk).items()):
+            if policy_id in to_cancel or rows[0]['cancel_date'] > date_cursor:
+                continue
+            pa = PolicyAccounting(policy_id, readonly=True)
+            if pa.policy.status != "Canceled" and pa.cancellation_due_to_non_pay(date_cursor):
+                to_cancel.append(policy_id)
+        if not to_cancel:
+            continue
+
+        log.info("%d policies will be canceled due lack of payment", len(to_cancel))
+        Policy.query.filter(Policy.id.in_(to_cancel))\
+                    .update({Policy.status: "Canceled",
+                             Policy.cancel_date: date_cursor,
+                             Policy.cancel_reason: "Lack of payment"},
+                            synchronize_session='fetch')
+        record_cancellations(to_cancel, date_cursor, "Lack of payment")
         db.session.commit()
+        invalidate_policies(to_cancel)
+        canceled.extend(to_cancel)
+
+    return canceled
 
 ################################
 # The functions below are for the db and
@@ -326,8 +1064,74 @@ def build_or_refresh_db():
     db.drop_all()
     db.create_all()
     insert_data()
+    rebuild_policy_balances()
+    record_missing_events()
+    db.session.commit()
     print "DB Ready!"
 
+def rebuild_with_autoincrement(table, archive_table):
+    """Rebuild a SQLite table created without AUTOINCREMENT, which only applies to the tables created with it.
+
+    The rows keep their identifiers and the new ones continue after the highest identifier of the table and
+    its archive, so an archived row never shares its identifier with a live one.
+
+    :param table: Table of a model declared with sqlite_autoincrement.
+    :type  table: sqlalchemy.Table
+    :param archive_table: Table its rows are archived to.
+    :type  archive_table: sqlalchemy.Table
+    """
+    rebuilt = table.name + '_rebuild'
+    columns = ', '.join(column.name for column in table.columns)
+    db.session.remove()
+    connection = db.engine.connect()
+    try:
+        connection.execute("ALTER TABLE %s RENAME TO %s" % (table.name, rebuilt))
+        # The indexes follow the renamed table, their names are needed for the new one
+        for index in table.indexes:
+            connection.execute("DROP INDEX IF EXISTS %s" % index.name)
+        table.create(connection)
+        connection.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (table.name, columns, columns, rebuilt))
+        connection.execute("DROP TABLE %s" % rebuilt)
+        last_id = max(connection.execute("SELECT MAX(id) FROM %s" % table.name).scalar() or 0,
+                      connection.execute("SELECT MAX(id) FROM %s" % archive_table.name).scalar() or 0)
+        connection.execute("DELETE FROM sqlite_sequence WHERE name = ?", table.name)
+        connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", table.name, last_id)
+    finally:
+        connection.close()
+
+
+def upgrade_db():
+    """Bring an existing database up to date with the models without losing its data.
+
+    Missing tables are created and the indexes declared in the models are added to the existing tables. The
+    invoices and payments tables of a SQLite database are rebuilt with AUTOINCREMENT. The policy balances
+    ledger and the accounting events are filled from the invoices and payments when their tables are created.
+    """
+    inspector = Inspector.from_engine(db.engine)
+    existing_tables = inspector.get_table_names()
+    db.create_all()
+    if db.engine.dialect.name == 'sqlite':
+        for model, archive_model in ((Invoice, ArchivedInvoice), (Payment, ArchivedPayment)):
+            definition = db.engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                           model.__tablename__).scalar()
+            if 'AUTOINCREMENT' not in definition.upper():
+                log.info("Rebuilding %s with AUTOINCREMENT", model.__tablename__)
+                rebuild_with_autoincrement(model.__table__, archive_model.__table__)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Creating index %s", index.name)
+                index.create(db.engine)
+    if PolicyBalance.__tablename__ not in existing_tables:
+        log.info("Filling the policy balances ledger")
+        rebuild_policy_balances()
+    if AccountingEvent.__tablename__ not in existing_tables:
+        log.info("Recording the accounting events")
+        record_missing_events()
+        db.session.commit()
+    log.info("DB Upgraded!")
+
 def insert_data():
     #Contacts
     contacts = []
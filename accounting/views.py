@@ -1,14 +1,34 @@
 from datetime import date, datetime
 import json
+from itertools import chain
+from Queue import Full
+from dateutil.relativedelta import relativedelta
 # You will probably need more methods from flask but this one is a good start.
 from flask import render_template, request, abort
+from sqlalchemy.orm import aliased
 
 # Import things from Flask that we need.
 from accounting import app, db
+from cache import policy_cache
+from instrumentation import metrics
+from streaming import format_date, json_array, json_stream, stream_requested
+from pagination import keyset_page
 
 # Import our models
 from models import Contact, Invoice, Policy, Payment
-from utils import PolicyAccounting
+from utils import PolicyAccounting, upgrade_db
+from importer import format_from_filename, import_policies_file
+from payment_queue import payment_queue
+from archive import audit_invoices, audit_payments, payments_query
+from ledger import policy_events
+from aging import add_to_report, aging_report, aging_rows, new_report
+from rollup import contact_summary
+
+# The shipped database only has the original tables, the ones every endpoint reads since are added once.
+@app.before_first_request
+def upgrade_database():
+    if app.config['UPGRADE_DB_ON_START']:
+        upgrade_db()
 
 # Routing for the server.
 @app.route("/")
@@ -16,118 +36,342 @@ def index():
     # You will need to serve something up here.
     return render_template('index.html')
 
-# Returns the invoices and payments for the specified policy
+# Returns the invoices and payments for the specified policy, add ?stream=1 to stream the response
 @app.route("/consult_policy", methods=['POST'])
 def consult_policy():
     response = {}
-    list_invoices = []
-    list_payments = []
     data = request.json
     try:
-        curr_date = datetime.strptime(data['date'], "%Y-%m-%d")
+        curr_date = datetime.strptime(data['date'], "%Y-%m-%d").date()
         policy_id = int(data['policy_id']['id'])
-        pa = PolicyAccounting(policy_id)
     except:
         abort(400)
+    stream = stream_requested()
+
+    # Repeated consultations of a policy are served from memory until its data changes
+    cached = policy_cache.get((policy_id, curr_date))
+    if cached is not None:
+        return cached
+
+    # Consultations never write, a policy without invoices yet shows the ones its schedule would create
+    try:
+        pa = PolicyAccounting(policy_id, readonly=True)
+    except ValueError:
+        abort(400)
+    if pa.has_plan:
+        # The invoices issued, then the installments of its billing plan the billing run didn't issue yet
+        invoices = lambda: chain(policy_invoices(policy_id, curr_date),
+                                 (format_invoice(invoice) for invoice in pa.projected_invoices(curr_date)))
+    elif pa.has_invoices:
+        invoices = lambda: policy_invoices(policy_id, curr_date)
+    else:
+        invoices = lambda: (format_invoice(invoice) for invoice in pa.projected_invoices(curr_date))
 
     # Get current balance to date
     response["total_balance"] = pa.return_account_balance(date_cursor=curr_date)
-    # Get invoices
-    invoices = Invoice.query.filter_by(policy_id=policy_id) \
-                      .filter(Invoice.bill_date <= curr_date ) \
-                      .filter(Invoice.deleted == False) \
-                      .order_by(Invoice.bill_date) \
-                      .all()
-
+    # Add policy status
+    response['policy_status'] = pa.policy.status
+
+    if stream:
+        def generate():
+            # The small fields go first, then the invoices and payments as they are read
+            yield json.dumps(response)[:-1] + ', "invoices": '
+            for piece in json_array(invoices()):
+                yield piece
+            yield ', "payments": '
+            for piece in json_array(policy_payments(policy_id, curr_date)):
+                yield piece
+            yield '}'
+        return json_stream(generate())
+
+    response['invoices'] = list(invoices())
+    response['payments'] = list(policy_payments(policy_id, curr_date))
+
+    response = json.dumps(response)
+    policy_cache.set((policy_id, curr_date), response)
+    return response
+
+def policy_invoices(policy_id, curr_date):
+    """Yield the non deleted invoices of a policy billed until a date, ordered by bill date."""
+    invoices = db.session.query(Invoice.bill_date, Invoice.due_date, Invoice.cancel_date, Invoice.amount_due)\
+                         .filter(Invoice.policy_id == policy_id)\
+                         .filter(Invoice.bill_date <= curr_date)\
+                         .filter(Invoice.deleted == False)\
+                         .order_by(Invoice.bill_date, Invoice.id)\
+                         .yield_per(app.config['STREAM_CHUNK_SIZE'])
     for invoice in invoices:
-        dict_invoice = {
-            'bill_date': invoice.bill_date.strftime("%m/%d/%Y"),
-            'due_date': invoice.due_date.strftime("%m/%d/%Y"),
-            'cancel_date': invoice.cancel_date.strftime("%m/%d/%Y"),
-            'amount_due': invoice.amount_due
-        }
-        list_invoices.append(dict_invoice)
-
-    response['invoices'] = list_invoices
-
-    # Get payments
-    payments = Payment.query.filter_by(policy_id=policy_id)\
-                            .filter(Payment.transaction_date <= curr_date)\
-                            .all()
-    print len(payments)
+        yield format_invoice(invoice)
+
+def format_invoice(invoice):
+    return {
+        'bill_date': format_date(invoice.bill_date),
+        'due_date': format_date(invoice.due_date),
+        'cancel_date': format_date(invoice.cancel_date),
+        'amount_due': invoice.amount_due
+    }
+
+def policy_payments(policy_id, curr_date):
+    """Yield the payments of a policy received until a date, archived or not, ordered by transaction date."""
+    payments = payments_query(policy_id).filter(Payment.transaction_date <= curr_date)\
+                                        .order_by(Payment.transaction_date, Payment.id)\
+                                        .yield_per(app.config['STREAM_CHUNK_SIZE'])
     for payment in payments:
-        dict_payment = {
-            'transaction_date': payment.transaction_date.strftime("%m/%d/%Y"),
+        yield {
+            'transaction_date': format_date(payment.transaction_date),
             'amount_paid': payment.amount_paid
         }
-        list_payments.append(dict_payment)
 
-    response['payments'] = list_payments
+# Page of the invoices of a policy ordered by bill date. "limit" sets the page size and "cursor" the page that
+# follows the one that returned it, add deleted=1 to include the invoices replaced by a new billing.
+@app.route("/policies/<int:policy_id>/invoices")
+def invoice_history(policy_id):
+    limit, cursor = history_page_arguments()
+    include_deleted = request.args.get('deleted', '').lower() in ('1', 'true', 'yes')
+    if db.session.query(Policy.id).filter(Policy.id == policy_id).first() is None:
+        abort(404)
+
+    invoices = db.session.query(Invoice.id, Invoice.bill_date, Invoice.due_date, Invoice.cancel_date,
+                                Invoice.amount_due, Invoice.deleted)\
+                         .filter(Invoice.policy_id == policy_id)
+    if not include_deleted:
+        invoices = invoices.filter(Invoice.deleted == False)
+    try:
+        invoices, next_cursor = keyset_page(invoices, Invoice.bill_date, Invoice.id, cursor, limit)
+    except ValueError:
+        abort(400)
 
-    # Add policy status
-    response['policy_status'] = pa.policy.status;
+    response = {'invoices': []}
+    for invoice in invoices:
+        item = format_invoice(invoice)
+        item['id'] = invoice.id
+        if include_deleted:
+            item['deleted'] = invoice.deleted
+        response['invoices'].append(item)
+    if next_cursor:
+        response['next_cursor'] = next_cursor
+    return json.dumps(response)
+
+# Page of the payments of a policy ordered by transaction date, archived ones included, with the same arguments
+# as the invoices
+@app.route("/policies/<int:policy_id>/payments")
+def payment_history(policy_id):
+    limit, cursor = history_page_arguments()
+    if db.session.query(Policy.id).filter(Policy.id == policy_id).first() is None:
+        abort(404)
 
+    try:
+        payments, next_cursor = keyset_page(payments_query(policy_id), Payment.transaction_date, Payment.id,
+                                            cursor, limit)
+    except ValueError:
+        abort(400)
+
+    response = {'payments': [{'id': payment.id,
+                              'transaction_date': format_date(payment.transaction_date),
+                              'amount_paid': payment.amount_paid,
+                              'contact_id': payment.contact_id,
+                              'archived': payment.archived}
+                             for payment in payments]}
+    if next_cursor:
+        response['next_cursor'] = next_cursor
     return json.dumps(response)
 
-# Get a list of the existing policies
+# Every invoice, payment and accounting event of a policy for audits, including the deleted and archived ones
+@app.route("/policies/<int:policy_id>/audit")
+def policy_audit(policy_id):
+    if db.session.query(Policy.id).filter(Policy.id == policy_id).first() is None:
+        abort(404)
+
+    invoices = audit_invoices(policy_id)
+    payments = audit_payments(policy_id)
+    for item in invoices:
+        for field in ('bill_date', 'due_date', 'cancel_date'):
+            item[field] = format_date(item[field])
+    for item in payments:
+        item['transaction_date'] = format_date(item['transaction_date'])
+    events = policy_events(policy_id)
+    for item in events:
+        item['effective_date'] = format_date(item['effective_date'])
+        item['recorded_at'] = item['recorded_at'].isoformat()
+    return json.dumps({'invoices': invoices, 'payments': payments, 'events': events})
+
+def history_page_arguments():
+    """Return the page size, capped to HISTORY_MAX_PAGE_SIZE, and the cursor of the history endpoints."""
+    limit = request.args.get('limit', app.config['HISTORY_PAGE_SIZE'], type=int)
+    if limit <= 0:
+        abort(400)
+    return min(limit, app.config['HISTORY_MAX_PAGE_SIZE']), request.args.get('cursor')
+
+# Returns the balance of the specified policy every step_days (one by default) between two dates, at most
+# TIMELINE_MAX_POINTS dates
+@app.route("/balance_timeline", methods=['POST'])
+def balance_timeline():
+    data = request.json
+    try:
+        start = datetime.strptime(data['start'], "%Y-%m-%d").date()
+        end = datetime.strptime(data['end'], "%Y-%m-%d").date()
+        step_days = int(data.get('step_days', 1))
+        policy_id = int(data['policy_id']['id'])
+    except:
+        abort(400)
+    if end < start or step_days <= 0:
+        abort(400)
+
+    try:
+        pa = PolicyAccounting(policy_id, readonly=True)
+    except ValueError:
+        abort(400)
+
+    try:
+        timeline = pa.balance_timeline(start, end, relativedelta(days=step_days),
+                                       app.config['TIMELINE_MAX_POINTS'])
+    except ValueError:
+        abort(400)
+    response = {'timeline': [{'date': format_date(date_cursor), 'balance': balance}
+                             for date_cursor, balance in timeline]}
+
+    return json.dumps(response)
+
+# Get a list of the existing policies, optionally paginated with the limit and offset arguments.
+# Add stream=1 to stream the response.
 @app.route("/list_policies")
 def policy_list():
     response = {}
-    list_policies = []
-    # Get policies
-    policies = Policy.query.order_by(Policy.effective_date) \
-                      .all()
-
-    for policy in policies:
-
-        insured = Contact.query.filter_by(id=policy.named_insured).one()
-        agent = Contact.query.filter_by(id=policy.agent).one()
-
-        dict_policy = {
-            'id': policy.id,
-            'policy_number': policy.policy_number,
-            'effective_date': policy.effective_date.strftime("%m/%d/%Y"),
-            'annual_premium': policy.annual_premium,
-            'insured_name': insured.name,
-            'agent_name': agent.name
-        }
-        list_policies.append(dict_policy)
+    limit = request.args.get('limit', None, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if (limit is not None and limit <= 0) or offset < 0:
+        abort(400)
 
-    response['policies'] = list_policies
+    # The insured and agent names are joined in the same query instead of being fetched per policy
+    insured = aliased(Contact)
+    agent = aliased(Contact)
+    policies = db.session.query(Policy.id,
+                                Policy.policy_number,
+                                Policy.effective_date,
+                                Policy.annual_premium,
+                                insured.name.label('insured_name'),
+                                agent.name.label('agent_name'))\
+                         .outerjoin(insured, insured.id == Policy.named_insured)\
+                         .outerjoin(agent, agent.id == Policy.agent)\
+                         .order_by(Policy.effective_date, Policy.id)
+    if limit is not None:
+        policies = policies.limit(limit)
+    if offset:
+        policies = policies.offset(offset)
+
+    listed = [0]
+    def list_policies():
+        for policy in policies.yield_per(app.config['STREAM_CHUNK_SIZE']):
+            listed[0] += 1
+            yield {
+                'id': policy.id,
+                'policy_number': policy.policy_number,
+                'effective_date': format_date(policy.effective_date),
+                'annual_premium': policy.annual_premium,
+                'insured_name': policy.insured_name,
+                'agent_name': policy.agent_name
+            }
+
+    # Let the client know where the next page starts when there could be more policies
+    def next_offset():
+        if limit is not None and listed[0] == limit:
+            return offset + limit
+
+    if stream_requested():
+        def generate():
+            yield '{"policies": '
+            for piece in json_array(list_policies()):
+                yield piece
+            if next_offset() is not None:
+                yield ', "next_offset": %d' % next_offset()
+            yield '}'
+        return json_stream(generate())
+
+    response['policies'] = list(list_policies())
+    if next_offset() is not None:
+        response['next_offset'] = next_offset()
 
     return json.dumps(response)
 
-# Get the names of the Contacts (insureds and agents)
+# Get the names of the Contacts (insureds and agents), add ?stream=1 to stream the response
 @app.route("/users")
 def users_data():
-    response = {}
-    list_agents = []
-    list_users = []
+    def list_contacts(role):
+        contacts = db.session.query(Contact.id, Contact.name)\
+                             .filter(Contact.role == role)\
+                             .order_by(Contact.id)\
+                             .yield_per(app.config['STREAM_CHUNK_SIZE'])
+        for contact in contacts:
+            yield {
+                'id': contact.id,
+                'name': contact.name
+            }
+
+    if stream_requested():
+        def generate():
+            yield '{"agents": '
+            for piece in json_array(list_contacts('Agent')):
+                yield piece
+            yield ', "users": '
+            for piece in json_array(list_contacts('Named Insured')):
+                yield piece
+            yield '}'
+        return json_stream(generate())
 
-    # Get agents
-    agents = Contact.query.filter_by(role='Agent').all()
-
-    for agent in agents:
-        dict_agent = {
-            'id': agent.id,
-            'name': agent.name
-        }
-        list_agents.append(dict_agent)
-
-    # Get users
-    users = Contact.query.filter_by(role='Named Insured').all()
+    response = {}
+    response['agents'] = list(list_contacts('Agent'))
+    response['users'] = list(list_contacts('Named Insured'))
 
-    for user in users:
-        dict_user = {
-            'id': user.id,
-            'name': user.name
-        }
-        list_users.append(dict_user)
+    return json.dumps(response)
 
-    response['agents'] = list_agents
-    response['users'] = list_users
+# Accounts receivable aging of the whole book at a date (today by default), details=1 adds every policy with a
+# balance and stream=1 streams them.
+@app.route("/reports/aging")
+def aging_data():
+    try:
+        date_cursor = datetime.strptime(request.args['date'], "%Y-%m-%d").date() \
+            if 'date' in request.args else datetime.now().date()
+    except ValueError:
+        abort(400)
+    details = request.args.get('details', '').lower() in ('1', 'true', 'yes')
+
+    if details and stream_requested():
+        def generate():
+            # The policies go first, the totals are known once all of them are sent
+            report = new_report(date_cursor)
+            def policies():
+                for policy_aging in aging_rows(date_cursor):
+                    add_to_report(report, policy_aging)
+                    if policy_aging['balance']:
+                        yield policy_aging
+            yield '{"date": %s, "policies": ' % json.dumps(report['date'])
+            for piece in json_array(policies()):
+                yield piece
+            yield ', "totals": %s, "policies_due": %d}' % (json.dumps(report['totals']), report['policies_due'])
+        return json_stream(generate())
+
+    return json.dumps(aging_report(date_cursor, details))
+
+# Summary of the policies of an agent or an insured at a date (today by default), add cache=0 to recalculate it
+@app.route("/agents/<int:contact_id>/summary")
+def agent_summary(contact_id):
+    return summary_response('Agent', contact_id)
+
+@app.route("/insureds/<int:contact_id>/summary")
+def insured_summary(contact_id):
+    return summary_response('Named Insured', contact_id)
+
+def summary_response(role, contact_id):
+    try:
+        date_cursor = datetime.strptime(request.args['date'], "%Y-%m-%d").date() \
+            if 'date' in request.args else datetime.now().date()
+    except ValueError:
+        abort(400)
+    use_cache = request.args.get('cache', '1').lower() not in ('0', 'false', 'no')
 
-    return json.dumps(response)
+    summary = contact_summary(role, contact_id, date_cursor, use_cache)
+    if summary is None:
+        abort(404)
+    return json.dumps(summary)
 
 # Create new policy
 @app.route("/create_policy", methods=['POST'])
@@ -167,6 +411,8 @@ def create_policy():
     new_policy.agent = agent
     db.session.add(new_policy)
     db.session.commit()
+    # The invoices are created with the policy, consultations don't write them
+    PolicyAccounting(new_policy.id)
 
     return "All good"
 
@@ -186,3 +432,73 @@ def make_payment():
 
     return "All Good"
 
+# Queue a payment to be stored in the background. With "ack": "durable" the response waits until the payment
+# is committed (for "timeout" seconds at most), otherwise it is sent as soon as the payment is queued.
+@app.route("/enqueue_payment", methods=['POST'])
+def enqueue_payment():
+    data = request.json
+    try:
+        curr_date = datetime.strptime(data['date'], "%Y-%m-%d").date()
+        amount = int(data['payment_amount'])
+        policy_id = int(data['policy_id']['id'])
+        ack = data.get('ack', 'queued')
+        timeout = float(data.get('timeout', 10))
+    except:
+        abort(400)
+    if ack not in ('queued', 'durable'):
+        abort(400)
+
+    # Validate the payment without loading the whole policy
+    policy = db.session.query(Policy.status, Policy.named_insured).filter(Policy.id == policy_id).first()
+    if policy is None or policy.status == "Canceled" or not policy.named_insured:
+        abort(400)
+
+    try:
+        ticket = payment_queue.enqueue(policy_id, policy.named_insured, amount, curr_date)
+    except Full:
+        abort(503)
+
+    if ack == 'durable':
+        ticket.wait(timeout)
+
+    status_codes = {'queued': 202, 'committed': 200, 'failed': 500}
+    return json.dumps(ticket.to_dict()), status_codes[ticket.status]
+
+# Status of a queued payment
+@app.route("/payment_queue/<int:ticket_id>")
+def payment_ticket(ticket_id):
+    ticket = payment_queue.ticket(ticket_id)
+    if ticket is None:
+        abort(404)
+    return json.dumps(ticket.to_dict())
+
+# Depth of the payment queue and counters of the payments stored
+@app.route("/payment_queue/metrics")
+def payment_queue_metrics():
+    return json.dumps(payment_queue.metrics())
+
+# Number and time of the SQL statements, requests per endpoint and PolicyAccounting methods of this process
+@app.route("/metrics")
+def metrics_data():
+    response = metrics.snapshot()
+    response['policy_cache'] = {'size': len(policy_cache), 'hits': policy_cache.hits,
+                                'misses': policy_cache.misses}
+    return json.dumps(response)
+
+# Bulk import of policies, contacts and payments from an uploaded CSV or JSON-lines file
+@app.route("/import_policies", methods=['POST'])
+def import_policies():
+    upload = request.files.get('file')
+    if upload is None:
+        abort(400)
+    file_format = request.form.get('format') or format_from_filename(upload.filename)
+    chunk_size = request.form.get('chunk_size', 500, type=int)
+    if chunk_size <= 0:
+        abort(400)
+
+    try:
+        stats = import_policies_file(upload.stream, file_format, chunk_size)
+    except ValueError:
+        abort(400)
+
+    return json.dumps(stats)
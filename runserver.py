@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-from accounting import app
+from accounting import app, configure_logging
 
 if __name__ == "__main__":
+    configure_logging()
     app.run(debug=True, host='0.0.0.0')